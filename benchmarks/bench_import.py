@@ -0,0 +1,153 @@
+"""
+Import time benchmark for each coder sms register entry point.
+
+Imports the module behind each process role in a fresh interpreter with python -X importtime, several times, and reports the median
+import time and the slowest modules. A role fails if it takes longer than its budget, or loads a heavy dependency it has no use for
+(e.g. SQLAlchemy in the sms api) - cold starts on scale up pay for every import, once per gunicorn worker.
+
+Usage:
+    $ python benchmarks/bench_import.py
+    $ python benchmarks/bench_import.py --runs 10 --budget-scale 2 --compare benchmarks/results/import-20240101-120000.json
+"""
+
+import os, sys, argparse, statistics, tempfile, json, subprocess
+from datetime import datetime
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../src")
+
+# role -> module imported by its entry point, import time budget in ms, and top level packages it must not load
+ROLES = {
+    "api": {
+        "module": "coder_sms_register.sms_api",
+        "budget_ms": 400,
+        "forbidden": ("sqlalchemy", "randomname", "bcrypt", "requests", "httpx"),
+    },
+    "asgi": {
+        "module": "coder_sms_register.sms_asgi",
+        "budget_ms": 250,
+        "forbidden": ("sqlalchemy", "randomname", "bcrypt", "requests", "httpx", "flask"),
+    },
+    "daemon": {
+        "module": "coder_sms_register.entrypoint",
+        "budget_ms": 250,
+        "forbidden": ("sqlalchemy", "randomname", "bcrypt", "requests", "httpx", "flask"),
+    },
+}
+
+
+def import_once(module: str, env: dict) -> tuple[float, dict, list[str]]:
+    """
+        Imports module in a fresh interpreter. Returns the cumulative import time in ms, each module's own import time in ms, and the
+        top level packages that ended up loaded.
+    """
+
+    code = f"import sys, json, {module}; print(json.dumps(sorted({{name.split('.')[0] for name in sys.modules}})))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, env=env)
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr[-2000:]}")
+
+    total_ms = None
+    self_ms = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        self_ms[name.strip()] = int(self_us) / 1000
+        if name.strip() == module:
+            total_ms = int(cumulative_us) / 1000
+
+    return total_ms, self_ms, json.loads(result.stdout)
+
+
+def bench_role(role: str, spec: dict, runs: int, env: dict, budget_scale: float) -> dict:
+    timings = []
+    self_ms = {}
+    for i in range(0, runs):
+        total_ms, run_self_ms, packages = import_once(spec["module"], env)
+        timings.append(total_ms)
+        for name, ms in run_self_ms.items():
+            self_ms.setdefault(name, []).append(ms)
+
+    slowest = sorted(((statistics.median(ms), name) for name, ms in self_ms.items()), reverse=True)[:10]
+    budget_ms = spec["budget_ms"] * budget_scale
+    median_ms = statistics.median(timings)
+    loaded = [package for package in spec["forbidden"] if package in packages]
+
+    return {
+        "module": spec["module"],
+        "median_ms": round(median_ms, 1),
+        "min_ms": round(min(timings), 1),
+        "max_ms": round(max(timings), 1),
+        "budget_ms": budget_ms,
+        "forbidden_loaded": loaded,
+        "passed": median_ms <= budget_ms and not loaded,
+        "slowest_modules_ms": {name: round(ms, 1) for ms, name in slowest},
+    }
+
+
+def compare(previous_path: str, results: dict) -> None:
+    with open(previous_path) as previous_file:
+        previous = json.load(previous_file)
+
+    print(f"\n{'compared to ' + previous.get('version', '?') + ' ' + previous.get('timestamp', ''):<40}{'before':>12}{'now':>12}")
+    for role, result in results["roles"].items():
+        before = (previous.get("roles", {}).get(role) or {}).get("median_ms")
+        print(f"{role + ' median ms':<40}{str(before):>12}{str(result['median_ms']):>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="import time of each coder sms register entry point, against a budget")
+    parser.add_argument("--roles", nargs="+", choices=list(ROLES), default=list(ROLES))
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per role - the median is reported")
+    parser.add_argument("--budget-scale", type=float, default=1, help="multiply every budget, e.g. 2 on a slow CI runner")
+    parser.add_argument("--output", help="where to save the JSON results (default benchmarks/results/import-<timestamp>.json)")
+    parser.add_argument("--compare", help="an earlier results file to compare against")
+    args = parser.parse_args()
+
+    # importing shouldn't read any settings, but point any files at a throw away directory and give it the ones every role requires just in case
+    tmp_dir = tempfile.mkdtemp(prefix="coder-sms-register-import-")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [SRC_DIR, os.environ.get("PYTHONPATH")])), CODER_REG_ETC_DIR=tmp_dir)
+    env.setdefault("REDIS_PORT", "6379")
+    env.setdefault("REDIS_DB", "0")
+
+    results = {
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "version": _version(),
+        "python": sys.version.split()[0],
+        "params": vars(args),
+        "roles": {role: bench_role(role, ROLES[role], args.runs, env, args.budget_scale) for role in args.roles},
+    }
+
+    output_path = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", f"import-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+
+    for role, result in results["roles"].items():
+        print(f"\n{role} ({result['module']})")
+        print(f"{'  median ms':<28}{result['median_ms']} (budget {result['budget_ms']}, min {result['min_ms']}, max {result['max_ms']})")
+        if result["forbidden_loaded"]:
+            print(f"{'  loaded but not needed':<28}{', '.join(result['forbidden_loaded'])}")
+        print(f"{'  slowest modules ms':<28}{result['slowest_modules_ms']}")
+        print(f"{'  result':<28}{'pass' if result['passed'] else 'FAIL'}")
+    print(f"\nresults saved to {output_path}")
+
+    if args.compare:
+        compare(args.compare, results)
+
+    if not all(result["passed"] for result in results["roles"].values()):
+        sys.exit(1)
+
+
+def _version() -> str:
+    from importlib.metadata import version, PackageNotFoundError
+
+    try:
+        return version("coder-sms-register")
+    except PackageNotFoundError:
+        return "unknown"
+
+
+if __name__ == "__main__":
+    main()
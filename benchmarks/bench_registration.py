@@ -0,0 +1,280 @@
+"""
+End to end load test for coder sms register.
+
+Starts the inbound sms api and the coder sms register threads against a local Redis, with fake Coder and Twilio servers standing in
+for the real ones. Replays signed Twilio webhooks, waits for every registration sms to reach the fake Twilio, then removes all the new
+users and their workspaces. Reports webhook latency, end to end registration latency percentiles, throughput and cleanup drain time,
+and saves the results as JSON so runs can be compared between releases.
+
+Usage (Redis must be running, e.g. the coder-sms-reg-redis-testing container):
+    $ python benchmarks/bench_registration.py --messages 2000 --concurrency 20 --redis-pw $REDIS_PW
+    $ python benchmarks/bench_registration.py --coder-latency-ms 150 --coder-error-rate .05 --compare benchmarks/results/registration-20240101-120000.json
+"""
+
+import os, sys, argparse, statistics, tempfile, threading, json, base64, hashlib, hmac, uuid, subprocess, logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import sleep, monotonic
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_services import FakeCoder, FakeTwilio
+
+PASS_PHRASE = "benchmarkpassphrase"
+TWILIO_ACCOUNT_SID = "ACbenchmark"
+TWILIO_ACCOUNT_TOKEN = "benchmark-token"
+FROM_NUM = "+15550000000"
+
+
+def _percentiles(timings: list[float]) -> dict:
+    """Returns p50, p90, p95, p99 and max of timings (seconds) in milliseconds"""
+
+    if not timings:
+        return None
+    if len(timings) == 1:
+        return {name: round(timings[0] * 1000, 2) for name in ("p50", "p90", "p95", "p99", "max")}
+
+    cuts = statistics.quantiles(timings, n=100, method="inclusive")
+    return {"p50": round(cuts[49] * 1000, 2), "p90": round(cuts[89] * 1000, 2), "p95": round(cuts[94] * 1000, 2), "p99": round(cuts[98] * 1000, 2), "max": round(max(timings) * 1000, 2)}
+
+
+def sign_webhook(url: str, params: dict, auth_token: str) -> str:
+    """Builds the X-Twilio-Signature header Twilio would send: base64 HMAC-SHA1 of the url followed by the sorted params"""
+
+    contents = url + "".join(key + params[key] for key in sorted(params))
+    return base64.b64encode(hmac.new(auth_token.encode("utf-8"), contents.encode("utf-8"), hashlib.sha1).digest()).decode("utf-8")
+
+
+def replay_webhooks(webhook_url: str, phone_nums: list[str], concurrency: int) -> dict:
+    """Posts one signed webhook per phone number, concurrency at a time. Returns phone number -> (monotonic send time, response seconds, status)."""
+
+    import requests
+
+    sessions = threading.local()
+    results = {}
+
+    def post_webhook(phone_num: str) -> None:
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+
+        params = {"MessageSid": "SM" + uuid.uuid4().hex, "AccountSid": TWILIO_ACCOUNT_SID, "From": phone_num, "To": FROM_NUM, "Body": PASS_PHRASE, "NumMedia": "0"}
+        headers = {"X-Twilio-Signature": sign_webhook(webhook_url, params, TWILIO_ACCOUNT_TOKEN)}
+
+        start = monotonic()
+        try:
+            status = sessions.session.post(webhook_url, data=params, headers=headers, timeout=30).status_code
+        except Exception:
+            status = None
+        results[phone_num] = (start, monotonic() - start, status)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(post_webhook, phone_nums))
+
+    return results
+
+
+def histogram_summary(registry) -> dict:
+    """p50 and p99 (upper bucket bounds, in seconds) and counts for every unlabelled histogram that saw observations"""
+
+    from coder_sms_register.metrics import Histogram
+
+    summary = {}
+    for metric in registry.metrics():
+        if isinstance(metric, Histogram) and not metric.labelnames and metric.snapshot()["count"]:
+            summary[metric.name] = {"count": metric.snapshot()["count"], "p50": metric.quantile(.5), "p99": metric.quantile(.99)}
+
+    return summary
+
+
+def compare(previous_path: str, results: dict) -> None:
+    with open(previous_path) as previous_file:
+        previous = json.load(previous_file)
+
+    rows = [
+        ("webhook p99 ms", ("webhook_ms", "p99")),
+        ("registration p50 ms", ("registration_ms", "p50")),
+        ("registration p99 ms", ("registration_ms", "p99")),
+        ("registrations/second", ("throughput", "registrations_per_second")),
+        ("cleanup users/second", ("cleanup", "users_per_second")),
+    ]
+
+    print(f"\n{'compared to ' + previous.get('version', '?') + ' ' + previous.get('timestamp', ''):<40}{'before':>12}{'now':>12}")
+    for label, (section, key) in rows:
+        before = (previous.get(section) or {}).get(key)
+        now = (results.get(section) or {}).get(key)
+        print(f"{label:<40}{str(before):>12}{str(now):>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="end to end registration load test against fake Coder and Twilio servers")
+    parser.add_argument("--messages", type=int, default=1000, help="signed webhooks to replay, one per phone number")
+    parser.add_argument("--concurrency", type=int, default=20, help="webhooks posted at once")
+    parser.add_argument("--sms-workers", type=int, default=4, help="SMS_WORKER_COUNT for the run")
+    parser.add_argument("--twilio-mps", type=float, default=100, help="TWILIO_MPS for the run - the default 1 would make Twilio's rate limit the only thing measured")
+    parser.add_argument("--store", choices=["sql", "redis"], default="sql", help="CODER_REG_STORE for the run")
+    parser.add_argument("--coder-latency-ms", type=float, default=50)
+    parser.add_argument("--coder-error-rate", type=float, default=0)
+    parser.add_argument("--twilio-latency-ms", type=float, default=100)
+    parser.add_argument("--twilio-error-rate", type=float, default=0)
+    parser.add_argument("--workspaces-per-user", type=int, default=1)
+    parser.add_argument("--workspace-delete-ms", type=float, default=500, help="how long the fake Coder takes to finish deleting a workspace")
+    parser.add_argument("--timeout", type=int, default=600, help="seconds to wait for every registration sms")
+    parser.add_argument("--drain-timeout", type=int, default=600, help="seconds to wait for every new user to be removed")
+    parser.add_argument("--redis-host", default=os.environ.get("REDIS_HOST", "127.0.0.1"))
+    parser.add_argument("--redis-port", default=os.environ.get("REDIS_PORT", "6379"))
+    parser.add_argument("--redis-db", default=os.environ.get("REDIS_DB", "0"))
+    parser.add_argument("--redis-pw", default=os.environ.get("REDIS_PW"))
+    parser.add_argument("--output", help="where to save the results (default: benchmarks/results/registration-<timestamp>.json)")
+    parser.add_argument("--compare", help="results file from an earlier run to compare against")
+    parser.add_argument("--verbose", action="store_true", help="show coder sms register's log output")
+    args = parser.parse_args()
+
+    run_id = uuid.uuid4().hex[:8]
+    tmp_dir = tempfile.mkdtemp(prefix="coder-sms-reg-bench-")
+
+    # the config reads these the first time a setting is used, so set them before touching Config
+    os.environ.update({
+        "CODER_REG_ENV": "dev", "REDIS_HOST": args.redis_host, "REDIS_PORT": str(args.redis_port), "REDIS_DB": str(args.redis_db),
+        "CODER_REG_PHONE_KEY": "benchmark-phone-key", "CODER_REG_PASS": PASS_PHRASE, "CODER_EMAIL_DOM": "bench.example.com", "CODER_API_KEY": "benchmark",
+        "TWILIO_ACCOUNT_SID": TWILIO_ACCOUNT_SID, "TWILIO_ACCOUNT_TOKEN": TWILIO_ACCOUNT_TOKEN, "TWILIO_AUTH_SID": TWILIO_ACCOUNT_SID, "TWILIO_AUTH_TOKEN": TWILIO_ACCOUNT_TOKEN, "FROM_NUM": FROM_NUM,
+        "CODER_REG_DB_URL": "sqlite:///" + os.path.join(tmp_dir, "bench.db"), "CODER_REG_STORE": args.store, "CODER_REG_STORE_PREFIX": f"bench_user_{run_id}",
+        "SMS_WORKER_COUNT": str(args.sms_workers), "TWILIO_MPS": str(args.twilio_mps),
+        # nobody expires while we register, then everybody does once we start the cleanup
+        "CODER_REMOVE_TIME": "1440", "CODER_CHECK_INTERVAL": "3600", "CODER_REMOVE_POLL_INTERVAL": "1",
+    })
+    if args.redis_pw:
+        os.environ["REDIS_PW"] = args.redis_pw
+
+    from coder_sms_register.config import Config
+    # keep the log files, and the stream and keys in redis, out of the way of a real install
+    Config.etc_basedir = tmp_dir
+    Config.log_path = os.path.join(tmp_dir, "coder-sms-register.log")
+    Config.redis_sms_stream_key = f"bench_sms_stream_{run_id}"
+    Config.redis_sms_dead_letter_key = f"bench_sms_stream_dead_letter_{run_id}"
+
+    fake_coder = FakeCoder(args.coder_latency_ms, args.coder_error_rate, args.workspaces_per_user, args.workspace_delete_ms).start()
+    fake_twilio = FakeTwilio(args.twilio_latency_ms, args.twilio_error_rate).start()
+    Config.coder_api_url = fake_coder.api_url
+    Config.twilio_url = fake_twilio.api_url
+
+    from coder_sms_register.sms_api import sms_api
+    from coder_sms_register.entrypoint import start_threads
+    from coder_sms_register.user_store import UserStore
+    from coder_sms_register.user_worker import UserWorker
+    from coder_sms_register.metrics import registry
+    from coder_sms_register.supervisor import Supervisor
+    from coder_sms_register.logs import setup_logging
+    from werkzeug.serving import make_server
+    import redis
+
+    setup_logging()
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+
+    api_server = make_server("127.0.0.1", 0, sms_api, threaded=True)
+    threading.Thread(target=api_server.serve_forever, daemon=True).start()
+    webhook_url = f"http://127.0.0.1:{api_server.server_port}/inbound"
+    Config.twilio_webhook_url = webhook_url
+
+    redis_conn = redis.Redis(host=Config.redis_host, port=Config.redis_port, db=Config.redis_db, password=Config.redis_pw, decode_responses=True)
+    user_store = UserStore.create(redis_conn)
+    supervisor = Supervisor()
+    start_threads(redis_conn, user_store, supervisor)
+
+    # the listener creates the consumer group at the end of the stream - anything posted before that would never be read
+    for i in range(0, 50):
+        try:
+            if redis_conn.xinfo_groups(Config.redis_sms_stream_key):
+                break
+        except redis.exceptions.ResponseError:
+            pass
+        sleep(.1)
+
+    phone_nums = ["+1555" + str(1000000 + i) for i in range(0, args.messages)]
+    print(f"replaying {args.messages} webhooks ({args.concurrency} at a time) - run {run_id}")
+    webhooks = replay_webhooks(webhook_url, phone_nums, args.concurrency)
+    accepted = [phone_num for phone_num, (start, seconds, status) in webhooks.items() if status == 200]
+
+    # wait for every accepted webhook's registration sms to reach the fake Twilio
+    deadline = monotonic() + args.timeout
+    while monotonic() < deadline and len(set(accepted) & set(fake_twilio.delivered)) < len(accepted):
+        sleep(.2)
+
+    registration_timings = [fake_twilio.delivered[phone_num] - webhooks[phone_num][0] for phone_num in accepted if phone_num in fake_twilio.delivered]
+    first_sent = min(start for start, seconds, status in webhooks.values())
+    last_delivered = max([fake_twilio.delivered[phone_num] for phone_num in accepted if phone_num in fake_twilio.delivered], default=first_sent)
+
+    shutdown_start = monotonic()
+    supervisor.shutdown(Config.shutdown_deadline)
+    shutdown_seconds = monotonic() - shutdown_start
+
+    # expire everybody, then time how long it takes to remove them all
+    Config.coder_remove_time = 0
+    sleep(1.1)
+    print(f"removing {len(registration_timings)} users")
+    cleanup_summary = UserWorker.cleanup_users(user_store, max(len(registration_timings), 1), args.drain_timeout)
+
+    results = {
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "version": _version(),
+        "git_commit": _git_commit(),
+        "params": vars(args),
+        "webhooks": {"sent": len(webhooks), "accepted": len(accepted), "failed": len(webhooks) - len(accepted)},
+        "webhook_ms": _percentiles([seconds for start, seconds, status in webhooks.values()]),
+        "registrations": {"completed": len(registration_timings), "missing": len(accepted) - len(registration_timings)},
+        "registration_ms": _percentiles(registration_timings),
+        "throughput": {
+            "seconds": round(last_delivered - first_sent, 2),
+            "registrations_per_second": round(len(registration_timings) / (last_delivered - first_sent), 2) if last_delivered > first_sent else None
+        },
+        "cleanup": cleanup_summary,
+        "shutdown_seconds": round(shutdown_seconds, 2),
+        "stage_seconds": histogram_summary(registry),
+        "fake_requests": {"coder": fake_coder.request_counts, "twilio": fake_twilio.request_counts},
+    }
+
+    output_path = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", f"registration-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+
+    print(f"\n{'webhooks accepted':<28}{results['webhooks']['accepted']} of {results['webhooks']['sent']}")
+    print(f"{'webhook ms':<28}{results['webhook_ms']}")
+    print(f"{'registrations completed':<28}{results['registrations']['completed']}")
+    print(f"{'registration ms':<28}{results['registration_ms']}")
+    print(f"{'registrations/second':<28}{results['throughput']['registrations_per_second']}")
+    print(f"{'cleanup':<28}{cleanup_summary}")
+    print(f"{'shutdown seconds':<28}{results['shutdown_seconds']}")
+    print(f"\nresults saved to {output_path}")
+
+    if args.compare:
+        compare(args.compare, results)
+
+    # tidy up redis - the stream, and the users if they were stored there
+    redis_conn.delete(Config.redis_sms_stream_key, Config.redis_sms_dead_letter_key)
+    for key in redis_conn.scan_iter(match=f"bench_user_{run_id}:*"):
+        redis_conn.delete(key)
+    api_server.shutdown()
+    fake_coder.stop()
+    fake_twilio.stop()
+
+
+def _version() -> str:
+    from importlib.metadata import version, PackageNotFoundError
+
+    try:
+        return version("coder-sms-register")
+    except PackageNotFoundError:
+        return "unknown"
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except Exception:
+        return None
+
+
+if __name__ == "__main__":
+    main()
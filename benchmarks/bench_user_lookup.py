@@ -0,0 +1,96 @@
+"""
+Benchmark for the existing user lookup in MsgManager.check_for_matching_user.
+
+Compares the keyed (phone_key) indexed lookup against the legacy bcrypt scan at a range of user counts.
+
+Usage:
+    $ python benchmarks/bench_user_lookup.py --counts 10 100 1000 10000 --legacy-counts 1 5 10 20
+"""
+
+import os, sys, argparse, statistics, tempfile
+from time import perf_counter
+
+# the config reads these the first time a setting is used - fill in safe values for a local run
+os.environ.setdefault("CODER_REG_ENV", "dev")
+os.environ.setdefault("REDIS_PORT", "6379")
+os.environ.setdefault("REDIS_DB", "0")
+os.environ.setdefault("CODER_REG_PHONE_KEY", "benchmark-phone-key")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../src"))
+
+from coder_sms_register.models import metadata_obj, users
+from coder_sms_register.sms_worker import MsgManager
+from coder_sms_register.sql_user_store import SQLUserStore
+import sqlalchemy as db
+import bcrypt, logging
+
+
+def _phone_num(i: int) -> str:
+    return "+1" + str(5550000000 + i)
+
+
+def _build_db(user_count: int, legacy: bool, bcrypt_rounds: int) -> db.engine.Engine:
+    """Create a throw away database with user_count users. Legacy users only have a bcrypt hash and no phone_key."""
+
+    db_file = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+    engine = db.create_engine("sqlite:///" + db_file.name)
+    metadata_obj.create_all(engine)
+
+    rows = []
+    for i in range(0, user_count):
+        msg_mgr = MsgManager(_phone_num(i), "", None)
+        if legacy:
+            hash_id = bcrypt.hashpw(msg_mgr.phone_num.encode("utf-8"), bcrypt.gensalt(rounds=bcrypt_rounds)).decode("utf-8")
+            phone_key = None
+        else:
+            # the hash_id just has to be unique here, we never bcrypt check rows with a phone_key
+            hash_id = "bench-" + str(i)
+            phone_key = msg_mgr.gen_phone_key()
+        rows.append({"hash_id": hash_id, "username": "user-" + str(i), "create_stamp": 1704067200, "phone_key": phone_key})
+
+    with engine.begin() as connection:
+        connection.execute(db.insert(users), rows)
+
+    return engine
+
+
+def _time_lookups(engine: db.engine.Engine, phone_nums: list[str]) -> list[float]:
+    user_store = SQLUserStore(engine)
+    timings = []
+    for phone_num in phone_nums:
+        start = perf_counter()
+        MsgManager(phone_num, "", user_store).check_for_matching_user()
+        timings.append((perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark user lookup latency against user count")
+    parser.add_argument("--counts", nargs="+", type=int, default=[10, 100, 1000, 10000], help="user counts for the keyed lookup")
+    parser.add_argument("--legacy-counts", nargs="+", type=int, default=[1, 5, 10, 20], help="user counts for the legacy bcrypt scan")
+    parser.add_argument("--bcrypt-rounds", type=int, default=12, help="bcrypt cost factor for legacy rows (12 is the bcrypt.gensalt default)")
+    parser.add_argument("--lookups", type=int, default=20, help="lookups to time per user count")
+    args = parser.parse_args()
+
+    # keep the per lookup log lines out of the results
+    logging.disable(logging.INFO)
+
+    print(f"{'mode':<8}{'users':>8}{'median ms':>12}{'max ms':>10}")
+
+    for user_count in args.counts:
+        engine = _build_db(user_count, False, args.bcrypt_rounds)
+        # half of the lookups hit an existing user and half miss
+        phone_nums = [_phone_num(i % user_count) if i % 2 == 0 else _phone_num(user_count + i) for i in range(0, args.lookups)]
+        timings = _time_lookups(engine, phone_nums)
+        print(f"{'keyed':<8}{user_count:>8}{statistics.median(timings):>12.3f}{max(timings):>10.3f}")
+
+    for user_count in args.legacy_counts:
+        engine = _build_db(user_count, True, args.bcrypt_rounds)
+        # misses are the worst case for the legacy scan - every row gets a bcrypt check, and nothing gets backfilled
+        phone_nums = [_phone_num(user_count + i) for i in range(0, min(args.lookups, 3))]
+        timings = _time_lookups(engine, phone_nums)
+        print(f"{'legacy':<8}{user_count:>8}{statistics.median(timings):>12.3f}{max(timings):>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
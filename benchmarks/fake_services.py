@@ -0,0 +1,157 @@
+"""
+Local stand-ins for the Coder V2 API and the Twilio Messages API, used by the benchmarks.
+
+Both servers add a configurable latency (mean in ms, +/- 50% jitter) and fail a configurable share of requests with a 503,
+so we can see how coder sms register behaves when the services it depends on slow down or misbehave.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from time import sleep, monotonic
+import threading, random, json, uuid
+
+
+class FakeService:
+    """A threaded HTTP server on a free local port that answers requests with handle()"""
+
+    def __init__(self, latency_ms: float =0, error_rate: float =0):
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.request_counts = {}
+
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _respond(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                status, resp_body = service.respond(self.command, self.path, body)
+
+                resp_bytes = json.dumps(resp_body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(resp_bytes)))
+                self.end_headers()
+                self.wfile.write(resp_bytes)
+
+            do_GET = do_POST = do_DELETE = _respond
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    def start(self) -> "FakeService":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def respond(self, method: str, path: str, body: bytes) -> tuple[int, dict]:
+        if self.latency_ms:
+            sleep(random.uniform(.5, 1.5) * self.latency_ms / 1000)
+
+        with self.lock:
+            self.request_counts[method] = self.request_counts.get(method, 0) + 1
+
+        if random.random() < self.error_rate:
+            return 503, {"message": "injected error"}
+
+        url = urlsplit(path)
+        return self.handle(method, url.path, parse_qs(url.query), body)
+
+    def handle(self, method: str, path: str, query: dict, body: bytes) -> tuple[int, dict]:
+        raise NotImplementedError
+
+
+class FakeCoder(FakeService):
+    """
+        Answers the Coder V2 API calls coder sms register makes: create user, get user, list workspaces, start a delete build and delete user.
+
+        Every new user gets workspaces_per_user stopped workspaces. A workspace disappears workspace_delete_ms after its delete build starts.
+    """
+
+    def __init__(self, latency_ms: float =0, error_rate: float =0, workspaces_per_user: int =1, workspace_delete_ms: float =0):
+        super().__init__(latency_ms, error_rate)
+        self.workspaces_per_user = workspaces_per_user
+        self.workspace_delete_ms = workspace_delete_ms
+        self.users = set()
+        # workspace id -> {"owner", "status", "transition", "deleted_at"}
+        self.workspaces = {}
+
+    @property
+    def api_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/api/v2/"
+
+    def handle(self, method: str, path: str, query: dict, body: bytes) -> tuple[int, dict]:
+        segments = path.strip("/").split("/")[2:] # drop api/v2
+
+        with self.lock:
+            self._finish_deletes()
+
+            if method == "POST" and segments == ["users"]:
+                username = json.loads(body)["username"]
+                self.users.add(username)
+                for i in range(0, self.workspaces_per_user):
+                    self.workspaces[str(uuid.uuid4())] = {"owner": username, "status": "stopped", "transition": "stop", "deleted_at": None}
+                return 201, {"id": str(uuid.uuid4()), "username": username}
+
+            if method == "GET" and len(segments) == 2 and segments[0] == "users":
+                if segments[1] not in self.users:
+                    return 404, {"message": "user not found"}
+                return 200, {"username": segments[1]}
+
+            if method == "GET" and segments == ["workspaces"]:
+                owner = query.get("q", [""])[0].removeprefix("owner:")
+                workspaces = [{"id": workspace_id, "latest_build": {"status": workspace["status"], "transition": workspace["transition"]}}
+                              for workspace_id, workspace in self.workspaces.items() if workspace["owner"] == owner]
+                return 200, {"count": len(workspaces), "workspaces": workspaces}
+
+            if method == "POST" and len(segments) == 3 and segments[0] == "workspaces" and segments[2] == "builds":
+                workspace = self.workspaces.get(segments[1])
+                if workspace is None:
+                    return 404, {"message": "workspace not found"}
+                workspace.update(status="deleting", transition="delete", deleted_at=monotonic() + self.workspace_delete_ms / 1000)
+                return 201, {"id": str(uuid.uuid4())}
+
+            if method == "DELETE" and len(segments) == 2 and segments[0] == "users":
+                if segments[1] not in self.users:
+                    return 404, {"message": "user not found"}
+                self.users.discard(segments[1])
+                return 200, {"message": "user deleted"}
+
+        return 404, {"message": "not found"}
+
+    def _finish_deletes(self) -> None:
+        now = monotonic()
+        for workspace_id in [workspace_id for workspace_id, workspace in self.workspaces.items() if workspace["deleted_at"] and workspace["deleted_at"] <= now]:
+            del self.workspaces[workspace_id]
+
+
+class FakeTwilio(FakeService):
+    """Answers Twilio's Messages.json endpoint and records when each phone number was sent a message"""
+
+    def __init__(self, latency_ms: float =0, error_rate: float =0):
+        super().__init__(latency_ms, error_rate)
+        # phone number -> monotonic time the first message to it was accepted
+        self.delivered = {}
+
+    @property
+    def api_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/2010-04-01/Accounts"
+
+    def handle(self, method: str, path: str, query: dict, body: bytes) -> tuple[int, dict]:
+        if method != "POST" or not path.endswith("/Messages.json"):
+            return 404, {"message": "not found"}
+
+        to_phone = parse_qs(body.decode("utf-8")).get("To", [""])[0]
+        with self.lock:
+            self.delivered.setdefault(to_phone, monotonic())
+
+        return 201, {"sid": "SM" + uuid.uuid4().hex, "to": to_phone, "status": "queued"}
@@ -0,0 +1,54 @@
+#!/bin/sh
+# container entrypoint, run by tini (see the Dockerfile) - starts redis, the coder sms register daemon and the inbound sms api,
+# and passes SIGTERM (docker stop) and SIGINT on to both so they shut down gracefully instead of being killed at the stop timeout.
+# If either process exits on its own, the other is stopped too, so the container exits and can be restarted.
+
+# make sure the default user owns the etc files so it can write logs and access the db file
+chown -R ${USERNAME}:${USERNAME} ${ETC_DIR} && \
+    chmod 700 ${ETC_DIR} || exit 1
+
+# start redis (note: REDIS_PW is injected at run time)
+redis-server --requirepass "${REDIS_PW}" --daemonize yes || exit 1
+
+# start the coder sms register application and the api as the default user - su-exec execs the command, so the pids below
+# are the processes themselves and signals reach them directly. gunicorn.conf.py picks the worker class and count from the environment
+su-exec ${USERNAME} start-coder-sms-reg &
+daemon_pid=$!
+cd ${PY_APP_DIR} && su-exec ${USERNAME} gunicorn -c gunicorn.conf.py &
+api_pid=$!
+
+stopping=""
+forward() {
+    stopping=1
+    kill -"$1" "$daemon_pid" "$api_pid" 2>/dev/null
+}
+trap 'forward TERM' TERM
+trap 'forward INT' INT
+
+# sleep in the background so a signal interrupts the wait right away, and check both processes are still running every second
+while [ -z "$stopping" ] && kill -0 "$daemon_pid" 2>/dev/null && kill -0 "$api_pid" 2>/dev/null; do
+    sleep 1 &
+    wait $!
+done
+
+# one of them exited on its own - stop the other
+if [ -z "$stopping" ]; then
+    forward TERM
+fi
+
+# wait for both to finish shutting down - wait returns early if another signal arrives, so keep waiting until each is gone.
+# The container exits with the first non-zero exit status
+status=0
+for pid in "$daemon_pid" "$api_pid"; do
+    wait "$pid"
+    pid_status=$?
+    while kill -0 "$pid" 2>/dev/null; do
+        wait "$pid"
+        pid_status=$?
+    done
+    if [ "$status" -eq 0 ]; then
+        status=$pid_status
+    fi
+done
+
+exit $status
@@ -15,15 +15,21 @@ setup(
     license='MIT License',
     packages=['coder_sms_register'],
     package_dir={'':'src'},
-    entry_points = { 'console_scripts' : ['start-coder-sms-reg=coder_sms_register.entrypoint:main']},
+    entry_points = { 'console_scripts' : ['start-coder-sms-reg=coder_sms_register.entrypoint:main', 'cleanup-coder-sms-users=coder_sms_register.entrypoint:cleanup']},
     
     install_requires=[
-        'requests', 'sqlalchemy', 'flask', 'flask_cors', 'bcrypt', 'randomname', 'redis>=5.0.0rc2'
+        'requests', 'sqlalchemy>=2.0', 'flask', 'flask_cors', 'bcrypt', 'randomname', 'redis>=5.0.0rc2'
     ],
 
     extras_require={
         # To install requirements for dev work use 'pip install -e .[dev]' 
-        'dev': ['coverage', 'mock']
+        'dev': ['coverage', 'mock', 'fakeredis[lua]'],
+        # To run with CODER_REG_RUNTIME=asyncio use 'pip install .[async]'
+        'async': ['httpx'],
+        # To serve the inbound sms api as ASGI (SMS_API_WORKER_CLASS=asgi) use 'pip install .[asgi]'
+        'asgi': ['uvicorn'],
+        # To store users in PostgreSQL (CODER_REG_DB_URL=postgresql+psycopg://...) use 'pip install .[postgres]'
+        'postgres': ['psycopg[binary]']
     },
 
     python_requires = '>=3.11',
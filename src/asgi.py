@@ -0,0 +1 @@
+from coder_sms_register.sms_asgi import sms_asgi
@@ -0,0 +1,543 @@
+from coder_sms_register.config import Config
+from coder_sms_register.coder import Coder, CoderClient, request_latency, request_retries
+from coder_sms_register.twilio import TwilioSender, send_latency, send_retries, send_failures
+from coder_sms_register.sms_worker import MsgManager, SMSWorker, process_latency, lookup_latency, create_user_latency, send_sms_latency, processed_msgs, resumed_msgs
+from coder_sms_register.idempotency import IdempotencyStore
+from coder_sms_register.sms_listener import reclaimed_msgs, dead_lettered_msgs, removed_consumers, delivered_too_often, dead_letter_fields, stale_consumers
+from coder_sms_register.resilience import next_retry_delay
+from coder_sms_register.user_store import UserStore
+from coder_sms_register.supervisor import beat
+from threading import Event
+from time import perf_counter
+import asyncio
+import redis.asyncio as aioredis
+import redis
+
+# httpx is an optional dependency - only needed when running with CODER_REG_RUNTIME=asyncio
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# Logging setup
+import logging
+logger = logging.getLogger(__name__)
+
+
+class AsyncCoder:
+    """A class used to create and delete Coder users via the V2 API from coroutines, sharing one pooled http client"""
+
+    def __init__(self, http_client: "httpx.AsyncClient"):
+        self.http_client = http_client
+        self.timeout = httpx.Timeout(Config.coder_read_timeout, connect=Config.coder_connect_timeout)
+        self.headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Coder-Session-Token": Config.coder_api_key
+        }
+
+    async def create_coder_user(self, user_name: str, pw: str) -> bool:
+        """A method that creates a Coder user via the V2 API"""
+
+        if await self.send_coder_request_with_retry(Config.coder_api_url + "users", 201, "POST", 3, Coder.new_user_body(user_name, pw)):
+            logger.info(f"successfully created user: {user_name}")
+            return True
+
+        logger.error(f"failed to create user: {user_name}")
+        return False
+
+    async def delete_coder_user(self, user_name: str) -> bool:
+        """A method that deletes a Coder user via the V2 API"""
+
+        if await self.send_coder_request_with_retry(Config.coder_api_url + "users/" + user_name, 200, "DELETE", 3):
+            logger.info(f"successfully deleted user: {user_name}")
+            return True
+
+        logger.error(f"failed to delete user: {user_name}")
+        return False
+
+    async def set_user_password(self, user_name: str, pw: str) -> bool:
+        """A method that gives an existing Coder user a new password via the V2 API"""
+
+        if await self.send_coder_request_with_retry(Config.coder_api_url + "users/" + user_name + "/password", 204, "PUT", 3, {"password": pw}):
+            logger.info(f"successfully reset the password for user: {user_name}")
+            return True
+
+        logger.error(f"failed to reset the password for user: {user_name}")
+        return False
+
+    async def send_coder_request_with_retry(self, url: str, success_status: int, http_method: str ="GET", attempts: int =3, req_body: dict =None) -> dict:
+        """
+            A method that will attempt Coder API requests with the same status aware retries, backoff and circuit breakers as Coder.send_coder_request_with_retry.
+
+            Returns respond body json as dict if successful based on the success status code provided (True if the response has no body). Otherwise returns False.
+        """
+
+        path = url.removeprefix(Config.coder_api_url)
+        breaker = Coder.breaker(path)
+        for i in range(0, attempts):
+            if not breaker.allow_request():
+                logger.warning(f"circuit {breaker.name} is open - not sending Coder API request")
+                return False
+
+            resp = await self._send_coder_request(url, http_method, req_body)
+            status_code = resp.status_code if resp is not None else None
+            breaker.record(status_code)
+
+            if status_code == success_status:
+                logger.info("Coder API request successful")
+                return resp.json() if resp.content else True
+
+            if resp is not None:
+                logger.error(f"problem with Coder API request - status code: {resp.status_code} - resp content: {resp.content}")
+
+            delay = next_retry_delay(Coder.retry_policy(), i, attempts, resp)
+            if delay is None:
+                break
+
+            await asyncio.sleep(delay)
+            request_retries.inc(method=http_method, endpoint=CoderClient.endpoint_label(path))
+
+        return False
+
+    async def _send_coder_request(self, url: str, http_method: str ="GET", req_body: dict =None) -> "httpx.Response":
+        """
+            A private method that executes Coder API requests.
+
+            Returns the response, whatever its status code. Returns None if an exception occurs (SSL issue, timeout, etc).
+        """
+
+        if http_method not in ["GET", "POST", "PUT", "DELETE"]:
+            raise Exception("invalid http_methode provided - must be 'GET', 'POST', 'PUT', or 'DELETE'")
+
+        status = "error"
+        start = perf_counter()
+        try:
+            resp = await self.http_client.request(http_method, url, headers=self.headers, json=req_body, timeout=self.timeout)
+            status = resp.status_code
+
+        except httpx.TimeoutException:
+            logger.warning("Coder api request timed out")
+            return None
+
+        except Exception as e:
+            logger.error("Coder api request encountered an unexpected error")
+            logger.error(e)
+            return None
+
+        finally:
+            request_latency.labels(method=http_method, endpoint=CoderClient.endpoint_label(url.removeprefix(Config.coder_api_url)), status=status).observe(perf_counter() - start)
+
+        return resp
+
+
+class AsyncTwilioSender:
+    """Class for sending sms messages via Twilio's api from coroutines, sharing one pooled http client"""
+
+    def __init__(self, http_client: "httpx.AsyncClient"):
+        self.http_client = http_client
+        self.timeout = httpx.Timeout(Config.twilio_read_timeout, connect=Config.twilio_connect_timeout)
+        # reuse the url, auth headers and from number built by the threaded sender
+        twilio_sender = TwilioSender()
+        self.url = twilio_sender.url
+        self.headers = twilio_sender.headers
+        self.from_phone = twilio_sender.from_phone
+        self.breaker = twilio_sender.breaker
+        self.retry_policy = twilio_sender.retry_policy
+
+    async def send_registration_sms(self, phone_num: str, phone_num_hash: str, user_email: str, pw: str) -> bool:
+        logger.info(f"attempting to send registration sms to {phone_num_hash}")
+
+        if not await self.send_sms_with_retry(2, TwilioSender.registration_body(user_email, pw), phone_num):
+            logger.error(f"failed to send sub sms to {phone_num_hash}")
+            return False
+
+        return True
+
+    async def send_sms(self, body: str, phone_num: str) -> bool:
+        if not self.breaker.allow_request():
+            logger.warning(f"circuit {self.breaker.name} is open - not sending sms")
+            return None
+
+        resp = await self._post_sms(body, phone_num)
+        if resp is None:
+            return None
+
+        if resp.status_code != 201:
+            logger.error("twilio request to send sms failed status code: {0} content: {1}".format(resp.status_code, resp.content))
+            return None
+
+        logger.info("sms message successfully sent")
+        return True
+
+    async def _post_sms(self, body: str, phone_num: str) -> "httpx.Response":
+        """A private method that makes the request to Twilio and records the result with the circuit breaker. Returns the response, or None if an exception occurs."""
+
+        logger.info("attempting to send sms")
+
+        status = "error"
+        start = perf_counter()
+        try:
+            resp = await self.http_client.post(self.url, headers=self.headers, data={"Body": body, "To": phone_num, "From": self.from_phone}, timeout=self.timeout)
+            status = resp.status_code
+        except httpx.TimeoutException:
+            logger.warning("twilio request timed out")
+            return None
+        except Exception as e:
+            logger.error("twilio request encountered an unexpected error")
+            logger.error(e)
+            return None
+        finally:
+            send_latency.labels(endpoint="messages", status=status).observe(perf_counter() - start)
+            self.breaker.record(None if status == "error" else status)
+
+        return resp
+
+    async def send_sms_with_retry(self, attempts: int, body: str, phone_num: str) -> bool:
+        # attempts = total attempts, not just retries. Only timeouts, 429s and 5xx responses are retried.
+        for i in range(0, attempts):
+            if not self.breaker.allow_request():
+                logger.warning(f"circuit {self.breaker.name} is open - not sending sms")
+                break
+
+            resp = await self._post_sms(body, phone_num)
+            if resp is not None and resp.status_code == 201:
+                logger.info("sms message successfully sent")
+                return True
+
+            if resp is not None:
+                logger.error("twilio request to send sms failed status code: {0} content: {1}".format(resp.status_code, resp.content))
+
+            delay = next_retry_delay(self.retry_policy, i, attempts, resp)
+            if delay is None:
+                break
+
+            logger.warning(f"wait {delay:.1f} seconds before we retry")
+            await asyncio.sleep(delay)
+            logger.warning("retrying twilio api call")
+            send_retries.inc()
+
+        send_failures.inc()
+        logger.error("giving up on sms send after {0} of {1} attempts".format(i + 1, attempts))
+        return None
+
+
+class AsyncEngine:
+    """
+        Runs the sms side of coder sms register on an asyncio event loop instead of threads.
+
+        Messages are read from the redis stream with an async client, and each one is processed as its own task. Coder and Twilio
+        calls share pooled async http clients, and the blocking work (bcrypt and the user store) runs on the default executor, so many
+        registrations can be waiting on the network at once.
+    """
+
+    def __init__(self, user_store: UserStore, redis_conn: aioredis.Redis, http_client: "httpx.AsyncClient", consumer_name: str, idempotency_store: IdempotencyStore):
+        self.user_store = user_store
+        # a blocking store, called on the default executor like the user store
+        self.idempotency_store = idempotency_store
+        self.redis_conn = redis_conn
+        self.coder = AsyncCoder(http_client)
+        self.twilio_sender = AsyncTwilioSender(http_client)
+        self.consumer_name = consumer_name
+        # caps the number of messages in flight, and keeps messages from the same phone number in order
+        self.in_flight = asyncio.Semaphore(Config.async_max_in_flight)
+        self.phone_locks = {}
+        self.tasks = set()
+
+    @staticmethod
+    def run(user_store: UserStore, consumer_name: str, stop: Event) -> None:
+        """A static method that runs the async engine on its own event loop until stop is set. Meant to be the target of a supervised thread."""
+
+        if httpx is None:
+            raise ImportError("the asyncio runtime requires httpx - install it with 'pip install coder-sms-register[async]'")
+
+        asyncio.run(AsyncEngine._main(user_store, consumer_name, stop))
+
+    @staticmethod
+    async def wait_for_stop(stop: Event, timeout: float) -> None:
+        """Waits up to timeout seconds, returning early once stop is set"""
+
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not stop.is_set() and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(min(.25, deadline - asyncio.get_running_loop().time()))
+
+    @staticmethod
+    async def _main(user_store: UserStore, consumer_name: str, stop: Event) -> None:
+        redis_conn = aioredis.Redis(host=Config.redis_host, port=Config.redis_port, db=Config.redis_db, password=Config.redis_pw, decode_responses=True)
+        limits = httpx.Limits(max_connections=Config.async_http_max_conns, max_keepalive_connections=Config.async_http_max_conns)
+
+        # the Coder and Twilio senders pass their own connect and read timeouts with each request
+        async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(Config.coder_read_timeout, connect=Config.coder_connect_timeout)) as http_client:
+            idempotency_store = IdempotencyStore(redis.Redis(host=Config.redis_host, port=Config.redis_port, db=Config.redis_db, password=Config.redis_pw, decode_responses=True))
+            engine = AsyncEngine(user_store, redis_conn, http_client, consumer_name, idempotency_store)
+            try:
+                # both loops stop reading new messages once stop is set (within a read's block time), then the ones in flight are drained below
+                await asyncio.gather(engine.get_messages(stop), engine.reclaim_messages(stop))
+            finally:
+                # give messages already being processed a chance to finish - anything left unacknowledged gets reclaimed later
+                if engine.tasks:
+                    await asyncio.wait(engine.tasks, timeout=Config.async_drain_timeout)
+                await redis_conn.aclose()
+
+    async def get_messages(self, stop: Event) -> None:
+        """A method that reads messages from the redis stream and starts a task for each one"""
+
+        try:
+            await self.redis_conn.xgroup_create(name=Config.redis_sms_stream_key, groupname=Config.redis_sms_consum_grp, mkstream=True, id="$")
+            logger.info(f"created consumer group: {Config.redis_sms_consum_grp}")
+        except redis.exceptions.ResponseError as e:
+            if str(e) == "BUSYGROUP Consumer Group name already exists":
+                logger.info(f"consumer group {Config.redis_sms_consum_grp} already exists - moving on")
+            else:
+                logger.error("problem creating consumer group in redis")
+                logger.error(e)
+
+        while not stop.is_set():
+            beat()
+            try:
+                streams = await self.redis_conn.xreadgroup(groupname=Config.redis_sms_consum_grp, consumername=self.consumer_name, streams={Config.redis_sms_stream_key: ">"}, count=Config.redis_msg_read_count, block=Config.redis_block_time_ms)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"problem fetching message from redis with stream: {Config.redis_sms_stream_key} , consumer group: {Config.redis_sms_consum_grp}, and consumer name: {self.consumer_name}")
+                logger.error(e)
+                await asyncio.sleep(1)
+                continue
+
+            if streams:
+                logger.info(f"{len(streams[0][1])} messages retrieved from redis stream {streams[0][0]}")
+                for msg in streams[0][1]:
+                    await self.start_task(msg[0], msg[1])
+
+    async def reclaim_messages(self, stop: Event) -> None:
+        """A method that claims messages left pending by a dead consumer, or that failed to process, the same way SMSListener.reclaim_messages does"""
+
+        while not stop.is_set():
+            # claiming while the Coder server is down would only use up the messages' deliveries
+            if Coder.breaker("users").is_open():
+                logger.warning(f"circuit {Coder.breaker('users').name} is open - not reclaiming pending messages")
+                await AsyncEngine.wait_for_stop(stop, Config.redis_claim_interval)
+                continue
+
+            start_id = "0-0"
+            try:
+                while True:
+                    next_id, claimed_msgs, deleted_ids = await self.redis_conn.xautoclaim(Config.redis_sms_stream_key, Config.redis_sms_consum_grp, self.consumer_name, Config.redis_claim_min_idle_ms, start_id=start_id, count=100)
+
+                    if deleted_ids:
+                        await self.redis_conn.xack(Config.redis_sms_stream_key, Config.redis_sms_consum_grp, *deleted_ids)
+
+                    delivery_counts = await self.delivery_counts([msg[0] for msg in claimed_msgs])
+                    for msg in claimed_msgs:
+                        delivery_count = delivery_counts.get(msg[0], 1)
+
+                        if delivered_too_often(delivery_count, Config.redis_max_deliveries):
+                            logger.error(f"message {msg[0]} failed after {delivery_count - 1} deliveries - moving it to dead letter stream {Config.redis_sms_dead_letter_key}")
+                            await self.redis_conn.xadd(Config.redis_sms_dead_letter_key, dead_letter_fields(msg[0], msg[1], delivery_count - 1), "*")
+                            await self.ack_message(msg[0])
+                            dead_lettered_msgs.inc()
+                        else:
+                            logger.warning(f"reclaimed message {msg[0]} (delivery {delivery_count})")
+                            await self.start_task(msg[0], msg[1])
+                            reclaimed_msgs.inc()
+
+                    if next_id == "0-0":
+                        break
+                    start_id = next_id
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"problem reclaiming pending messages from redis stream: {Config.redis_sms_stream_key} and consumer group: {Config.redis_sms_consum_grp}")
+                logger.error(e)
+
+            await self.remove_stale_consumers()
+            await AsyncEngine.wait_for_stop(stop, Config.redis_claim_interval)
+
+    async def delivery_counts(self, msg_ids: list[str]) -> dict[str, int]:
+        """A method that returns message id -> times delivered for messages just claimed, the same way SMSListener.delivery_counts does"""
+
+        counts = {}
+        start_id = msg_ids[0] if msg_ids else None
+        while start_id is not None and len(counts) < len(msg_ids):
+            pending = await self.redis_conn.xpending_range(Config.redis_sms_stream_key, Config.redis_sms_consum_grp, min=start_id, max=msg_ids[-1], count=len(msg_ids), consumername=self.consumer_name)
+            counts.update({entry["message_id"]: entry["times_delivered"] for entry in pending})
+            start_id = "(" + pending[-1]["message_id"] if len(pending) == len(msg_ids) else None
+
+        return counts
+
+    async def remove_stale_consumers(self) -> None:
+        """A method that removes idle consumers with nothing pending from the group, the same way SMSListener.remove_stale_consumers does"""
+
+        try:
+            for stale_name in stale_consumers(await self.redis_conn.xinfo_consumers(Config.redis_sms_stream_key, Config.redis_sms_consum_grp), self.consumer_name, Config.stale_consumer_ms):
+                await self.redis_conn.xgroup_delconsumer(Config.redis_sms_stream_key, Config.redis_sms_consum_grp, stale_name)
+                logger.info(f"removed stale consumer {stale_name} from consumer group {Config.redis_sms_consum_grp}")
+                removed_consumers.inc()
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"problem removing stale consumers from consumer group: {Config.redis_sms_consum_grp}")
+            logger.error(e)
+
+    async def start_task(self, msg_id: str, inbound_sms: dict) -> None:
+        """A method that waits for a free in flight slot, then processes the message in its own task"""
+
+        await self.in_flight.acquire()
+        task = asyncio.create_task(self.handle_message(msg_id, inbound_sms))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def handle_message(self, msg_id: str, inbound_sms: dict) -> None:
+        """A method that processes one message, one at a time per phone number, and acknowledges it once it is done"""
+
+        phone_num = inbound_sms.get("From", "")
+        # [lock, number of tasks using it] - the count lets us drop the lock once no task for this phone number needs it
+        phone_lock = self.phone_locks.setdefault(phone_num, [asyncio.Lock(), 0])
+        phone_lock[1] += 1
+
+        try:
+            async with phone_lock[0]:
+                with process_latency.time():
+                    processed = await self.process_sms(inbound_sms)
+
+        except Exception as e:
+            logger.error(f"unexpected error processing message {msg_id}")
+            logger.error(e)
+            processed = False
+
+        finally:
+            self.in_flight.release()
+            phone_lock[1] -= 1
+            if phone_lock[1] == 0:
+                del self.phone_locks[phone_num]
+
+        processed_msgs.inc(result="done" if processed else "retry")
+        if processed:
+            await self.ack_message(msg_id)
+        else:
+            logger.warning(f"message {msg_id} not processed - leaving it pending in the redis stream to be retried")
+
+    async def ack_message(self, msg_id: str) -> None:
+        try:
+            async with self.redis_conn.pipeline(transaction=Config.redis_ack_transaction) as pipe:
+                pipe.xack(Config.redis_sms_stream_key, Config.redis_sms_consum_grp, msg_id)
+                pipe.xdel(Config.redis_sms_stream_key, msg_id)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"problem acknowledging and deleting message id {msg_id} from redis stream: {Config.redis_sms_stream_key}")
+            logger.error(e)
+
+    async def process_sms(self, inbound_sms: dict) -> bool:
+        """
+            A method that processes a single inbound sms message - the coroutine version of SMSWorker.process_sms.
+
+            Returns True if the message is done with (including messages we ignore). Returns False if it should be retried.
+        """
+
+        loop = asyncio.get_running_loop()
+
+        message_sid = inbound_sms.get("MessageSid")
+        saved_state = await loop.run_in_executor(None, self.idempotency_store.get, message_sid)
+
+        if saved_state and saved_state.get("state") in ("sms_sent", "ignored"):
+            logger.info(f"message {message_sid} was already processed ({saved_state.get('state')})")
+            resumed_msgs.inc(state=saved_state.get("state"))
+            return True
+
+        # sms_queued is left by the threaded runtime's send queue - here the sms is sent inline, so either way it just needs sending
+        if saved_state and saved_state.get("state") in ("user_created", "sms_queued"):
+            logger.info(f"user {saved_state.get('username')} was already created for message {message_sid} - sending credentials")
+            resumed_msgs.inc(state=saved_state.get("state"))
+            pw = saved_state.get("pw")
+            # the password is only kept for REDIS_IDEMPOTENCY_PW_TTL seconds - past that the user gets a new one
+            if not pw:
+                if SMSWorker.coder_unavailable(message_sid):
+                    return False
+                pw = Coder.gen_password()
+                if not await self.coder.set_user_password(saved_state.get("username"), pw):
+                    return False
+                await loop.run_in_executor(None, lambda: self.idempotency_store.set_state(message_sid, saved_state.get("state"), pw=pw))
+            return await self.send_credentials(message_sid, inbound_sms["From"], saved_state.get("phone_num_hash"), {"username": saved_state.get("username"), "pw": pw})
+
+        await loop.run_in_executor(None, self.idempotency_store.set_state, message_sid, "received")
+
+        sms_msg = MsgManager(inbound_sms["From"], inbound_sms["Body"], self.user_store)
+        if not sms_msg.phone_num_valid:
+            logger.warning("invalid phone number received")
+            await loop.run_in_executor(None, self.idempotency_store.set_state, message_sid, "ignored")
+            return True
+
+        # user store lookup, and a bcrypt check for legacy rows - keep it off the event loop
+        with lookup_latency.time():
+            existing_user = await loop.run_in_executor(None, sms_msg.check_for_matching_user)
+
+        if existing_user is False:
+            return False
+
+        if existing_user:
+            logger.info(f"user {existing_user} already exists")
+            await loop.run_in_executor(None, self.idempotency_store.set_state, message_sid, "ignored")
+            return True
+
+        if not sms_msg.verify_pass_phrase():
+            await loop.run_in_executor(None, self.idempotency_store.set_state, message_sid, "ignored")
+            return True
+
+        logger.info("user does not exist and a correct pass phrase was provided. create a new user")
+        if SMSWorker.coder_unavailable(message_sid):
+            return False
+
+        with create_user_latency.time():
+            user_creds = await self.create_user(sms_msg)
+
+        if not user_creds:
+            logger.error("problem creating new user")
+            return False
+
+        logger.info("successfully created new user")
+        await loop.run_in_executor(None, lambda: self.idempotency_store.set_state(message_sid, "user_created", username=user_creds["username"], pw=user_creds["pw"], phone_num_hash=sms_msg.phone_num_hash))
+
+        return await self.send_credentials(message_sid, sms_msg.phone_num, sms_msg.phone_num_hash, user_creds)
+
+    async def send_credentials(self, message_sid: str, phone_num: str, phone_num_hash: str, user_creds: dict) -> bool:
+        """
+            A method that sends a new user's credentials and records the message as sms_sent once Twilio accepts it.
+
+            Returns False if the sms wasn't sent, so the message stays pending and the sms is tried again when it is reclaimed.
+        """
+
+        with send_sms_latency.time():
+            sms_sent = await self.twilio_sender.send_registration_sms(phone_num, phone_num_hash, user_creds["username"] + "@" + Config.coder_email_dom, user_creds["pw"])
+
+        if sms_sent:
+            logger.info(f"credentials sent for {user_creds['username']}")
+            await asyncio.get_running_loop().run_in_executor(None, self.idempotency_store.set_state, message_sid, "sms_sent")
+        else:
+            logger.error(f"failed to send credentials to {user_creds['username']}")
+
+        return sms_sent
+
+    async def create_user(self, sms_msg: MsgManager) -> dict[str]:
+        """A method to create a new Coder user and add them to the database - the coroutine version of MsgManager.create_user"""
+
+        loop = asyncio.get_running_loop()
+        creds = Coder.gen_credentials()
+
+        if not await self.coder.create_coder_user(creds["username"], creds["pw"]):
+            logger.error(f"failed to create new Coder user {creds['username']}")
+            return None
+
+        phone_hash = await loop.run_in_executor(None, sms_msg.gen_phone_hash)
+        if await loop.run_in_executor(None, sms_msg._add_user_to_db, creds["username"], phone_hash):
+            logger.info("user created and added to the database")
+            return creds
+
+        logger.error(f"failed to save new Coder user {creds['username']} to database. Deleting user.")
+        if await self.coder.delete_coder_user(creds["username"]):
+            logger.info(f"Coder user {creds['username']} successfully deleted")
+        else:
+            logger.error(f"failed to delete Coder user {creds['username']}")
+
+        return None
@@ -1,19 +1,33 @@
 from coder_sms_register.config import Config
-from time import sleep
-import randomname, secrets, requests, os
+from coder_sms_register.metrics import registry
+from coder_sms_register.resilience import CircuitBreaker, RetryPolicy, next_retry_delay
+from time import sleep, perf_counter
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+import secrets, requests, threading
 
 
 # Logging setup
 import logging
 logger = logging.getLogger(__name__)
-logger.setLevel(Config.log_level)
-logger.addHandler(Config.file_handler)
-logger.addHandler(Config.stout_handler)
+
+request_latency = registry.histogram("coder_request_seconds", "time spent on each Coder API request, by method, endpoint and response status", labelnames=("method", "endpoint", "status"))
+request_retries = registry.counter("coder_request_retries_total", "Coder API requests retried after a failed attempt", labelnames=("method", "endpoint"))
 
 
 class Coder:
     """A class used to manage users and workspaces via the Coder V2 API"""
 
+    # shared by every Coder object to delete workspaces concurrently - the number of requests actually in flight is capped by CoderClient
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    # pre-checked usernames handed out by gen_credentials - set when the username pool thread is started
+    username_pool = None
+
+    # built on first use, so importing this module doesn't read the config
+    _retry_policy = None
+
     def __init__(self, coder_username: str):
         self.coder_username = coder_username
 
@@ -21,38 +35,96 @@ class Coder:
     def gen_credentials() -> dict[str]:
         """
             A static method that generates a random username and password to be used while creating a Coder user.
-        
-            Returns a dictionary with a randomly generated user name of the form <emotion>-<fish> and password.
+
+            The username comes from the username pool when it is running, so it is already known to be free. Otherwise (or if the pool has
+            run dry) a fresh name is generated on the spot.
 
             Example return value: {"username": "happy-tuna", "pw": "MG2kpRU91bo"}.
         """
-        
-        user_name = randomname.get_name(adj=('emotions',), noun=('fish',)) # generate a random user name of the form 'happy-tuna'
-        pw = secrets.token_urlsafe(8) # generate a random password that will be about 10 characters in length
 
-        return {"username": user_name, "pw": pw}
-    
+        user_name = Coder.username_pool.take() if Coder.username_pool else None
+        if user_name is None:
+            user_name = Coder.gen_username()
+
+        return {"username": user_name, "pw": Coder.gen_password()}
+
     @staticmethod
-    def create_coder_user(user_name: str, pw: str) -> bool:
-        """A static method that creates a Coder user via the V2 API"""
+    def gen_password() -> str:
+        """A static method that generates a random password that will be about 10 characters in length"""
 
-        url = os.environ.get("CODER_API_URL") + "users"
+        return secrets.token_urlsafe(8)
 
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "Coder-Session-Token": os.environ.get("CODER_API_KEY")
-        }
+    @staticmethod
+    def gen_username() -> str:
+        """
+            A static method that generates a random username from the configured word lists, e.g. 'happy-tuna' with the default emotions and fish,
+            or 'happy-tuna-4821' with a 4 digit suffix.
+        """
 
-        req_body = {
+        # imported here so only the daemon loads randomname's word lists
+        import randomname
+
+        user_name = randomname.get_name(adj=Config.username_adjectives, noun=Config.username_nouns)
+        if Config.username_suffix_digits > 0:
+            user_name += "-" + str(secrets.randbelow(10 ** Config.username_suffix_digits)).zfill(Config.username_suffix_digits)
+
+        return user_name
+    
+    @staticmethod
+    def new_user_body(user_name: str, pw: str) -> dict:
+        """A static method that builds the request body used to create a Coder user with a password login"""
+
+        return {
             "disable_login": False,
-            "email": user_name + "@" + os.environ.get("CODER_EMAIL_DOM"),
+            "email": user_name + "@" + Config.coder_email_dom,
             "login_type": "password",
             "password": pw,
             "username": user_name
             }
+
+    @staticmethod
+    def coder_user_exists(user_name: str) -> bool:
+        """
+            A static method that checks whether the Coder server already has a user with this username. A single attempt, no retries.
+
+            Returns True or False, or None if the Coder server couldn't be asked.
+        """
+
+        breaker = Coder.breaker("users/" + user_name)
+        if not breaker.allow_request():
+            logger.warning(f"circuit {breaker.name} is open - not checking whether Coder user {user_name} exists")
+            return None
+
+        try:
+            resp = CoderClient.shared().request("GET", "users/" + user_name)
+
+        except Exception as e:
+            breaker.record(None)
+            logger.error(f"problem checking whether Coder user {user_name} exists")
+            logger.error(e)
+            return None
+
+        breaker.record(resp.status_code)
+
+        if resp.status_code == 200:
+            return True
+
+        # Coder answers 400 or 404 for a username it doesn't know
+        if resp.status_code in (400, 404):
+            return False
+
+        logger.error(f"problem checking whether Coder user {user_name} exists - status code: {resp.status_code}")
+        return None
+
+    @staticmethod
+    def create_coder_user(user_name: str, pw: str) -> bool:
+        """A static method that creates a Coder user via the V2 API"""
+
+        path = "users"
+
+        req_body = Coder.new_user_body(user_name, pw)
         
-        if Coder.send_coder_request_with_retry(url, headers, 201, "POST", 3, req_body):
+        if Coder.send_coder_request_with_retry(path, 201, "POST", 3, req_body):
             logger.info(f"successfully created user: {user_name}")
             return True
         else:
@@ -60,20 +132,29 @@ class Coder:
             return False
         
 
+    @staticmethod
+    def set_user_password(user_name: str, pw: str) -> bool:
+        """A static method that gives an existing Coder user a new password via the V2 API - used when a user's credentials sms has to be resent after their password was forgotten"""
+
+        path = "users/" + user_name + "/password"
+
+        if Coder.send_coder_request_with_retry(path, 204, "PUT", 3, {"password": pw}):
+            logger.info(f"successfully reset the password for user: {user_name}")
+            return True
+        else:
+            logger.error(f"failed to reset the password for user: {user_name}")
+            return False
+
     def get_user_workspaces(self) -> list[list[str],list[str]]:
         """A method that fetches a coder user's workspaces and adds them as a property in the object instance"""
 
-        url = os.environ.get("CODER_API_URL") + "workspaces?q=owner:" + self.coder_username
-
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "Coder-Session-Token": os.environ.get("CODER_API_KEY")
-        }
+        path = "workspaces?q=owner:" + self.coder_username
         
-        if resp_body:= Coder.send_coder_request_with_retry(url, headers, 200, "GET", 3):
+        if resp_body:= Coder.send_coder_request_with_retry(path, 200, "GET", 3):
             logger.info(f"successfully fetched workspaces for user: {self.coder_username}")
             workspaces_list = [[],[]]
+            # latest build status and transition for each workspace, used to follow workspace deletion
+            workspace_builds = []
             if resp_body.get("count") == 0:
                 logger.info(f"{self.coder_username} does not have any workspaces")
             else:
@@ -83,33 +164,30 @@ class Coder:
                         workspaces_list[1].append("stopped")
                     else:
                         workspaces_list[1].append("not stopped")
+                    workspace_builds.append({"id": workspace.get("id"), "status": workspace.get("latest_build").get("status"), "transition": workspace.get("latest_build").get("transition")})
             
             self.workspaces = workspaces_list
+            self.workspace_builds = workspace_builds
             return workspaces_list
         
         else:
             logger.error(f"failed to fetch workspaces for user: {self.coder_username}")
             self.workspaces = None
+            self.workspace_builds = None
             return None
     
     @staticmethod
     def delete_workspace(workspace_id) -> bool:
         """Static method to delete a Coder workspace via the V2 API"""
 
-        url = os.environ.get("CODER_API_URL") + "workspaces/" + workspace_id + "/builds"
-
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "Coder-Session-Token": os.environ.get("CODER_API_KEY")
-        }
+        path = "workspaces/" + workspace_id + "/builds"
 
         req_body = {
             "orphan": False,
             "transition": "delete"
         }
         
-        if resp_body:= Coder.send_coder_request_with_retry(url, headers, 201, "POST", 3, req_body):
+        if resp_body:= Coder.send_coder_request_with_retry(path, 201, "POST", 3, req_body):
             logger.info(f"successfully initated delete of workspace: {workspace_id}")
             return True
         
@@ -117,138 +195,246 @@ class Coder:
         return False
 
 
-    def remove_user_workspaces(self) -> bool:
-        """
-        A method to remove user workspaces
-        
-        Returns True if all workspaces are successfully removed or there aren't any workspaces to remove.
-        Returns False if any worspace fails to be removed.
-        """
+    @staticmethod
+    def executor() -> ThreadPoolExecutor:
+        """A static method that returns the process wide executor used for concurrent workspace deletes, creating it on first use"""
 
-        if self.get_user_workspaces() and self.workspaces[0]:
-            if "not stopped" in self.workspaces[1]:
-                logger.info(f"user {self.coder_username} has workspaces that are not stopped - cannot remove workspaces until they are stopped")
-                return False
-            
-            else:
-                workspace_remove_status = []
-                for workspace in self.workspaces[0]:
-                    if Coder.delete_workspace(workspace):
-                        workspace_remove_status.append("removed")
-                    else:
-                        workspace_remove_status.append("not removed")
-                
-                if "not removed" in workspace_remove_status:
-                    logger.error("could not remove all workspaces")
-                    return False
-                else:
-                    logger.error("all workspaces removed")
-                    return True
-            
-        else:
-            logger.info("no workspaces to remove")
-            return True
-            
+        if Coder._executor is None:
+            with Coder._executor_lock:
+                if Coder._executor is None:
+                    Coder._executor = ThreadPoolExecutor(max_workers=Config.coder_max_in_flight, thread_name_prefix="coder-delete")
+
+        return Coder._executor
+
+    @staticmethod
+    def shutdown_executor() -> None:
+        """A static method that shuts the workspace delete executor down without waiting - deletes that haven't started are cancelled"""
+
+        if Coder._executor is not None:
+            Coder._executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def retry_policy() -> RetryPolicy:
+        """A static method that returns the retry policy shared by every Coder API request, creating it on first use"""
+
+        if Coder._retry_policy is None:
+            Coder._retry_policy = RetryPolicy(Config.coder_backoff_base, Config.coder_backoff_cap, Config.retry_max_wait)
+
+        return Coder._retry_policy
+
+    @staticmethod
+    def delete_workspaces(workspace_ids: list[str]) -> dict[str, bool]:
+        """Static method that starts deleting several workspaces at once. Returns a dict of workspace id -> True if the delete was started."""
+
+        futures = {workspace_id: Coder.executor().submit(Coder.delete_workspace, workspace_id) for workspace_id in workspace_ids}
+        return {workspace_id: future.result() for workspace_id, future in futures.items()}
 
     def delete_coder_user(self) -> bool:
         """A method that deletes a Coder user via the V2 API"""
         
-        url = os.environ.get("CODER_API_URL") + "users/" + self.coder_username
-
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "Coder-Session-Token": os.environ.get("CODER_API_KEY")
-        }
+        path = "users/" + self.coder_username
         
-        if Coder.send_coder_request_with_retry(url, headers, 200, "DELETE", 3):
+        if Coder.send_coder_request_with_retry(path, 200, "DELETE", 3):
             logger.info(f"successfully deleted user: {self.coder_username}")
             return True
         else:
             logger.error(f"failed to delete user: {self.coder_username}")
             return False
     
-    def remove_user(self) -> bool:
-        """A method to remove the user set in the Coder object and their workspaces from the Coder server"""
+    def remove_user_step(self, remove_state: str) -> str:
+        """
+            A method that moves the removal of the user set in the Coder object one step forward without waiting on the Coder server.
+
+            remove_state: where the removal currently stands - "expired", "workspaces_deleting", or "user_deleting".
 
-        if self.remove_user_workspaces():
-            # wait for 60 seconds for the workspaces to finish deleting before deleting the user
-            sleep(60)
+            Returns the new remove state, which is the same state if the step couldn't be completed yet, or "done" once the user is deleted.
+        """
 
+        if remove_state == "expired":
+            if self.get_user_workspaces() is None:
+                return "expired"
+
+            # workspaces already being deleted don't need another delete build, but anything else has to be stopped first
+            to_delete = [build["id"] for build in self.workspace_builds if build["transition"] != "delete" or build["status"] == "failed"]
+            not_stopped = [build["id"] for build in self.workspace_builds if build["transition"] != "delete" and build["status"] != "stopped"]
+            if not_stopped:
+                logger.info(f"user {self.coder_username} has workspaces that are not stopped - cannot remove workspaces until they are stopped")
+                return "expired"
+
+            if False in Coder.delete_workspaces(to_delete).values():
+                logger.error(f"could not start deleting all workspaces for {self.coder_username}")
+                return "expired"
+
+            return "workspaces_deleting" if self.workspace_builds else "user_deleting"
+
+        if remove_state == "workspaces_deleting":
+            if self.get_user_workspaces() is None:
+                return "workspaces_deleting"
+
+            if not self.workspace_builds:
+                logger.info(f"all workspaces deleted for {self.coder_username}")
+                return "user_deleting"
+
+            # restart any delete build that failed, or was replaced by another build in the meantime
+            to_delete = []
+            for build in self.workspace_builds:
+                if build["transition"] != "delete" or build["status"] == "failed":
+                    if build["status"] in ["stopped", "failed"]:
+                        logger.warning(f"workspace {build['id']} is not being deleted (status: {build['status']}) - starting delete again")
+                        to_delete.append(build["id"])
+                    else:
+                        logger.warning(f"workspace {build['id']} for {self.coder_username} is {build['status']} - waiting for it to stop")
+            Coder.delete_workspaces(to_delete)
+
+            logger.info(f"{self.coder_username} still has {len(self.workspace_builds)} workspaces being deleted")
+            return "workspaces_deleting"
+
+        if remove_state == "user_deleting":
             if self.delete_coder_user():
                 logger.info(f"{self.coder_username} successfully removed")
-                return True
-            else:
-                logger.error(f"{self.coder_username} not successfully removed")
-                return False
-        else:
-            logger.info(f"{self.coder_username} still has workspaces - we need to wait until they are deleted to remove the user")
-            return False
+                return "done"
+
+            logger.error(f"{self.coder_username} not successfully removed")
+            return "user_deleting"
+
+        raise Exception(f"invalid remove_state provided: {remove_state}")
 
     @staticmethod
-    def send_coder_request_with_retry(url: str, headers: dict, success_status: int, http_method: str ="GET", attempts: int =3, req_body: dict =None) -> dict:
+    def breaker(path: str) -> CircuitBreaker:
+        """A static method that returns the circuit breaker for the Coder API endpoint path belongs to, e.g. "users/happy-tuna" -> coder:users/{id}"""
+
+        return CircuitBreaker.get("coder:" + CoderClient.endpoint_label(path))
+
+    @staticmethod
+    def send_coder_request_with_retry(path: str, success_status: int, http_method: str ="GET", attempts: int =3, req_body: dict =None) -> dict:
         """
-            A static method that will attempt Coder API requests with retries in a backoff pattern. 
+            A static method that will attempt Coder API requests with retries in a jittered exponential backoff pattern.
+
+            path: the part of the url after CODER_API_URL, e.g. "users".
+
+            Only timeouts, connection errors, 429s and 5xx responses are retried, and never sooner than a Retry-After header asks. Nothing is
+            sent while the endpoint's circuit breaker is open, so callers fail fast while the Coder server is down.
 
-            Returns respond body json as dict if successful based on the success status code provided. Otherwise returns False.
+            Returns respond body json as dict if successful based on the success status code provided (True if the response has no body). Otherwise returns False.
         """
+
+        breaker = Coder.breaker(path)
         for i in range(0, attempts):
-            if resp_body:= Coder._send_user_coder_request(url, headers, success_status, http_method, req_body):
-                return resp_body
-            else:
-                sleep(i ** 3 + .2) # sleep for .2, 1.2, 8.2, 27.2 ... seconds between retries
-        
+            if not breaker.allow_request():
+                logger.warning(f"circuit {breaker.name} is open - not sending Coder API request")
+                return False
+
+            resp = Coder._send_user_coder_request(path, http_method, req_body)
+            status_code = resp.status_code if resp is not None else None
+            breaker.record(status_code)
+
+            if status_code == success_status:
+                logger.info("Coder API request successful")
+                return resp.json() if resp.content else True
+
+            if resp is not None:
+                logger.error(f"problem with Coder API request - status code: {resp.status_code} - resp content: {resp.content}")
+
+            delay = next_retry_delay(Coder.retry_policy(), i, attempts, resp)
+            if delay is None:
+                break
+
+            sleep(delay)
+            request_retries.inc(method=http_method, endpoint=CoderClient.endpoint_label(path))
+
         # if we never complete a successful request in the number of attemptes allotted, return False
-        return False 
+        return False
 
 
     @staticmethod
-    def _send_user_coder_request(url: str, headers: dict, success_status: int, http_method: str ="GET", req_body:dict =None) -> dict:
+    def _send_user_coder_request(path: str, http_method: str ="GET", req_body:dict =None) -> requests.Response:
         """
-            A private static method that executes Coder API requests.  
+            A private static method that executes Coder API requests through the shared CoderClient.
 
-            http_method: must be "GET", "POST", or "DELETE".  
+            http_method: must be "GET", "POST", "PUT", or "DELETE".
 
-            Returns None if an exception occurs (SSL issue, timeout, etc). Returns False if any status code other than the success_status provided
-            is returned from the API. Returns response body json as dict if the success_status provided is returned from the API.
+            Returns the response, whatever its status code. Returns None if an exception occurs (SSL issue, timeout, etc).
         """
 
         # validate http method - raise exception if wrong
-        if http_method not in ["GET", "POST", "DELETE"]:
-            raise Exception("invalid http_methode provided - must be 'GET', 'POST', or 'DELETE'")
-        
-        try:
-            if http_method == "GET":
-                resp = requests.get(url=url, headers=headers, timeout=10)
+        if http_method not in ["GET", "POST", "PUT", "DELETE"]:
+            raise Exception("invalid http_methode provided - must be 'GET', 'POST', 'PUT', or 'DELETE'")
 
-            elif http_method == "POST":
-                resp = requests.post(url=url, headers=headers, json=req_body, timeout=10)
-            
-            elif http_method == "DELETE":
-                resp = requests.delete(url=url, headers=headers, timeout=10)
+        try:
+            return CoderClient.shared().request(http_method, path, req_body)
 
         except requests.exceptions.Timeout:
             logger.warning("Coder api request timed out")
             return None
-        
+
         except requests.exceptions.SSLError:
             logger.warning("Coder api request experienced an SSL error")
             return None
-        
+
         except Exception as e:
             logger.error("Coder api request encountered an unexpected error")
             logger.error(e)
             return None
 
-        if resp.status_code == success_status:
-            logger.info(f"Coder API request successful")
-            return resp.json()
-        
-        else:
-            logger.error(f"problem with Coder API request - status code: {resp.status_code} - resp content: {resp.content}")
-            return False
 
-            
+class CoderClient:
+    """
+        A long lived client for the Coder V2 API.
 
-    
+        Owns a requests.Session with a pool of keep-alive connections and the auth headers, so each request reuses an open
+        TCP/TLS connection to the Coder server instead of doing a new handshake.
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, api_url: str, api_key: str, pool_size: int =10, connect_timeout: float =3.05, read_timeout: float =10, max_in_flight: int =10):
+        self.api_url = api_url
+        self.timeout = (connect_timeout, read_timeout)
+        # caps the requests this process has open against the Coder server at once, no matter how many threads are calling
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Coder-Session-Token": api_key
+        })
+
+    @staticmethod
+    def shared() -> "CoderClient":
+        """A static method that returns the process wide CoderClient, creating it from the environment on first use"""
+
+        if CoderClient._shared is None:
+            with CoderClient._shared_lock:
+                if CoderClient._shared is None:
+                    CoderClient._shared = CoderClient(Config.coder_api_url, Config.coder_api_key, Config.coder_pool_size, Config.coder_connect_timeout, Config.coder_read_timeout, Config.coder_max_in_flight)
+
+        return CoderClient._shared
+
+    @staticmethod
+    def endpoint_label(path: str) -> str:
+        """
+            A static method that turns a request path into a metric label without user names or ids, so each endpoint is a single series.
+
+            Example: "workspaces/1234/builds" -> "workspaces/{id}/builds", "workspaces?q=owner:happy-tuna" -> "workspaces"
+        """
 
+        segments = path.split("?")[0].strip("/").split("/")
+        return "/".join("{id}" if i % 2 else segment for i, segment in enumerate(segments))
+
+    def request(self, http_method: str, path: str, req_body: dict =None) -> requests.Response:
+        """A method that sends a request to the Coder API - path is appended to the api url"""
+
+        with self.in_flight:
+            status = "error"
+            start = perf_counter()
+            try:
+                resp = self.session.request(http_method, self.api_url + path, json=req_body, timeout=self.timeout)
+                status = resp.status_code
+                return resp
+            finally:
+                request_latency.labels(method=http_method, endpoint=CoderClient.endpoint_label(path), status=status).observe(perf_counter() - start)
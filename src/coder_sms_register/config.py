@@ -1,55 +1,299 @@
-import os, logging, sys
-from logging.handlers import RotatingFileHandler
-
-
-class Config:
-
-    ### -- WHERE TO FIND FILES --- ###
-    if os.environ.get("CODER_REG_ENV") == "dev":
-        etc_basedir = os.path.abspath(os.path.dirname(__file__))
-        etc_basedir = os.path.join(etc_basedir, '../../')
-    
-    else:
-        etc_basedir = '/etc/coder-sms-register'
-  
-    db_path = os.path.join(etc_basedir, "coder_sms_register.db")
-
-    ### --- LOG PARAMETERS --- ###
-    # don't do debug level if running in a prod environament
-    if os.environ.get("CODER_REG_LOG_LEVEL") == "debug" and os.environ.get("CODER_REG_ENV") == "dev":
-        set_log_level = logging.DEBUG
-    else:
-        set_log_level = logging.INFO
-
-    log_path = os.path.join(etc_basedir, "coder-sms-register.log")
-    log_level = set_log_level
-    log_format = logging.Formatter(" %(asctime)s - [%(levelname)s] - %(name)s - %(threadName)s - %(message)s", "%Y-%m-%d %H:%M:%S %z")
-    log_maxbytes = 5000000
-    log_backup_count = 1
-
-    file_handler = RotatingFileHandler(log_path, maxBytes=log_maxbytes, backupCount=log_backup_count) 
-    file_handler.setLevel(log_level)
-    file_handler.setFormatter(log_format)
-
-    stout_handler = logging.StreamHandler(sys.stdout)
-    stout_handler.setLevel(log_level)
-    stout_handler.setFormatter(log_format)
-
-    # Logging setup
-    logger = logging.getLogger(__name__)
-    logger.setLevel(log_level)
-    logger.addHandler(file_handler)
-    logger.addHandler(stout_handler)
-
-    ### -- TWILIO PARAMETERS --- ###
-    twilio_url = "https://api.twilio.com/2010-04-01/Accounts"
-
-    ### -- REDIS PARAMETERS --- ###
-    redis_host = os.environ.get("REDIS_HOST")
-    redis_port = int(os.environ.get("REDIS_PORT"))
-    redis_pw = os.environ.get("REDIS_PW")
-    redis_db = int(os.environ.get("REDIS_DB"))
-    redis_sms_stream_key = "sms_stream"
-    redis_sms_consum_grp = "sms_consum_grp"
-    redis_msg_read_count = 3
-    redis_block_time_ms = 1000
\ No newline at end of file
+import os, logging, socket, threading, importlib.util
+
+
+class ConfigError(Exception):
+    """Raised when settings in the environment are missing or invalid - the message lists every problem found, not just the first"""
+
+
+class EnvReader:
+    """Reads and converts settings from an environment mapping, collecting every problem instead of stopping at the first one"""
+
+    def __init__(self, environ: dict):
+        self.environ = environ
+        self.errors = []
+
+    def get_str(self, name: str, default: str =None, required: bool =False, choices: tuple[str] =None, lower: bool =False) -> str:
+        value = self.environ.get(name) or default
+        if value is None:
+            if required:
+                self.errors.append(f"{name} is not set")
+            return None
+
+        if lower:
+            value = value.lower()
+        if choices is not None and value not in choices:
+            self.errors.append(f"{name} must be one of {', '.join(choices)} - got '{value}'")
+
+        return value
+
+    def get_int(self, name: str, default: int =None, required: bool =False, minimum: int =None) -> int:
+        return self._get_number(name, int, default, required, minimum, None)
+
+    def get_float(self, name: str, default: float =None, required: bool =False, minimum: float =None, maximum: float =None) -> float:
+        return self._get_number(name, float, default, required, minimum, maximum)
+
+    def get_bool(self, name: str, default: bool) -> bool:
+        value = self.get_str(name, "true" if default else "false", choices=("true", "false", "1", "0", "yes", "no"), lower=True)
+        return value in ("true", "1", "yes")
+
+    def get_list(self, name: str, default: str) -> tuple[str]:
+        return tuple(item.strip() for item in self.get_str(name, default).split(",") if item.strip())
+
+    def _get_number(self, name: str, number_type: type, default, required: bool, minimum, maximum):
+        value = self.environ.get(name)
+        if value in (None, ""):
+            if required:
+                self.errors.append(f"{name} is not set")
+            return default
+
+        try:
+            number = number_type(value)
+        except ValueError:
+            self.errors.append(f"{name} must be {'an integer' if number_type is int else 'a number'} - got '{value}'")
+            return default
+
+        if minimum is not None and number < minimum:
+            self.errors.append(f"{name} must be at least {minimum} - got {number}")
+        if maximum is not None and number > maximum:
+            self.errors.append(f"{name} must be at most {maximum} - got {number}")
+
+        return number
+
+    def check(self) -> None:
+        """Raises ConfigError listing every problem found while reading settings"""
+
+        if self.errors:
+            raise ConfigError("invalid settings: " + "; ".join(self.errors))
+
+
+class Settings:
+    """
+        Every setting for coder sms register, read from the environment and checked in one go when the object is built.
+
+        role: the process the settings are for - "daemon" (start-coder-sms-reg), "cleanup" (cleanup-coder-sms-users) or "api" (the
+        inbound sms api). Settings only some processes use are required for those roles. None checks only what every process needs.
+
+        Build it through Config (below) rather than directly, so each process reads its settings once, the first time one is needed.
+    """
+
+    roles = ("daemon", "cleanup", "api")
+
+    def __init__(self, environ: dict, role: str =None):
+        if role is not None and role not in Settings.roles:
+            raise ValueError(f"unknown role: {role} - expected one of {', '.join(Settings.roles)}")
+
+        env = EnvReader(environ)
+        self.role = role
+        daemon = role == "daemon"
+        coder_client = role in ("daemon", "cleanup")
+
+        ### -- WHERE TO FIND FILES --- ###
+        if env.get_str("CODER_REG_ETC_DIR"):
+            self.etc_basedir = env.get_str("CODER_REG_ETC_DIR")
+        elif env.get_str("CODER_REG_ENV") == "dev":
+            self.etc_basedir = os.path.join(os.path.abspath(os.path.dirname(__file__)), '../../')
+        else:
+            self.etc_basedir = '/etc/coder-sms-register'
+
+        self.db_path = os.path.join(self.etc_basedir, "coder_sms_register.db")
+
+        ### -- DATABASE PARAMETERS --- ###
+        # any SQLAlchemy url, e.g. postgresql://user:pw@host/db for larger deployments - defaults to the SQLite file above
+        self.db_url = env.get_str("CODER_REG_DB_URL", "sqlite:///" + self.db_path)
+        self.db_pool_size = env.get_int("CODER_REG_DB_POOL_SIZE", 10, minimum=1)
+        self.db_pool_overflow = 5
+        self.db_busy_timeout_ms = 5000 # how long a SQLite connection waits on a lock before giving up
+        self.db_mmap_size = 64 * 1024 * 1024 # bytes of the SQLite file memory mapped for reads
+
+        ### --- METRICS PARAMETERS --- ###
+        # port the daemon serves Prometheus metrics on at /metrics - 0 turns the metrics server off. The sms api serves its own at /metrics.
+        self.metrics_port = env.get_int("METRICS_PORT", 9100, minimum=0)
+
+        ### --- USER STORE PARAMETERS --- ###
+        # where users are kept - 'sql' (the database above, default) or 'redis', so several register processes can share users
+        self.user_store = env.get_str("CODER_REG_STORE", "sql", choices=("sql", "redis"), lower=True)
+        self.redis_user_key_prefix = env.get_str("CODER_REG_STORE_PREFIX", "coder_user")
+
+        ### --- LOG PARAMETERS --- ###
+        # don't do debug level if running in a prod environament
+        if env.get_str("CODER_REG_LOG_LEVEL") == "debug" and env.get_str("CODER_REG_ENV") == "dev":
+            self.log_level = logging.DEBUG
+        else:
+            self.log_level = logging.INFO
+
+        self.log_path = os.path.join(self.etc_basedir, "coder-sms-register.log")
+        self.log_format = logging.Formatter(" %(asctime)s - [%(levelname)s] - %(name)s - %(threadName)s - %(message)s", "%Y-%m-%d %H:%M:%S %z")
+        self.log_maxbytes = 5000000
+        self.log_backup_count = 1
+        self.log_json = env.get_str("CODER_REG_LOG_FORMAT", "text", choices=("text", "json"), lower=True) == "json" # one JSON object per line instead of the text format above
+        self.log_sample_rate = env.get_float("CODER_REG_LOG_SAMPLE_RATE", 1, minimum=0, maximum=1) # share of debug and info lines kept - warnings and errors are always kept
+
+        ### -- SMS API PARAMETERS --- ###
+        # publish webhooks from concurrent request threads (gunicorn --threads) to the stream in one pipeline per batch
+        self.sms_api_batch_xadd = env.get_bool("SMS_API_BATCH_XADD", False)
+        self.sms_api_batch_max = 100 # most messages per pipeline
+        self.sms_api_batch_wait_ms = env.get_float("SMS_API_BATCH_WAIT_MS", 2, minimum=0) # longest a message waits for others to join its batch
+        self.sms_api_xadd_timeout = 5 # seconds a webhook waits for its batch to be published before answering with a 500
+        # turn webhooks away once this many messages are waiting in the stream - 0 turns load shedding off
+        self.sms_api_shed_backlog = env.get_int("SMS_API_SHED_BACKLOG", 10000, minimum=0)
+        self.sms_api_shed_mode = env.get_str("SMS_API_SHED_MODE", "twiml", choices=("twiml", "503"), lower=True) # 'twiml' replies to the sender with the message below, '503' answers Twilio with a 503
+        self.sms_api_shed_msg = env.get_str("SMS_API_SHED_MSG", "We are getting a lot of messages right now. Please text us again in a few minutes.")
+        self.sms_api_shed_retry_after = 60 # seconds, sent in the Retry-After header of a 503
+        self.sms_api_backlog_check_interval = 1 # seconds between checks of the stream length
+
+        ### -- USER LOOKUP PARAMETERS --- ###
+        # server side secret used to build the keyed (HMAC) phone number lookup stored alongside the bcrypt hash. It must never change once
+        # users exist - their phone keys wouldn't match anymore, and there is deliberately no fallback (a bcrypt check per user per registration)
+        self.phone_key_secret = env.get_str("CODER_REG_PHONE_KEY", required=daemon)
+        self.coder_reg_pass = env.get_str("CODER_REG_PASS", required=daemon) # pass phrase a new user texts to get a login
+
+        ### -- SMS WORKER PARAMETERS --- ###
+        self.sms_worker_count = env.get_int("SMS_WORKER_COUNT", 4, minimum=1) # number of threads processing inbound sms messages
+
+        ### -- USERNAME PARAMETERS --- ###
+        # randomname word lists new usernames are built from (comma separated), e.g. CODER_REG_NAME_ADJ=emotions,colors CODER_REG_NAME_NOUN=fish,birds
+        self.username_adjectives = env.get_list("CODER_REG_NAME_ADJ", "emotions")
+        self.username_nouns = env.get_list("CODER_REG_NAME_NOUN", "fish")
+        self.username_suffix_digits = env.get_int("CODER_REG_NAME_SUFFIX_DIGITS", 0, minimum=0) # random digits added to each name, e.g. 4 -> happy-tuna-4821
+        self.username_pool_size = env.get_int("CODER_REG_NAME_POOL_SIZE", 20, minimum=0) # pre-checked free usernames kept ready - 0 turns the pool off
+        self.username_pool_interval = 1 # seconds between checks that the pool is full
+
+        ### -- RUNTIME PARAMETERS --- ###
+        # 'threads' (default) or 'asyncio' - asyncio mode requires the optional httpx dependency (pip install coder-sms-register[async])
+        self.runtime = env.get_str("CODER_REG_RUNTIME", "threads", choices=("threads", "asyncio"), lower=True)
+        # checked here so a missing dependency stops the daemon at startup, instead of crashing the supervised async engine thread over and over
+        if daemon and self.runtime == "asyncio" and importlib.util.find_spec("httpx") is None:
+            env.errors.append("CODER_REG_RUNTIME=asyncio requires httpx - install it with pip install coder-sms-register[async]")
+        self.async_max_in_flight = env.get_int("ASYNC_MAX_IN_FLIGHT", 500, minimum=1) # max inbound sms messages processed at once in asyncio mode
+        self.async_http_max_conns = env.get_int("ASYNC_HTTP_MAX_CONNS", 100, minimum=1) # size of the shared Coder/Twilio connection pool in asyncio mode
+        self.async_drain_timeout = 10 # seconds to let in flight messages finish when shutting down in asyncio mode
+        # this replica's consumer name in the redis consumer group - unique per host and process unless set, so replicas never share one
+        self.consumer_name = env.get_str("CODER_REG_CONSUMER_NAME") or f"{socket.gethostname()}-{os.getpid()}"
+        self.stale_consumer_ms = env.get_int("STALE_CONSUMER_MS", 3600000, minimum=0) # consumers with nothing pending and idle this long (e.g. replicas that were replaced) are removed from the group
+        # only the replica holding the leader lease runs user cleanup - if it dies, another replica takes over within LEADER_LEASE_TTL seconds
+        self.leader_lease_key = "coder_sms_register:user_cleanup_leader"
+        self.leader_lease_ttl = env.get_float("LEADER_LEASE_TTL", 15, minimum=1)
+        # seconds a graceful shutdown (SIGTERM or ctrl + c) gets to finish messages already read and stop every thread - keep it under the container's stop timeout
+        self.shutdown_deadline = env.get_float("SHUTDOWN_DEADLINE", 8, minimum=0)
+        self.heartbeat_timeout = env.get_float("HEARTBEAT_TIMEOUT", 120, minimum=1) # seconds a thread can go without a heartbeat before /healthz reports it stuck
+        self.supervisor_restart_base = 1 # backoff before restarting a crashed thread - doubles each time up to supervisor_restart_cap seconds, with jitter
+        self.supervisor_restart_cap = 60
+
+        ### -- CODER PARAMETERS --- ###
+        self.coder_api_url = env.get_str("CODER_API_URL", required=coder_client) # e.g. https://coder.yourdomain.com/api/v2/
+        self.coder_api_key = env.get_str("CODER_API_KEY", required=coder_client)
+        self.coder_email_dom = env.get_str("CODER_EMAIL_DOM", required=daemon) # new users log in as <username>@<this domain>
+        # minutes before a user created by this app is removed - 0 turns automatic removal off
+        self.coder_remove_time = env.get_int("CODER_REMOVE_TIME", required=coder_client, minimum=0)
+        self.coder_check_interval = env.get_int("CODER_CHECK_INTERVAL", required=daemon, minimum=1) # longest wait (in seconds) between checks for expired users
+        self.coder_pool_size = env.get_int("CODER_POOL_SIZE", 10, minimum=1) # keep-alive connections held open to the Coder server
+        self.coder_connect_timeout = env.get_float("CODER_CONNECT_TIMEOUT", 3.05, minimum=0) # seconds
+        self.coder_read_timeout = env.get_float("CODER_READ_TIMEOUT", 10, minimum=0) # seconds
+        self.coder_max_in_flight = env.get_int("CODER_MAX_IN_FLIGHT", 8, minimum=1) # most requests open against the Coder server at once
+        self.coder_cleanup_workers = env.get_int("CODER_CLEANUP_WORKERS", 8, minimum=1) # users moved through removal at the same time
+        self.coder_cleanup_batch = env.get_int("CODER_CLEANUP_BATCH", 500, minimum=1) # most expired users fetched per pass
+        self.coder_remove_poll_interval = env.get_int("CODER_REMOVE_POLL_INTERVAL", 15, minimum=1) # seconds between checks while users are part way through being removed
+        self.coder_backoff_base = .5 # seconds
+        self.coder_backoff_cap = 10 # seconds
+
+        ### -- RESILIENCE PARAMETERS --- ###
+        # per endpoint circuit breakers for the Coder and Twilio apis - this many server failures in a row opens the circuit
+        self.circuit_failure_threshold = env.get_int("CIRCUIT_FAILURE_THRESHOLD", 5, minimum=1)
+        self.circuit_reset_timeout = env.get_float("CIRCUIT_RESET_TIMEOUT", 30, minimum=0) # seconds an open circuit refuses requests before letting a trial request through
+        self.retry_max_wait = 30 # longest Retry-After (in seconds) a thread will wait out - anything longer gives up and the message is retried later
+
+        ### -- TWILIO PARAMETERS --- ###
+        self.twilio_url = "https://api.twilio.com/2010-04-01/Accounts"
+        self.twilio_account_sid = env.get_str("TWILIO_ACCOUNT_SID", required=daemon)
+        self.twilio_auth_sid = env.get_str("TWILIO_AUTH_SID", required=daemon) # credentials used to send sms - can be the same as the account sid and token
+        self.twilio_auth_token = env.get_str("TWILIO_AUTH_TOKEN", required=daemon)
+        self.twilio_from_num = env.get_str("FROM_NUM", required=daemon) # the number sms messages are sent from
+        # the api checks each webhook's signature with the account token, over the webhook url Twilio was given
+        self.twilio_account_token = env.get_str("TWILIO_ACCOUNT_TOKEN", required=role == "api")
+        self.twilio_webhook_url = env.get_str("TWILIO_WEBHOOK_URL", required=role == "api")
+        self.twilio_pool_size = 4 # keep-alive connections held open to Twilio
+        self.twilio_connect_timeout = env.get_float("TWILIO_CONNECT_TIMEOUT", 3.05, minimum=0) # seconds
+        self.twilio_read_timeout = env.get_float("TWILIO_READ_TIMEOUT", 10, minimum=0) # seconds
+        self.twilio_mps = env.get_float("TWILIO_MPS", 1, minimum=.001) # messages per second allowed for the from number (1 for a 10 digit long code)
+        self.twilio_send_attempts = env.get_int("TWILIO_SEND_ATTEMPTS", 4, minimum=1) # total attempts per outbound sms
+        self.twilio_backoff_base = 1.5 # seconds
+        self.twilio_backoff_cap = 30 # seconds
+
+        ### -- REDIS PARAMETERS --- ###
+        self.redis_host = env.get_str("REDIS_HOST")
+        self.redis_port = env.get_int("REDIS_PORT", required=True)
+        self.redis_pw = env.get_str("REDIS_PW")
+        self.redis_db = env.get_int("REDIS_DB", required=True, minimum=0)
+        # connection pool used by the api to publish messages - each gunicorn worker builds its own pool
+        self.redis_pool_max_conns = env.get_int("REDIS_POOL_MAX_CONNS", 10, minimum=1)
+        self.redis_async_pool_max_conns = env.get_int("REDIS_ASYNC_POOL_MAX_CONNS", 50, minimum=1) # connections per worker when the api runs as ASGI (SMS_API_WORKER_CLASS=asgi)
+        self.redis_pool_timeout = env.get_float("REDIS_POOL_TIMEOUT", 2, minimum=0) # seconds to wait for a free connection before giving up
+        self.redis_health_check_interval = env.get_int("REDIS_HEALTH_CHECK_INTERVAL", 30, minimum=0) # seconds a connection can sit idle before it is pinged on checkout
+        self.redis_retry_attempts = 3 # retries after a connection error, so we reconnect transparently if redis restarts
+        self.redis_sms_stream_key = "sms_stream"
+        # approximate cap on the stream's length (XADD MAXLEN ~), so it can't grow without limit while the daemon is down - 0 for no cap.
+        # Trimming drops the oldest messages, so keep this well above SMS_API_SHED_BACKLOG.
+        self.redis_sms_stream_maxlen = env.get_int("REDIS_STREAM_MAXLEN", 100000, minimum=0)
+        self.redis_sms_consum_grp = "sms_consum_grp"
+        self.redis_msg_read_count = env.get_int("REDIS_MSG_READ_COUNT", 3, minimum=1) # max messages fetched per read from the stream
+        self.redis_block_time_ms = env.get_int("REDIS_BLOCK_TIME_MS", 1000, minimum=1) # how long a read waits for new messages
+        self.redis_claim_min_idle_ms = env.get_int("REDIS_CLAIM_MIN_IDLE_MS", 300000, minimum=0) # how long a message can go unacknowledged before another consumer reclaims it
+        self.redis_claim_interval = env.get_int("REDIS_CLAIM_INTERVAL", 30, minimum=1) # seconds between checks for unacknowledged messages
+        self.redis_max_deliveries = env.get_int("REDIS_MAX_DELIVERIES", 5, minimum=1) # deliveries before a message is moved to the dead letter stream
+        self.redis_sms_dead_letter_key = "sms_stream_dead_letter"
+        self.redis_replay_key_prefix = "sms_api_seen:" # MessageSids the api has already published to the stream
+        self.redis_replay_ttl = env.get_int("REDIS_REPLAY_TTL", 600, minimum=1) # seconds a MessageSid is remembered - Twilio's webhook retries happen well within this
+        self.redis_idempotency_key_prefix = "sms_msg_state:" # per MessageSid processing state saved by the sms workers
+        self.redis_idempotency_ttl = env.get_int("REDIS_IDEMPOTENCY_TTL", 86400, minimum=1) # seconds a message's processing state is kept
+        self.redis_idempotency_pw_ttl = env.get_int("REDIS_IDEMPOTENCY_PW_TTL", 1800, minimum=1) # seconds a new user's password is kept for resending the credentials sms - past this it is reset instead
+        self.redis_ack_transaction = env.get_bool("REDIS_ACK_TRANSACTION", False) # wrap the batch ack and delete in MULTI/EXEC
+        self.redis_ack_batch_max = env.get_int("REDIS_ACK_BATCH_MAX", 50, minimum=1) # most processed messages acknowledged per pipeline
+        self.redis_ack_wait_ms = env.get_float("REDIS_ACK_WAIT_MS", 100, minimum=0) # longest a processed message waits for others to join its ack batch
+
+        env.check()
+
+
+class LazyConfig:
+    """
+        The process wide settings. Nothing is read from the environment when this module is imported - the Settings are built and
+        checked the first time a setting is read (or load() is called), so importing a module never fails on a missing setting.
+
+        Reading or setting an attribute, e.g. Config.redis_port, reads or sets it on the Settings.
+    """
+
+    def __init__(self):
+        object.__setattr__(self, "_settings", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def load(self, role: str =None) -> Settings:
+        """
+            Returns the settings, building them from the environment if they haven't been yet. Raises ConfigError if any setting is missing or invalid.
+
+            role: check the settings this process needs as well - see Settings. Entry points call this first, so a process stops with
+            one message listing every missing setting rather than failing on the first one it uses. Settings already built for another
+            role are built again.
+        """
+
+        if self._settings is None or (role is not None and self._settings.role != role):
+            with self._lock:
+                if self._settings is None or (role is not None and self._settings.role != role):
+                    object.__setattr__(self, "_settings", Settings(os.environ, role))
+
+        return self._settings
+
+    def reload(self) -> Settings:
+        """Rebuilds the settings from the current environment, for the same role, e.g. after changing it in a script"""
+
+        with self._lock:
+            object.__setattr__(self, "_settings", Settings(os.environ, self._settings.role if self._settings is not None else None))
+
+        return self._settings
+
+    def __getattr__(self, name: str):
+        return getattr(self.load(), name)
+
+    def __setattr__(self, name: str, value) -> None:
+        setattr(self.load(), name, value)
+
+
+Config = LazyConfig()
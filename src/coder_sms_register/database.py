@@ -0,0 +1,79 @@
+from coder_sms_register.config import Config
+from coder_sms_register.models import metadata_obj, users, remove_states, upgrade_schema
+from sqlalchemy.engine import Engine
+import sqlalchemy as db
+
+# Logging setup
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Queries:
+    """
+        Statements used by the sms and user workers, built once with bind parameters.
+
+        Reusing the same statement objects means SQLAlchemy compiles each one a single time and pulls it from its compiled cache after that.
+    """
+
+    user_by_phone_key = db.select(users.c.username).where(users.c.phone_key == db.bindparam("phone_key"))
+    user_by_username = db.select(users.c.username).where(users.c.username == db.bindparam("username"))
+    legacy_users = db.select(users.c.hash_id, users.c.username).where(users.c.phone_key.is_(None))
+    insert_user = db.insert(users)
+    set_phone_key = db.update(users).where(users.c.hash_id == db.bindparam("b_hash_id")).values(phone_key=db.bindparam("phone_key"))
+    set_remove_state = db.update(users).where(users.c.username == db.bindparam("b_username")).values(remove_state=db.bindparam("remove_state"))
+    delete_user = db.delete(users).where(users.c.username == db.bindparam("username"))
+    # two queries rather than an OR, so each one is a range search on the (remove_state, create_stamp) index
+    in_progress_users = (db.select(users.c.username, users.c.create_stamp, users.c.remove_state)
+                            .where(users.c.remove_state.in_(remove_states))
+                            .order_by(users.c.create_stamp)
+                            .limit(db.bindparam("batch_size")))
+    expired_users = (db.select(users.c.username, users.c.create_stamp, users.c.remove_state)
+                            .where(users.c.create_stamp < db.bindparam("cutoff"), users.c.remove_state.is_(None))
+                            .order_by(users.c.create_stamp)
+                            .limit(db.bindparam("batch_size")))
+    next_create_stamp = db.select(db.func.min(users.c.create_stamp)).where(users.c.create_stamp >= db.bindparam("cutoff"))
+
+
+class Database:
+    """A class that owns creating the database engine shared by every thread"""
+
+    @staticmethod
+    def create_engine(db_url: str =None) -> Engine:
+        """
+            A static method that creates the engine for db_url (defaults to CODER_REG_DB_URL, then the SQLite file in the etc directory).
+
+            SQLite connections are switched to WAL mode with synchronous=NORMAL, so readers don't block the writer, and get a busy timeout so
+            threads wait for a lock instead of failing. Any other url (e.g. postgresql://) gets a pre-pinged connection pool.
+        """
+
+        db_url = db_url or Config.db_url
+        url = db.engine.make_url(db_url)
+
+        if url.get_backend_name() == "sqlite":
+            # SQLAlchemy 2.0 pools file databases with a QueuePool, so it takes the pool settings - 1.4 used a NullPool there and rejects them
+            engine = db.create_engine(url, pool_size=Config.db_pool_size, max_overflow=Config.db_pool_overflow, connect_args={"check_same_thread": False, "timeout": Config.db_busy_timeout_ms / 1000})
+            db.event.listen(engine, "connect", Database._set_sqlite_pragmas)
+        else:
+            engine = db.create_engine(url, pool_size=Config.db_pool_size, max_overflow=Config.db_pool_overflow, pool_pre_ping=True)
+
+        logger.info(f"created database engine for {url.render_as_string(hide_password=True)}")
+        return engine
+
+    @staticmethod
+    def init_db(db_url: str =None) -> Engine:
+        """A static method that creates the engine, creates the tables if they don't already exist, and brings older databases up to date"""
+
+        engine = Database.create_engine(db_url)
+        metadata_obj.create_all(engine)
+        upgrade_schema(engine)
+
+        return engine
+
+    @staticmethod
+    def _set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(Config.db_busy_timeout_ms)}")
+        cursor.execute(f"PRAGMA mmap_size={int(Config.db_mmap_size)}")
+        cursor.close()
@@ -1,20 +1,20 @@
-from coder_sms_register.config import Config
-from coder_sms_register.models import metadata_obj
-from coder_sms_register.sms_listener import SMSListener
-from coder_sms_register.sms_worker import SMSWorker
-from coder_sms_register.user_worker import UserWorker
-import sqlalchemy as db
-from threading import Thread
-from queue import Queue
-from time import sleep
-import redis
+from coder_sms_register.config import Config, ConfigError
+from coder_sms_register.user_store import UserStore
+from coder_sms_register.idempotency import IdempotencyStore
+from coder_sms_register.sms_listener import SMSListener, StreamAcker
+from coder_sms_register.sms_queue import ShardedQueue
+from coder_sms_register.metrics import registry
+from coder_sms_register.logs import setup_logging
+from coder_sms_register.leader import LeaderLease
+from coder_sms_register.supervisor import Supervisor
+import redis, argparse
+
+# the sms worker, Twilio and Coder modules (bcrypt, requests, randomname) are imported by the functions that start their threads,
+# so each runtime mode and the cleanup command only load what they use
 
 # Logging setup
 import logging
 logger = logging.getLogger(__name__)
-logger.setLevel(Config.log_level)
-logger.addHandler(Config.file_handler)
-logger.addHandler(Config.stout_handler)
 
 
 
@@ -22,49 +22,201 @@ logger.addHandler(Config.stout_handler)
 def main():
     """The main entrypoint function for coder sms register"""
 
+    # read and check every setting before anything else, so a bad environment stops the daemon with one message listing every problem
+    if not load_config("daemon"):
+        return None
+
+    setup_logging()
+
     print("#########################################")
     print("###### STARTING CODER SMS REGISTER ######")
     print("#########################################\n\n")
 
-    # create the database if it doesn't already exist
-    engine = db.create_engine('sqlite:///' + Config.db_path)
-    metadata_obj.create_all(engine)
+    # redis connection shared by the listener threads, and the user store when CODER_REG_STORE=redis
+    redis_conn = redis.Redis(host=Config.redis_host, port=Config.redis_port, db=Config.redis_db, password=Config.redis_pw, decode_responses=True)
+
+    # the supervisor runs the daemon's threads, restarts any that crash, and stops them in order on SIGTERM or ctrl + c
+    supervisor = Supervisor()
+    supervisor.add_ready_check("redis", redis_conn.ping)
+
+    # serve the metrics registry to Prometheus, and liveness / readiness checks, from a daemon thread
+    if Config.metrics_port:
+        registry.route("/healthz", supervisor.healthz)
+        registry.route("/readyz", supervisor.readyz)
+        registry.start_http_server(Config.metrics_port)
+        logger.info(f"serving metrics and health checks on port {Config.metrics_port}")
+    registry.gauge("sms_stream_pending", "messages delivered to the consumer group but not acknowledged yet", lambda: SMSListener.stream_stats(redis_conn, Config.redis_sms_stream_key, Config.redis_sms_consum_grp)["pending"])
+    registry.gauge("sms_stream_lag", "messages in the stream not delivered to the consumer group yet", lambda: SMSListener.stream_stats(redis_conn, Config.redis_sms_stream_key, Config.redis_sms_consum_grp)["lag"])
+
+    # with the sql store this creates the database if it doesn't already exist and brings older databases up to date
+    user_store = UserStore.create(redis_conn)
 
-    # create the queues that the threads will share
-    inbound_sms_q = Queue()
-    kill_q = Queue()
+    logger.info(f"reading from consumer group {Config.redis_sms_consum_grp} as consumer {Config.consumer_name}")
+
+    supervisor.install_signal_handlers()
+    if Config.runtime == "asyncio":
+        inbound_sms_q = None
+        start_asyncio(redis_conn, user_store, supervisor)
+    else:
+        inbound_sms_q = start_threads(redis_conn, user_store, supervisor)
+
+    # wait for SIGTERM (docker stop) or ctrl + c
+    while not supervisor.stopping.wait(5):
+        if inbound_sms_q is not None:
+            logger.debug(f"coder sms register is running - inbound sms queue depth by worker: {inbound_sms_q.depths()}")
+
+    logger.warning("shutting down coder sms register")
+    supervisor.shutdown(Config.shutdown_deadline)
+
+
+def load_config(role: str) -> bool:
+    """
+        Reads and checks every setting from the environment, including the ones this role (see Settings) requires. Returns False, after
+        logging what is wrong, if any setting is missing or invalid.
+    """
+
+    try:
+        Config.load(role)
+    except ConfigError as e:
+        logger.error("cannot start coder sms register - fix these settings")
+        logger.error(e)
+        return False
+
+    return True
+
+
+def start_threads(redis_conn: redis.Redis, user_store: UserStore, supervisor: Supervisor) -> ShardedQueue:
+    """
+        Adds the listener, reclaimer, sms worker, sms sender, user cleanup and username pool threads to the supervisor and starts them.
+
+        On shutdown the listener and reclaimer stop first, then the sms workers once they have emptied the inbound sms queue, then the
+        sms sender once it has sent the replies they queued, and last the acker once it has acknowledged every processed message.
+
+        Returns the inbound sms queue.
+    """
+
+    from coder_sms_register.sms_worker import SMSWorker
+    from coder_sms_register.twilio import TwilioSender, TwilioSendQueue
+    from coder_sms_register.coder import Coder
+
+    # create the queues that the threads will share - inbound messages are split into one shard per sms worker by phone number
+    inbound_sms_q = ShardedQueue(Config.sms_worker_count)
+    registry.gauge("sms_inbound_queue_depth", "inbound sms messages waiting to be processed", inbound_sms_q.qsize)
   
     # redis listener thread - listens for messages posted to the redis stream by the API
-    # create the redis connection object
-    redis_conn = redis.Redis(host=Config.redis_host, port=Config.redis_port, db=Config.redis_db, password=Config.redis_pw, decode_responses=True)
-    # create the sms listener thread
-    sms_listener_thread = Thread(target=SMSListener.get_message, args=[redis_conn, Config.redis_sms_stream_key, Config.redis_sms_consum_grp, "sms-listener-01", Config.redis_msg_read_count, Config.redis_block_time_ms, inbound_sms_q, kill_q])
+    supervisor.add("sms-listener", SMSListener.get_message, [redis_conn, Config.redis_sms_stream_key, Config.redis_sms_consum_grp, Config.consumer_name, Config.redis_msg_read_count, Config.redis_block_time_ms, inbound_sms_q])
     
-    # thread to process incoming sms messages
-    sms_proc_thread = Thread(target=SMSWorker.sms_worker, args=[kill_q, inbound_sms_q, engine])
+    # thread to reclaim messages that were delivered but never acknowledged (crashed consumer or failed processing) - paused while the
+    # Coder users circuit is open, since the sms workers park messages in the pending entries list until it closes
+    supervisor.add("sms-reclaimer", SMSListener.reclaim_messages, [redis_conn, Config.redis_sms_stream_key, Config.redis_sms_consum_grp, Config.consumer_name, Config.redis_claim_min_idle_ms, Config.redis_max_deliveries, Config.redis_sms_dead_letter_key, Config.redis_claim_interval, inbound_sms_q], {"is_paused": Coder.breaker("users").is_open})
 
-    # thread to remove users and workspaces from the coder server
-    user_cleanup = Thread(target=UserWorker.user_worker, args=[kill_q, engine])
+    # thread to acknowledge processed messages in the redis stream in batches - stops after the sms workers and sender, which feed it.
+    # Messages waiting on their credentials sms are touched well within the reclaimer's min idle time, so they are never reclaimed while queued
+    acker = StreamAcker(redis_conn, Config.redis_sms_stream_key, Config.redis_sms_consum_grp, Config.redis_ack_batch_max, Config.redis_ack_wait_ms,
+                        Config.consumer_name, Config.redis_claim_min_idle_ms / 3)
+    supervisor.add("sms-acker", acker.run, stage=3, drained=acker.qsize)
 
-    # start the threads
-    sms_listener_thread.start()
-    sms_proc_thread.start()
-    user_cleanup.start()
+    # thread to send reply sms messages, rate limited to what Twilio allows for our from number
+    twilio_send_q = TwilioSendQueue(TwilioSender(), Config.twilio_mps, Config.twilio_send_attempts)
+    registry.gauge("twilio_send_queue_depth", "outbound sms messages waiting to be sent", twilio_send_q.qsize)
+    supervisor.add("sms-sender", twilio_send_q.run, stage=2, drained=twilio_send_q.due)
 
-    # look for a keyboard interrupt (ctlr + c), so the app can be exited manually
-    try:
-        while True:
-            sleep(5)
-            logger.debug("coder sms register is running")
-    except KeyboardInterrupt:
-        for i in range (0,10):
-            kill_q.put("kill")
-        logger.warning("shutting down coder sms register")
-    
-    # collect all the threads before shutting down completely
-    sms_listener_thread.join()
-    sms_proc_thread.join()
-    user_cleanup.join()
+    # threads to process incoming sms messages, one per queue shard - acknowledges messages in the redis stream once they are processed
+    # and saves each message's progress, so a redelivered message carries on where it stopped
+    idempotency_store = IdempotencyStore(redis_conn)
+    for i in range(0, Config.sms_worker_count):
+        supervisor.add(f"sms-worker-{i:02d}", SMSWorker.sms_worker, [inbound_sms_q.shard(i), user_store, acker, twilio_send_q, idempotency_store], stage=1, drained=inbound_sms_q.shard(i).qsize)
+
+    # thread to remove users and workspaces from the coder server - only runs on the replica holding the leader lease
+    add_user_cleanup(redis_conn, user_store, supervisor)
+    add_username_pool(user_store, supervisor)
+
+    supervisor.start()
+
+    return inbound_sms_q
+
+
+def add_user_cleanup(redis_conn: redis.Redis, user_store: UserStore, supervisor: Supervisor) -> None:
+    """
+        Adds the leader lease thread, and the user cleanup thread that only removes users while this replica holds the lease, to the supervisor,
+        unless automatic removal is turned off (CODER_REMOVE_TIME=0).
+    """
+
+    if Config.coder_remove_time < 1:
+        logger.info("CODER_REMOVE_TIME is 0 - users are not removed automatically")
+        return None
+
+    from coder_sms_register.user_worker import UserWorker
+    from coder_sms_register.coder import Coder
+
+    lease = LeaderLease(redis_conn, Config.leader_lease_key, Config.consumer_name, Config.leader_lease_ttl)
+    registry.gauge("user_cleanup_leader", "1 if this replica holds the leader lease and runs user cleanup, otherwise 0", lambda: int(lease.token is not None))
+
+    supervisor.add("leader-lease", lease.run)
+    # a pass over a big batch of expired users can take a while, so only check the thread is alive
+    supervisor.add("user-cleanup", UserWorker.user_worker, [user_store], {"lease": lease}, heartbeat_timeout=None)
+    # workspace deletes that haven't started when shutdown begins are cancelled, so they don't hold the process open past the deadline
+    supervisor.add_shutdown_hook(Coder.shutdown_executor)
+
+
+def add_username_pool(user_store: UserStore, supervisor: Supervisor) -> None:
+    """Adds the thread that keeps a pool of free usernames ready for Coder.gen_credentials to the supervisor, unless the pool is turned off (CODER_REG_NAME_POOL_SIZE=0)"""
+
+    if Config.username_pool_size < 1:
+        return None
+
+    from coder_sms_register.username_pool import UsernamePool
+    from coder_sms_register.coder import Coder
+
+    Coder.username_pool = UsernamePool(user_store, Config.username_pool_size)
+    registry.gauge("username_pool_depth", "free usernames ready for new users", Coder.username_pool.depth)
+
+    supervisor.add("username-pool", Coder.username_pool.run)
+
+
+def start_asyncio(redis_conn: redis.Redis, user_store: UserStore, supervisor: Supervisor) -> None:
+    """Starts the sms listener and workers on an asyncio event loop in a supervised thread, with user cleanup still on its own thread"""
+
+    # imported here so the optional async dependencies are only needed in asyncio mode
+    from coder_sms_register.async_engine import AsyncEngine
+
+    logger.info("starting in asyncio runtime mode")
+
+    # the engine drains its own in flight messages once stop is set
+    supervisor.add("async-engine", AsyncEngine.run, [user_store, Config.consumer_name])
+    add_user_cleanup(redis_conn, user_store, supervisor)
+    add_username_pool(user_store, supervisor)
+
+    supervisor.start()
+
+
+def cleanup():
+    """Entrypoint for cleanup-coder-sms-users - removes a batch of expired users right away and reports throughput"""
+
+    parser = argparse.ArgumentParser(description="remove expired users and their workspaces from the Coder server")
+    parser.add_argument("--limit", type=int, default=100, help="most users to remove")
+    parser.add_argument("--timeout", type=int, default=1800, help="seconds to keep waiting on workspace deletes before giving up")
+    args = parser.parse_args()
+
+    if not load_config("cleanup"):
+        return None
+
+    # with a remove time of 0 every user would count as expired
+    if Config.coder_remove_time < 1:
+        logger.error("CODER_REMOVE_TIME is 0 - automatic removal is turned off, so there are no expired users to clean up")
+        return None
+
+    from coder_sms_register.user_worker import UserWorker
+
+    setup_logging()
+    user_store = UserStore.create()
+
+    summary = UserWorker.cleanup_users(user_store, args.limit, args.timeout)
+    if summary is None:
+        logger.error("cleanup failed - could not fetch users from the user store")
+        return None
+
+    print(f"removed {summary['removed']} of {summary['users']} users in {summary['seconds']} seconds ({summary['users_per_second']} users/second)")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,80 @@
+from coder_sms_register.config import Config
+import redis
+
+# Logging setup
+import logging
+logger = logging.getLogger(__name__)
+
+# the steps an inbound sms goes through, in order - "ignored" is for messages that needed nothing done (existing user, wrong pass phrase).
+# sms_queued is saved with the stream id of the delivery whose send queue holds the credentials sms
+message_states = ("received", "user_created", "sms_queued", "sms_sent", "ignored")
+
+
+class IdempotencyStore:
+    """
+        Remembers how far each inbound sms (keyed by Twilio's MessageSid) got through processing, in a redis hash that expires after ttl seconds.
+
+        A redelivered or retried message can then pick up where it stopped - e.g. a message whose Coder user was created, but whose
+        sms never went out, only needs the sms sent. From user_created until sms_sent the new user's temporary password is kept so
+        the sms can be resent - in its own key that expires after pw_ttl seconds, well before the rest of the state. It is removed
+        as soon as the sms is sent.
+
+        Every method fails open: if redis can't be reached the message is processed as if it had never been seen.
+    """
+
+    def __init__(self, redis_conn: redis.Redis, key_prefix: str =None, ttl: int =None, pw_ttl: int =None):
+        self.redis_conn = redis_conn
+        self.key_prefix = key_prefix or Config.redis_idempotency_key_prefix
+        self.ttl = ttl or Config.redis_idempotency_ttl
+        self.pw_ttl = pw_ttl or Config.redis_idempotency_pw_ttl
+
+    def get(self, message_sid: str) -> dict:
+        """
+            Returns the saved state for the message, e.g. {"state": "user_created", "username": ..., "pw": ...}, or None if there isn't one.
+
+            pw is left out once it has expired.
+        """
+
+        if not message_sid:
+            return None
+
+        try:
+            pipe = self.redis_conn.pipeline(transaction=False)
+            pipe.hgetall(self.key_prefix + message_sid)
+            pipe.get(self.key_prefix + message_sid + ":pw")
+            saved_state, pw = pipe.execute()
+            if saved_state and pw:
+                saved_state["pw"] = pw
+            return saved_state or None
+        except Exception as e:
+            logger.error(f"problem fetching the state of message {message_sid}")
+            logger.error(e)
+            return None
+
+    def set_state(self, message_sid: str, state: str, **fields) -> bool:
+        """Saves the message's new state, along with any extra fields, and restarts the ttl. A pw field is kept for pw_ttl seconds only."""
+
+        if not message_sid:
+            return False
+
+        if state not in message_states:
+            raise Exception(f"invalid message state provided: {state}")
+
+        pw = fields.pop("pw", None)
+        try:
+            pipe = self.redis_conn.pipeline(transaction=True)
+            pipe.hset(self.key_prefix + message_sid, mapping={"state": state, **fields})
+            pipe.expire(self.key_prefix + message_sid, self.ttl)
+            if pw:
+                pipe.set(self.key_prefix + message_sid + ":pw", pw, ex=self.pw_ttl)
+            # the password is only needed until the sms goes out
+            if state in ("sms_sent", "ignored"):
+                pipe.delete(self.key_prefix + message_sid + ":pw")
+            pipe.execute()
+
+        except Exception as e:
+            logger.error(f"problem saving state {state} for message {message_sid}")
+            logger.error(e)
+            return False
+
+        return True
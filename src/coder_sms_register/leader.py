@@ -0,0 +1,152 @@
+from coder_sms_register.metrics import registry
+from coder_sms_register.supervisor import beat
+from time import monotonic
+import redis, threading
+
+# Logging setup
+import logging
+logger = logging.getLogger(__name__)
+
+leases_acquired = registry.counter("leader_lease_acquired_total", "times this process became the leader")
+leases_lost = registry.counter("leader_lease_lost_total", "times this process stopped being the leader without giving the lease up")
+
+
+class LeaderLease:
+    """
+        A lease lock in redis that makes one coder sms register process (across every replica) the leader, e.g. for user cleanup.
+
+        The lease key holds "<holder id>:<fencing token>" and expires ttl seconds after it was last renewed. The leader renews it every
+        ttl / 3 seconds. Every other process tries to take it every second, so a new leader takes over within a lease period of the
+        old one dying.
+
+        Each time the lease is taken, the fencing token goes up by one. is_leader() checks the token hasn't been superseded, so a
+        process that was paused past its lease (GC, stalled VM) finds out before its next step rather than acting alongside the new leader.
+    """
+
+    # SET NX the lease with a fresh fencing token. Returns the token, or nil if someone else holds the lease.
+    _acquire_script = """
+        if redis.call('EXISTS', KEYS[1]) == 1 then
+            return nil
+        end
+        local token = redis.call('INCR', KEYS[2])
+        redis.call('SET', KEYS[1], ARGV[1] .. ':' .. token, 'PX', ARGV[2])
+        return token
+    """
+
+    # extend the lease only if we still hold it with this token. Returns 1 if renewed, 0 if not.
+    _renew_script = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+        end
+        return 0
+    """
+
+    # give the lease up only if we still hold it
+    _release_script = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('DEL', KEYS[1])
+        end
+        return 0
+    """
+
+    def __init__(self, redis_conn: redis.Redis, lease_key: str, holder_id: str, ttl: float):
+        self.redis_conn = redis_conn
+        self.lease_key = lease_key
+        self.fence_key = lease_key + ":fence"
+        self.holder_id = holder_id
+        self.ttl = ttl
+        self.token = None
+        self.renewed_at = 0.0
+        self.lock = threading.Lock()
+
+        self._acquire = redis_conn.register_script(LeaderLease._acquire_script)
+        self._renew = redis_conn.register_script(LeaderLease._renew_script)
+        self._release = redis_conn.register_script(LeaderLease._release_script)
+
+    @property
+    def lease_value(self) -> str:
+        return f"{self.holder_id}:{self.token}"
+
+    def is_leader(self) -> bool:
+        """
+            Returns True if this process holds the lease - it was renewed less than a lease period ago, and no one has taken it since.
+
+            Call it before each step that only the leader should take.
+        """
+
+        with self.lock:
+            if self.token is None or monotonic() - self.renewed_at >= self.ttl:
+                return False
+            token = self.token
+
+        try:
+            return int(self.redis_conn.get(self.fence_key) or 0) == token
+        except Exception as e:
+            logger.error("problem checking the leader lease fencing token")
+            logger.error(e)
+            return False
+
+    def try_acquire(self) -> bool:
+        """Takes the lease if no one holds it. Returns True if this process is now the leader."""
+
+        token = self._acquire(keys=[self.lease_key, self.fence_key], args=[self.holder_id, int(self.ttl * 1000)])
+        if token is None:
+            return False
+
+        with self.lock:
+            self.token = int(token)
+            self.renewed_at = monotonic()
+
+        logger.info(f"{self.holder_id} is now the leader (fencing token {self.token})")
+        leases_acquired.inc()
+        return True
+
+    def renew(self) -> bool:
+        """Extends the lease. Returns False, and stops being the leader, if the lease was lost (it expired and someone else took it)."""
+
+        if self._renew(keys=[self.lease_key], args=[self.lease_value, int(self.ttl * 1000)]):
+            with self.lock:
+                self.renewed_at = monotonic()
+            return True
+
+        logger.error(f"{self.holder_id} lost the leader lease (fencing token {self.token})")
+        leases_lost.inc()
+        with self.lock:
+            self.token = None
+        return False
+
+    def release(self) -> None:
+        """Gives the lease up, so another process can take over straight away instead of waiting for it to expire"""
+
+        if self.token is None:
+            return None
+
+        try:
+            self._release(keys=[self.lease_key], args=[self.lease_value])
+            logger.info(f"{self.holder_id} released the leader lease")
+        except Exception as e:
+            logger.error("problem releasing the leader lease")
+            logger.error(e)
+
+        with self.lock:
+            self.token = None
+
+    def run(self, stop: threading.Event) -> None:
+        """A method that keeps trying to take the lease, and renews it while it is held, until stop is set. Meant to be the target of its own thread."""
+
+        while not stop.is_set():
+            beat()
+            try:
+                if self.token is None:
+                    self.try_acquire()
+                else:
+                    self.renew()
+
+            except Exception as e:
+                logger.error("problem taking or renewing the leader lease")
+                logger.error(e)
+
+            # renew well inside the lease period - followers check every second so they take over quickly
+            stop.wait(self.ttl / 3 if self.token is not None else 1)
+
+        self.release()
@@ -0,0 +1,124 @@
+from coder_sms_register.config import Config
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from datetime import datetime, timezone
+import logging, json, os, queue, random, sys, atexit, threading
+
+# every module logs through a child of this logger, e.g. logging.getLogger("coder_sms_register.sms_worker")
+package_logger = logging.getLogger("coder_sms_register")
+
+_listener = None
+_role = None
+_setup_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as a single line of JSON, for log shippers that index fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        log_line = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "thread": record.threadName,
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            log_line["exc_info"] = self.formatException(record.exc_info)
+
+        return json.dumps(log_line)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps roughly sample_rate of the debug and info records, and every warning or worse"""
+
+    def __init__(self, sample_rate: float):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.sample_rate >= 1:
+            return True
+
+        return random.random() < self.sample_rate
+
+
+def log_file_path(role: str) -> str:
+    """
+        Returns the log file for this process, or None if it only logs to stdout. The daemon owns coder-sms-register.log. The sms api
+        runs as several gunicorn workers that come and go - a file per worker would pile up, and a shared file would be rotated by
+        several processes at once - so it logs to stdout only, where gunicorn and the container runtime collect it.
+    """
+
+    if role == "daemon":
+        return Config.log_path
+
+    return None
+
+
+def setup_logging(role: str ="daemon") -> None:
+    """
+        Routes every coder_sms_register logger through a queue, so the calling thread only pays for putting the record on the queue.
+        A QueueListener thread formats the records and writes them to stdout, and to the log file for roles that have one.
+
+        Safe to call more than once - the handlers are replaced, not added to. A forked child (e.g. gunicorn --preload) sets up its own
+        queue and listener thread automatically, since threads don't survive a fork.
+    """
+
+    global _listener, _role
+
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+
+        log_format = JsonFormatter() if Config.log_json else Config.log_format
+
+        handlers = [logging.StreamHandler(sys.stdout)]
+        if log_file_path(role) is not None:
+            handlers.append(RotatingFileHandler(log_file_path(role), maxBytes=Config.log_maxbytes, backupCount=Config.log_backup_count))
+        for handler in handlers:
+            handler.setLevel(Config.log_level)
+            handler.setFormatter(log_format)
+
+        log_q = queue.Queue()
+        queue_handler = QueueHandler(log_q)
+        # sample before the record is queued, so dropped records cost next to nothing
+        queue_handler.addFilter(SamplingFilter(Config.log_sample_rate))
+
+        package_logger.handlers.clear()
+        package_logger.addHandler(queue_handler)
+        package_logger.setLevel(Config.log_level)
+        package_logger.propagate = False
+
+        _listener = QueueListener(log_q, *handlers, respect_handler_level=True)
+        _listener.start()
+        _role = role
+
+
+def stop_logging() -> None:
+    """Writes out anything still on the queue and stops the listener thread"""
+
+    global _listener
+
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+            _listener = None
+
+
+def _setup_logging_after_fork() -> None:
+    global _listener, _setup_lock
+
+    # the parent's listener thread didn't come with us - drop it without joining and start fresh. The lock may have been held by a parent thread.
+    _setup_lock = threading.Lock()
+    if _role is not None:
+        _listener = None
+        setup_logging(_role)
+
+
+os.register_at_fork(after_in_child=_setup_logging_after_fork)
+atexit.register(stop_logging)
@@ -0,0 +1,291 @@
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+# content type for the Prometheus text exposition format
+exposition_content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+
+    escaped = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        escaped.append(f'{name}="{value}"')
+
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if value == float("-inf"):
+        return "-Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """A thread safe histogram with fixed buckets, used to track latencies in seconds"""
+
+    default_buckets = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, description: str, buckets: tuple[float] =default_buckets, labelnames: tuple[str] =()):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        # one extra slot for observations larger than the biggest bucket (+Inf)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._children = {}
+
+    def labels(self, **labels) -> "Histogram":
+        """Returns the histogram for one combination of label values, e.g. latency.labels(endpoint="users", status=201).observe(.2)"""
+
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            if key not in self._children:
+                self._children[key] = Histogram(self.name, self.description, self.buckets)
+            return self._children[key]
+
+    def observe(self, value: float) -> None:
+        """Record a single observation"""
+
+        with self._lock:
+            self._counts[bisect_left(self.buckets, value)] += 1
+            self._sum += value
+            self._count += 1
+
+    @contextmanager
+    def time(self):
+        """Context manager that observes how long the wrapped block took to run"""
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start)
+
+    def quantile(self, q: float) -> float:
+        """
+            Estimate a quantile (0 < q <= 1) from the buckets.
+
+            Returns the upper bound of the bucket the quantile falls in, or None if nothing has been observed yet.
+            Observations bigger than the largest bucket report as float("inf").
+        """
+
+        with self._lock:
+            counts = list(self._counts)
+            total = self._count
+
+        if total == 0:
+            return None
+
+        rank = q * total
+        running_count = 0
+        for i, count in enumerate(counts):
+            running_count += count
+            if running_count >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+
+        return float("inf")
+
+    def snapshot(self) -> dict:
+        """Returns the cumulative bucket counts along with the sum and count of all observations"""
+
+        with self._lock:
+            counts = list(self._counts)
+            obs_sum = self._sum
+            obs_count = self._count
+
+        cumulative = []
+        running_count = 0
+        for upper_bound, count in zip(self.buckets + (float("inf"),), counts):
+            running_count += count
+            cumulative.append((upper_bound, running_count))
+
+        return {"buckets": cumulative, "sum": obs_sum, "count": obs_count}
+
+    def exposition(self) -> list[str]:
+        """Returns the Prometheus text lines for this histogram, one set of series per label combination"""
+
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+
+        if self.labelnames:
+            with self._lock:
+                children = [(dict(zip(self.labelnames, key)), child) for key, child in self._children.items()]
+        else:
+            children = [({}, self)]
+
+        for labels, child in children:
+            snapshot = child.snapshot()
+            for upper_bound, count in snapshot["buckets"]:
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': _format_value(upper_bound)})} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(snapshot['sum'])}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {snapshot['count']}")
+
+        return lines
+
+
+class Counter:
+    """A thread safe counter that only goes up, e.g. the number of retries, optionally split by label values"""
+
+    def __init__(self, name: str, description: str, labelnames: tuple[str] =()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount: float =1, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def exposition(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+
+        with self._lock:
+            values = list(self._values.items())
+
+        # an unlabelled counter reports 0 before its first increment
+        if not values and not self.labelnames:
+            values = [((), 0)]
+
+        for key, value in values:
+            lines.append(f"{self.name}{_format_labels(dict(zip(self.labelnames, key)))} {_format_value(value)}")
+
+        return lines
+
+
+class Gauge:
+    """A gauge that reads its current value from a callback when it is collected, e.g. a queue depth, or holds the last value set"""
+
+    def __init__(self, name: str, description: str, value_func =None):
+        self.name = name
+        self.description = description
+        self._value_func = value_func
+        self._value = 0
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def value(self) -> float:
+        if self._value_func is None:
+            return self._value
+
+        return self._value_func()
+
+    def exposition(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+
+        # a callback that can't be read right now (e.g. redis is down) is left out of the scrape rather than failing it
+        try:
+            value = self.value()
+        except Exception:
+            return lines
+
+        if value is not None:
+            lines.append(f"{self.name} {_format_value(value)}")
+
+        return lines
+
+
+class MetricsRegistry:
+    """A process wide collection of metrics, so each module can look up the same metric by name"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        # extra paths served by start_http_server, e.g. health checks - path -> function returning (status, content type, body)
+        self._routes = {}
+
+    def histogram(self, name: str, description: str, buckets: tuple[float] =Histogram.default_buckets, labelnames: tuple[str] =()) -> Histogram:
+        """Returns the histogram registered under name, creating it if it doesn't exist yet"""
+
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Histogram(name, description, buckets, labelnames)
+            return self._metrics[name]
+
+    def counter(self, name: str, description: str, labelnames: tuple[str] =()) -> Counter:
+        """Returns the counter registered under name, creating it if it doesn't exist yet"""
+
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Counter(name, description, labelnames)
+            return self._metrics[name]
+
+    def gauge(self, name: str, description: str, value_func =None) -> Gauge:
+        """Registers a gauge under name, replacing any gauge already registered with that name"""
+
+        with self._lock:
+            self._metrics[name] = Gauge(name, description, value_func)
+            return self._metrics[name]
+
+    def metrics(self) -> list:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def exposition(self) -> str:
+        """Returns every metric in the Prometheus text exposition format"""
+
+        lines = []
+        for metric in sorted(self.metrics(), key=lambda metric: metric.name):
+            lines.extend(metric.exposition())
+
+        return "\n".join(lines) + "\n"
+
+    def route(self, path: str, handler) -> None:
+        """Serves handler's response at path alongside /metrics. handler takes no arguments and returns (status, content type, body)."""
+
+        with self._lock:
+            self._routes[path] = handler
+
+    def start_http_server(self, port: int, addr: str ="0.0.0.0") -> ThreadingHTTPServer:
+        """Serves the exposition at /metrics, and any routes added with route(), on its own port from a daemon thread, for processes that don't already run a web server"""
+
+        metrics_registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                if path == "/metrics":
+                    status, content_type, body = 200, exposition_content_type, metrics_registry.exposition()
+                elif path in metrics_registry._routes:
+                    status, content_type, body = metrics_registry._routes[path]()
+                else:
+                    self.send_error(404)
+                    return
+
+                body = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # keep scrapes out of stderr
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((addr, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+
+        return server
+
+
+registry = MetricsRegistry()
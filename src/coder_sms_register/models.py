@@ -1,11 +1,81 @@
 import sqlalchemy as db
+from datetime import datetime
+from zoneinfo import ZoneInfo
 
 metadata_obj = db.MetaData()
 
+# legacy string create stamps were written with datetime.now() inside the container, whose clock the Dockerfile sets to this zone (TZ)
+legacy_stamp_tz = "America/Chicago"
+
+# the steps a user goes through while being removed from Coder, in order
+remove_states = ("expired", "workspaces_deleting", "user_deleting", "done")
+
 users = db.Table(
         'users',
         metadata_obj,
         db.Column('hash_id', db.String, primary_key=True),
         db.Column('username', db.String, nullable=False),
-        db.Column('create_stamp', db.String, nullable=False),
-)
\ No newline at end of file
+        # unix epoch seconds - indexed so the user worker can fetch only expired users
+        db.Column('create_stamp', db.Integer, nullable=False),
+        # keyed HMAC of the normalized phone number - lets us find a user with a single indexed lookup instead of a bcrypt check per row
+        db.Column('phone_key', db.String, nullable=True),
+        # where the user is in being removed from Coder - None until the user expires, then expired -> workspaces_deleting -> user_deleting -> done
+        db.Column('remove_state', db.String, nullable=True),
+        db.Index('ix_users_phone_key', 'phone_key', unique=True),
+        db.Index('ix_users_create_stamp', 'create_stamp'),
+        db.Index('ix_users_remove_state_create_stamp', 'remove_state', 'create_stamp'),
+        # lets the username pool check a candidate name is free with one indexed lookup
+        db.Index('ix_users_username', 'username'),
+)
+
+
+def upgrade_schema(engine: db.engine.Engine, stamp_tz: str =legacy_stamp_tz) -> None:
+    """
+        Bring an existing database up to date with the table definitions above. Safe to call on every start up.
+
+        stamp_tz: the time zone legacy string create stamps were written in.
+    """
+
+    inspector = db.inspect(engine)
+    existing_cols = {col["name"]: col for col in inspector.get_columns("users")}
+    existing_indexes = [index["name"] for index in inspector.get_indexes("users")]
+
+    with engine.begin() as connection:
+        # databases created before the phone_key column existed - rows are filled in lazily the first time the phone number texts us again
+        if "phone_key" not in existing_cols:
+            connection.execute(db.text("ALTER TABLE users ADD COLUMN phone_key VARCHAR"))
+
+        if "remove_state" not in existing_cols:
+            connection.execute(db.text("ALTER TABLE users ADD COLUMN remove_state VARCHAR"))
+
+        # databases created when create_stamp was a "%Y-%m-%d %H:%M:%S" string
+        if not isinstance(existing_cols["create_stamp"]["type"], db.Integer):
+            _convert_create_stamp(connection, existing_indexes, stamp_tz)
+
+        for index in users.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def _convert_create_stamp(connection: db.engine.Connection, existing_indexes: list[str], stamp_tz: str) -> None:
+    """
+        Rebuild the users table with create_stamp as an integer epoch. SQLite can't change a column's type in place.
+
+        The legacy stamps have no offset, so they are read as wall clock time in stamp_tz - not the local time of whatever machine runs the upgrade.
+    """
+
+    # the indexes follow the table when it is renamed, so drop them to free up their names
+    for index_name in existing_indexes:
+        connection.execute(db.text(f"DROP INDEX IF EXISTS {index_name}"))
+
+    connection.execute(db.text("ALTER TABLE users RENAME TO users_legacy"))
+    users.create(connection)
+
+    legacy_rows = connection.execute(db.text("SELECT hash_id, username, create_stamp, phone_key, remove_state FROM users_legacy")).fetchall()
+    if legacy_rows:
+        tz = ZoneInfo(stamp_tz)
+        connection.execute(db.insert(users), [
+            {"hash_id": row[0], "username": row[1], "create_stamp": int(datetime.strptime(row[2], "%Y-%m-%d %H:%M:%S").replace(tzinfo=tz).timestamp()), "phone_key": row[3], "remove_state": row[4]}
+            for row in legacy_rows
+        ])
+
+    connection.execute(db.text("DROP TABLE users_legacy"))
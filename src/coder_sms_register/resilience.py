@@ -0,0 +1,181 @@
+from coder_sms_register.config import Config
+from coder_sms_register.metrics import registry
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from time import monotonic
+import threading, random
+
+# Logging setup
+import logging
+logger = logging.getLogger(__name__)
+
+circuit_transitions = registry.counter("circuit_breaker_transitions_total", "circuit breaker state changes, by breaker and the state moved to", labelnames=("breaker", "state"))
+circuit_rejections = registry.counter("circuit_breaker_rejected_total", "requests not sent because their circuit breaker was open", labelnames=("breaker",))
+
+
+def server_failed(status_code: int) -> bool:
+    """Returns True if the response means the service itself is in trouble - no response at all (timeout, connection error) or a 5xx"""
+
+    return status_code is None or status_code >= 500
+
+
+def retryable(status_code: int) -> bool:
+    """Returns True if a request that got this response may work next time. 4xx responses never will, except 429 (rate limited)."""
+
+    return server_failed(status_code) or status_code == 429
+
+
+def retry_after(headers) -> float:
+    """Returns the seconds a Retry-After header asks us to wait (either delay seconds or an HTTP date), or None if there isn't a usable one"""
+
+    value = headers.get("Retry-After") if headers is not None else None
+    if not value:
+        return None
+
+    if value.strip().isdigit():
+        return float(value.strip())
+
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except Exception:
+        return None
+
+
+def next_retry_delay(retry_policy: "RetryPolicy", attempt: int, attempts: int, resp) -> float:
+    """
+        Returns the seconds to wait before trying a failed request again, or None to give up - attempt (counting from 0) was the last of
+        attempts, or resp (None for no response) isn't worth retrying. Shared by the threaded and asyncio retry loops.
+    """
+
+    delay = retry_policy.delay(attempt, resp.status_code if resp is not None else None, resp.headers if resp is not None else None)
+    if delay is None or attempt >= attempts - 1:
+        return None
+
+    return delay
+
+
+class RetryPolicy:
+    """
+        Status aware retries with full jitter exponential backoff - attempt n waits a random time between 0 and min(cap, base * 2 ** n) seconds.
+
+        A Retry-After header is honoured, unless it asks for longer than max_wait, in which case the caller should give up rather than
+        hold a thread (the message is retried later from the redis stream).
+    """
+
+    def __init__(self, base: float, cap: float, max_wait: float):
+        self.base = base
+        self.cap = cap
+        self.max_wait = max_wait
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def delay(self, attempt: int, status_code: int, headers=None) -> float:
+        """
+            Returns the seconds to wait before retrying a request that got status_code (None for no response) on attempt (counting from 0),
+            or None if it shouldn't be retried.
+        """
+
+        if not retryable(status_code):
+            return None
+
+        delay = self.backoff(attempt)
+        if requested_delay:= retry_after(headers):
+            if requested_delay > self.max_wait:
+                logger.warning(f"server asked us to wait {requested_delay:.0f} seconds before retrying - giving up for now")
+                return None
+            delay = max(delay, requested_delay)
+
+        return delay
+
+
+class CircuitBreaker:
+    """
+        A circuit breaker for one endpoint of an external service.
+
+        closed:    requests go through. failure_threshold server failures in a row opens the circuit.
+        open:      requests are refused without being sent, for reset_timeout seconds.
+        half_open: after reset_timeout, one trial request is let through. If it works the circuit closes, if it fails the circuit opens again.
+
+        Breakers are shared by every thread in the process - get one with CircuitBreaker.get(name).
+    """
+
+    _breakers = {}
+    _breakers_lock = threading.Lock()
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_started_at = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get(name: str) -> "CircuitBreaker":
+        """A static method that returns the process wide breaker with this name, creating it from the config on first use"""
+
+        if name not in CircuitBreaker._breakers:
+            with CircuitBreaker._breakers_lock:
+                if name not in CircuitBreaker._breakers:
+                    CircuitBreaker._breakers[name] = CircuitBreaker(name, Config.circuit_failure_threshold, Config.circuit_reset_timeout)
+
+        return CircuitBreaker._breakers[name]
+
+    def is_open(self) -> bool:
+        """Returns True while requests are being refused, i.e. the circuit is open and not ready for a trial request yet"""
+
+        return self.state == "open" and monotonic() < self.opened_at + self.reset_timeout
+
+    def retry_in(self) -> float:
+        """Returns the seconds until the circuit will let a trial request through - 0 if requests can go now"""
+
+        if self.state != "open":
+            return 0.0
+
+        return max(0.0, self.opened_at + self.reset_timeout - monotonic())
+
+    def allow_request(self) -> bool:
+        """Returns True if a request can be sent now. Call record() with its result afterwards."""
+
+        with self.lock:
+            if self.state == "closed":
+                return True
+
+            now = monotonic()
+            if self.state == "open" and now >= self.opened_at + self.reset_timeout:
+                self._set_state("half_open")
+
+            # a single trial request at a time - if the trial never reports back, let another through after reset_timeout
+            if self.state == "half_open" and (self.trial_started_at is None or now >= self.trial_started_at + self.reset_timeout):
+                self.trial_started_at = now
+                return True
+
+        circuit_rejections.inc(breaker=self.name)
+        return False
+
+    def record(self, status_code: int) -> None:
+        """Records the result of a request - status_code is None if no response came back"""
+
+        with self.lock:
+            if server_failed(status_code):
+                self.failures += 1
+                if self.state == "half_open" or self.failures >= self.failure_threshold:
+                    self.opened_at = monotonic()
+                    self.trial_started_at = None
+                    if self.state != "open":
+                        self._set_state("open")
+                        logger.error(f"circuit {self.name} opened after {self.failures} failures - refusing requests for {self.reset_timeout} seconds")
+
+            else:
+                self.failures = 0
+                self.trial_started_at = None
+                if self.state != "closed":
+                    self._set_state("closed")
+                    logger.info(f"circuit {self.name} closed")
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+        circuit_transitions.inc(breaker=self.name, state=state)
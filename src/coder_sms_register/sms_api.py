@@ -1,16 +1,20 @@
 from coder_sms_register.config import Config
 from flask import Flask, request, make_response
+from time import perf_counter, monotonic
 from flask_cors import CORS
-import datetime, redis
-from coder_sms_register.twilio import TwilioSignature
+from xml.sax.saxutils import escape
+import datetime, redis, os, threading
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+from coder_sms_register.twilio_signature import TwilioSignature
+from coder_sms_register.metrics import registry, exposition_content_type
+from coder_sms_register.stream_batcher import StreamBatcher
 
 sms_api = Flask(__name__)
 
-# Logging setup
+# Logging setup - sms_api.logger is coder_sms_register.sms_api, so it logs through the package's queue once logging is set up. That
+# happens in each gunicorn worker after the fork (post_fork in gunicorn.conf.py), not when this module is imported.
 sms_api.logger.handlers.clear()
-sms_api.logger.setLevel(Config.log_level)
-sms_api.logger.addHandler(Config.file_handler)
-sms_api.logger.addHandler(Config.stout_handler)
 
 CORS(sms_api)
 
@@ -18,21 +22,170 @@ CORS(sms_api)
 # gloabl var to keep track of redis consumer group issues
 redis_cons_grp_status = "no error"
 
+# process wide redis connection pool - built lazily so each gunicorn worker creates its own after the fork
+_redis_pool = None
+_redis_pool_pid = None
+_redis_pool_lock = threading.Lock()
+
+# per process xadd batcher - its flush thread doesn't survive a fork, so each gunicorn worker starts its own
+_batcher = None
+_batcher_pid = None
+
+# messages waiting in the stream, as of the last check - (length, monotonic time it was read)
+_stream_backlog = (0, 0.0)
+
+xadd_latency = registry.histogram("sms_api_xadd_seconds", "time spent publishing an inbound sms to the redis stream")
+inbound_latency = registry.histogram("sms_api_inbound_seconds", "time spent handling a Twilio webhook, by response status", labelnames=("status",))
+duplicate_webhooks = registry.counter("sms_api_duplicate_webhooks_total", "webhooks acknowledged without publishing because their MessageSid was already published")
+shed_webhooks = registry.counter("sms_api_shed_webhooks_total", "webhooks turned away without publishing because the stream backlog was over SMS_API_SHED_BACKLOG")
+
+
+def _get_redis_conn() -> redis.Redis:
+    """Returns a redis client backed by this process's connection pool, creating the pool on first use"""
+
+    global _redis_pool, _redis_pool_pid
+
+    if _redis_pool is None or _redis_pool_pid != os.getpid():
+        with _redis_pool_lock:
+            if _redis_pool is None or _redis_pool_pid != os.getpid():
+                _redis_pool = redis.BlockingConnectionPool(
+                    host=Config.redis_host, port=Config.redis_port, db=Config.redis_db, password=Config.redis_pw, decode_responses=True,
+                    max_connections=Config.redis_pool_max_conns, timeout=Config.redis_pool_timeout,
+                    health_check_interval=Config.redis_health_check_interval, socket_keepalive=True,
+                    retry=Retry(ExponentialBackoff(cap=1, base=.05), Config.redis_retry_attempts),
+                    retry_on_error=[redis.exceptions.ConnectionError, redis.exceptions.TimeoutError]
+                )
+                _redis_pool_pid = os.getpid()
+                sms_api.logger.info(f"created redis connection pool for process {_redis_pool_pid}")
+
+    return redis.Redis(connection_pool=_redis_pool)
+
+
+def _get_batcher() -> StreamBatcher:
+    """Returns this process's xadd batcher, creating it (and its flush thread) on first use"""
+
+    global _batcher, _batcher_pid
+
+    if _batcher is None or _batcher_pid != os.getpid():
+        with _redis_pool_lock:
+            if _batcher is None or _batcher_pid != os.getpid():
+                _batcher = StreamBatcher(_get_redis_conn, Config.redis_sms_stream_key, Config.redis_sms_stream_maxlen, Config.sms_api_batch_max, Config.sms_api_batch_wait_ms)
+                _batcher_pid = os.getpid()
+
+    return _batcher
+
+
+def _get_stream_backlog() -> int:
+    """
+        Returns the number of messages in the sms stream, read at most once per SMS_API_BACKLOG_CHECK_INTERVAL seconds.
+
+        The daemon deletes messages from the stream once they are processed, so the stream length is everything not processed yet - the
+        consumer group's lag plus its pending messages. Returns 0 if redis can't be reached, so the producer reports the problem instead.
+    """
+
+    global _stream_backlog
+
+    backlog, checked_at = _stream_backlog
+    if monotonic() - checked_at < Config.sms_api_backlog_check_interval:
+        return backlog
+
+    try:
+        backlog = _get_redis_conn().xlen(Config.redis_sms_stream_key)
+    except Exception as e:
+        sms_api.logger.error(f"problem checking the length of redis stream {Config.redis_sms_stream_key}")
+        sms_api.logger.error(e)
+        backlog = 0
+
+    _stream_backlog = (backlog, monotonic())
+    return backlog
+
+
+def _shed_load():
+    """Builds the response for a webhook turned away because the daemon is too far behind - a TwiML reply asking the sender to try later, or a 503"""
+
+    shed_webhooks.inc()
+
+    if Config.sms_api_shed_mode == "twiml":
+        resp = make_response(f"<Response><Message>{escape(Config.sms_api_shed_msg)}</Message></Response>", 200)
+        resp.headers["Content-Type"] = "text/html"
+        return resp
+
+    resp = make_response("service unavailable", 503)
+    resp.headers["Retry-After"] = str(Config.sms_api_shed_retry_after)
+    return resp
+
+
+def _claim_message_sid(message_sid: str) -> bool:
+    """
+        Remembers the MessageSid for a short time with SET NX EX. Returns False if it was already claimed, i.e. this is Twilio retrying a webhook we already published.
+
+        Fails open - if redis can't be reached the message goes on to the producer, which will report the problem.
+    """
+
+    if not message_sid:
+        return True
+
+    try:
+        return bool(_get_redis_conn().set(Config.redis_replay_key_prefix + message_sid, 1, nx=True, ex=Config.redis_replay_ttl))
+    except Exception as e:
+        sms_api.logger.error(f"problem checking replay cache for message {message_sid}")
+        sms_api.logger.error(e)
+        return True
+
+
+def _release_message_sid(message_sid: str) -> None:
+    """Forgets a claimed MessageSid, so Twilio's retry of a webhook we failed to publish isn't mistaken for a duplicate"""
+
+    if not message_sid:
+        return None
+
+    try:
+        _get_redis_conn().delete(Config.redis_replay_key_prefix + message_sid)
+    except Exception as e:
+        sms_api.logger.error(f"problem releasing message {message_sid} from the replay cache")
+        sms_api.logger.error(e)
+
+
 def _sms_msg_producer(msg: dict) -> bool:
-    redis_conn = redis.Redis(host=Config.redis_host, port=Config.redis_port, db=Config.redis_db, password=Config.redis_pw, decode_responses=True)
     msg["received_datetime"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    # publish alongside the webhooks other threads in this worker are handling, in one pipeline
+    if Config.sms_api_batch_xadd:
+        with xadd_latency.time():
+            return _get_batcher().xadd(msg, Config.sms_api_xadd_timeout)
+
+    redis_conn = _get_redis_conn()
     try:
-        redis_conn.xadd(Config.redis_sms_stream_key, msg, "*")
+        with xadd_latency.time():
+            # MAXLEN ~ lets redis trim whole nodes at a time, which is far cheaper than an exact cap
+            redis_conn.xadd(Config.redis_sms_stream_key, msg, "*", maxlen=Config.redis_sms_stream_maxlen or None, approximate=True)
     except Exception as e:
         sms_api.logger.error(f"problem publishing message to redis stream msg: {msg}")
         sms_api.logger.error(e)
         return False
-    
+
+    sms_api.logger.debug(f"xadd latency p50: {xadd_latency.quantile(.5)}s p99: {xadd_latency.quantile(.99)}s")
     return True
 
 
+@sms_api.route("/metrics", methods=["GET"])
+def metrics():
+    # each gunicorn worker keeps its own registry, so a scrape reports the worker that answered it
+    resp = make_response(registry.exposition(), 200)
+    resp.headers["Content-Type"] = exposition_content_type
+    return resp
+
+
 @sms_api.route("/inbound", methods=["POST"])
 def inbound_sms():
+    start = perf_counter()
+    resp = _inbound_sms()
+    inbound_latency.labels(status=resp.status_code).observe(perf_counter() - start)
+
+    return resp
+
+
+def _inbound_sms():
     global redis_cons_grp_status
     if redis_cons_grp_status == "error":
         sms_api.logger.error("redis error")
@@ -47,10 +200,25 @@ def inbound_sms():
         resp = make_response("not authorized", 401)
         return resp
     
+    # the daemon is too far behind to get to this message any time soon - say so right away instead of adding to the backlog
+    if Config.sms_api_shed_backlog and _get_stream_backlog() >= Config.sms_api_shed_backlog:
+        sms_api.logger.warning(f"stream backlog is over {Config.sms_api_shed_backlog} messages - shedding load")
+        return _shed_load()
+
     req_data = request.form.to_dict()
 
+    # Twilio retries webhooks it didn't see a response to in time - acknowledge those without publishing the message again
+    message_sid = req_data.get("MessageSid")
+    if not _claim_message_sid(message_sid):
+        sms_api.logger.info(f"message {message_sid} was already published - returning success 200")
+        duplicate_webhooks.inc()
+        resp = make_response("<Response></Response>", 200)
+        resp.headers["Content-Type"] = "text/html"
+        return resp
+
     if not _sms_msg_producer(req_data):
         sms_api.logger.error("500 error - problem creating msg for redis")
+        _release_message_sid(message_sid)
         resp = make_response("internal server error", 500)
         return resp
 
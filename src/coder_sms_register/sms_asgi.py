@@ -0,0 +1,235 @@
+"""
+    The ASGI version of the inbound sms api (sms_api.py), for gunicorn's uvicorn worker class.
+
+    Each worker handles every webhook on one event loop, so a webhook waiting on redis costs a coroutine rather than a worker process or thread.
+    It behaves the same as the flask app - signature check, load shedding, MessageSid replay cache, then XADD - and shares its config and metrics.
+"""
+
+from coder_sms_register.config import Config
+from coder_sms_register.twilio_signature import TwilioSignature
+from coder_sms_register.metrics import registry, exposition_content_type
+from coder_sms_register.stream_batcher import AsyncStreamBatcher
+from time import perf_counter, monotonic
+from urllib.parse import parse_qsl
+from xml.sax.saxutils import escape
+import datetime, redis
+import redis.asyncio as aioredis
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
+
+# Logging setup - handlers are set up in each gunicorn worker after the fork (post_fork in gunicorn.conf.py), not when this module is imported
+import logging
+logger = logging.getLogger(__name__)
+
+# metrics shared with the flask app - the registry hands back the same metric for the same name
+xadd_latency = registry.histogram("sms_api_xadd_seconds", "time spent publishing an inbound sms to the redis stream")
+inbound_latency = registry.histogram("sms_api_inbound_seconds", "time spent handling a Twilio webhook, by response status", labelnames=("status",))
+duplicate_webhooks = registry.counter("sms_api_duplicate_webhooks_total", "webhooks acknowledged without publishing because their MessageSid was already published")
+shed_webhooks = registry.counter("sms_api_shed_webhooks_total", "webhooks turned away without publishing because the stream backlog was over SMS_API_SHED_BACKLOG")
+
+# built on the worker's event loop the first time they are needed
+_redis_conn = None
+_batcher = None
+
+# messages waiting in the stream, as of the last check - (length, monotonic time it was read)
+_stream_backlog = (0, 0.0)
+
+# largest webhook body we'll read - Twilio's are a few KB
+max_body_bytes = 64 * 1024
+
+
+def _get_redis_conn() -> aioredis.Redis:
+    """
+        Returns an async redis client backed by this worker's connection pool, creating the pool on first use.
+
+        Commands that hit a dropped connection or a timeout are retried with backoff, the same as the flask app's pool.
+    """
+
+    global _redis_conn
+
+    if _redis_conn is None:
+        _redis_conn = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool(
+            host=Config.redis_host, port=Config.redis_port, db=Config.redis_db, password=Config.redis_pw, decode_responses=True,
+            max_connections=Config.redis_async_pool_max_conns, timeout=Config.redis_pool_timeout,
+            health_check_interval=Config.redis_health_check_interval, socket_keepalive=True,
+            retry=Retry(ExponentialBackoff(cap=1, base=.05), Config.redis_retry_attempts),
+            retry_on_error=[redis.exceptions.ConnectionError, redis.exceptions.TimeoutError]
+        ))
+        logger.info("created async redis connection pool")
+
+    return _redis_conn
+
+
+def _get_batcher() -> AsyncStreamBatcher:
+    global _batcher
+
+    if _batcher is None:
+        _batcher = AsyncStreamBatcher(_get_redis_conn(), Config.redis_sms_stream_key, Config.redis_sms_stream_maxlen, Config.sms_api_batch_max, Config.sms_api_batch_wait_ms)
+
+    return _batcher
+
+
+async def _get_stream_backlog() -> int:
+    """Returns the number of messages in the sms stream, read at most once per SMS_API_BACKLOG_CHECK_INTERVAL seconds - see sms_api._get_stream_backlog"""
+
+    global _stream_backlog
+
+    backlog, checked_at = _stream_backlog
+    if monotonic() - checked_at < Config.sms_api_backlog_check_interval:
+        return backlog
+
+    # claim the check before awaiting, so a burst of requests doesn't all ask redis at once
+    _stream_backlog = (backlog, monotonic())
+    try:
+        backlog = await _get_redis_conn().xlen(Config.redis_sms_stream_key)
+    except Exception as e:
+        logger.error(f"problem checking the length of redis stream {Config.redis_sms_stream_key}")
+        logger.error(e)
+        backlog = 0
+
+    _stream_backlog = (backlog, monotonic())
+    return backlog
+
+
+async def _claim_message_sid(message_sid: str) -> bool:
+    """Remembers the MessageSid for a short time with SET NX EX. Returns False if it was already claimed. Fails open."""
+
+    if not message_sid:
+        return True
+
+    try:
+        return bool(await _get_redis_conn().set(Config.redis_replay_key_prefix + message_sid, 1, nx=True, ex=Config.redis_replay_ttl))
+    except Exception as e:
+        logger.error(f"problem checking replay cache for message {message_sid}")
+        logger.error(e)
+        return True
+
+
+async def _release_message_sid(message_sid: str) -> None:
+    if not message_sid:
+        return None
+
+    try:
+        await _get_redis_conn().delete(Config.redis_replay_key_prefix + message_sid)
+    except Exception as e:
+        logger.error(f"problem releasing message {message_sid} from the replay cache")
+        logger.error(e)
+
+
+async def _sms_msg_producer(msg: dict) -> bool:
+    msg["received_datetime"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    try:
+        with xadd_latency.time():
+            if Config.sms_api_batch_xadd:
+                return await _get_batcher().xadd(msg, Config.sms_api_xadd_timeout)
+
+            await _get_redis_conn().xadd(Config.redis_sms_stream_key, msg, "*", maxlen=Config.redis_sms_stream_maxlen or None, approximate=True)
+    except Exception as e:
+        logger.error(f"problem publishing message to redis stream msg: {msg}")
+        logger.error(e)
+        return False
+
+    return True
+
+
+def _twiml(message: str =None) -> tuple[int, dict, bytes]:
+    body = f"<Response><Message>{escape(message)}</Message></Response>" if message else "<Response></Response>"
+    return 200, {"Content-Type": "text/html"}, body.encode("utf-8")
+
+
+async def _inbound_sms(form: dict, headers: dict) -> tuple[int, dict, bytes]:
+    """Handles one Twilio webhook. Returns the status code, response headers and response body."""
+
+    # HMAC-SHA1 over a few hundred bytes takes microseconds, so it is done right on the event loop
+    if not TwilioSignature(form, headers).compare_signatures():
+        logger.warning("bad signature - not authorized")
+        return 401, {"Content-Type": "text/plain"}, b"not authorized"
+
+    if Config.sms_api_shed_backlog and await _get_stream_backlog() >= Config.sms_api_shed_backlog:
+        logger.warning(f"stream backlog is over {Config.sms_api_shed_backlog} messages - shedding load")
+        shed_webhooks.inc()
+        if Config.sms_api_shed_mode == "twiml":
+            return _twiml(Config.sms_api_shed_msg)
+        return 503, {"Content-Type": "text/plain", "Retry-After": str(Config.sms_api_shed_retry_after)}, b"service unavailable"
+
+    message_sid = form.get("MessageSid")
+    if not await _claim_message_sid(message_sid):
+        logger.info(f"message {message_sid} was already published - returning success 200")
+        duplicate_webhooks.inc()
+        return _twiml()
+
+    if not await _sms_msg_producer(form):
+        logger.error("500 error - problem creating msg for redis")
+        await _release_message_sid(message_sid)
+        return 500, {"Content-Type": "text/plain"}, b"internal server error"
+
+    logger.info("returning success 200")
+    return _twiml()
+
+
+async def _read_body(receive) -> bytes:
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if len(body) > max_body_bytes:
+            return None
+        if not message.get("more_body"):
+            return body
+
+
+async def _send_response(send, status: int, headers: dict, body: bytes) -> None:
+    headers = dict(headers, **{"Content-Length": str(len(body))})
+    await send({"type": "http.response.start", "status": status, "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers.items()]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _batcher is not None:
+                await _batcher.close()
+            if _redis_conn is not None:
+                await _redis_conn.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def sms_asgi(scope, receive, send) -> None:
+    """The ASGI application - serves POST /inbound and GET /metrics"""
+
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+
+    if scope["type"] != "http":
+        return None
+
+    if scope["path"] == "/metrics" and scope["method"] == "GET":
+        # each gunicorn worker keeps its own registry, so a scrape reports the worker that answered it
+        return await _send_response(send, 200, {"Content-Type": exposition_content_type}, registry.exposition().encode("utf-8"))
+
+    if scope["path"] != "/inbound":
+        return await _send_response(send, 404, {"Content-Type": "text/plain"}, b"not found")
+
+    if scope["method"] != "POST":
+        return await _send_response(send, 405, {"Content-Type": "text/plain", "Allow": "POST"}, b"method not allowed")
+
+    start = perf_counter()
+    body = await _read_body(receive)
+    if body is None:
+        status, headers, resp_body = 413, {"Content-Type": "text/plain"}, b"request too large"
+    else:
+        # first value wins for repeated keys, the same as werkzeug's form.to_dict()
+        form = {}
+        for key, value in parse_qsl(body.decode("utf-8"), keep_blank_values=True):
+            form.setdefault(key, value)
+        req_headers = {"X-Twilio-Signature": value.decode("latin-1") for name, value in scope["headers"] if name == b"x-twilio-signature"}
+
+        status, headers, resp_body = await _inbound_sms(form, req_headers)
+
+    await _send_response(send, status, headers, resp_body)
+    inbound_latency.labels(status=status).observe(perf_counter() - start)
@@ -1,25 +1,57 @@
 from coder_sms_register.config import Config
+from coder_sms_register.metrics import registry
+from coder_sms_register.supervisor import beat
+from threading import Event, Condition
+from time import monotonic
 import redis, queue
+from typing import Callable
 
 # Logging setup
 import logging
 logger = logging.getLogger(__name__)
-logger.setLevel(Config.log_level)
-logger.addHandler(Config.file_handler)
-logger.addHandler(Config.stout_handler)
+
+reclaimed_msgs = registry.counter("sms_stream_reclaimed_total", "unacknowledged messages claimed back from the consumer group's pending entries list")
+dead_lettered_msgs = registry.counter("sms_stream_dead_lettered_total", "messages moved to the dead letter stream after too many deliveries")
+removed_consumers = registry.counter("sms_stream_consumers_removed_total", "consumers with nothing pending removed from the consumer group after going idle")
+
+
+def delivered_too_often(delivery_count: int, max_deliveries: int) -> bool:
+    """Returns True if a reclaimed message has used up its deliveries and belongs in the dead letter stream"""
+
+    return delivery_count > max_deliveries
+
+
+def dead_letter_fields(msg_id: str, msg: dict, delivery_count: int) -> dict:
+    """Returns the fields a message is saved with in the dead letter stream - its own, plus its stream id and how often it was delivered"""
+
+    return dict(msg, original_id=msg_id, delivery_count=delivery_count)
+
+
+def stale_consumers(consumers: list[dict], consumer_name: str, stale_ms: int) -> list[str]:
+    """
+        Returns the names of the consumers (from XINFO CONSUMERS) that can be removed from the group - not this one, nothing pending,
+        and idle for at least stale_ms.
+    """
+
+    return [consumer["name"] for consumer in consumers if consumer["name"] != consumer_name and not consumer["pending"] and consumer["idle"] >= stale_ms]
 
 
 class SMSListener:
     
     @staticmethod
-    def get_message(redis_conn: redis.Redis, redis_stream_key: str, redis_consumer_grp: str, consumer_name: str, msg_read_count: int, block_time_ms: int, inbound_sms_q: queue.Queue, kill_q: queue.Queue) -> None:
+    def get_message(redis_conn: redis.Redis, redis_stream_key: str, redis_consumer_grp: str, consumer_name: str, msg_read_count: int, block_time_ms: int, inbound_sms_q: queue.Queue, stop: Event) -> None:
+        """
+            A static method that reads new messages from the redis stream as consumer_name and posts them to the inbound sms queue, until stop is set.
+
+            The read blocks for at most block_time_ms, so the listener notices stop within that time.
+        """
             
         try:
-            redis_conn.xgroup_create(name=Config.redis_sms_stream_key, groupname=Config.redis_sms_consum_grp, mkstream=True, id="$")
-            logger.info(f"created consumer group: {Config.redis_sms_consum_grp}")
+            redis_conn.xgroup_create(name=redis_stream_key, groupname=redis_consumer_grp, mkstream=True, id="$")
+            logger.info(f"created consumer group: {redis_consumer_grp}")
         except redis.exceptions.ResponseError as e:
             if str(e) == "BUSYGROUP Consumer Group name already exists":
-                logger.info(f"consumer group {Config.redis_sms_consum_grp} already exists - moving on")
+                logger.info(f"consumer group {redis_consumer_grp} already exists - moving on")
             else:
                 logger.error("problem creating consumer group in redis")
                 logger.error(e)
@@ -30,7 +62,8 @@ class SMSListener:
             redis_cons_grp_status = "error"
 
 
-        while kill_q.empty():
+        while not stop.is_set():
+            beat()
             try:
                 streams = redis_conn.xreadgroup(groupname=redis_consumer_grp, consumername=consumer_name, streams={redis_stream_key: ">"}, count=msg_read_count, block=block_time_ms)
             
@@ -42,13 +75,281 @@ class SMSListener:
             if streams:
                 logger.info(f"{len(streams[0][1])} messages retrieved from redis stream {streams[0][0]}")
                 
-                # loop through the messages and post them to the inbound sms queue, acknowledge the message with redis, and delete the message from the stream
+                # post the messages to the inbound sms queue along with their stream id - the sms worker acknowledges them once they are processed
                 for msg in streams[0][1]:
                     logger.debug(f"posting this message to the sms_inbound_q: {msg[1]}")
-                    inbound_sms_q.put(msg[1])
+                    inbound_sms_q.put((msg[0], msg[1]))
+
+    @staticmethod
+    def reclaim_messages(redis_conn: redis.Redis, redis_stream_key: str, redis_consumer_grp: str, consumer_name: str, min_idle_ms: int, max_deliveries: int, dead_letter_key: str, check_interval: int, inbound_sms_q: queue.Queue, stop: Event, is_paused: Callable[[], bool] =None) -> None:
+        """
+            A static method that watches the consumer group's pending entries list for messages that were delivered but never acknowledged
+            (a consumer crashed or a message failed to process), claims them with XAUTOCLAIM, and posts them back on the inbound sms queue.
+
+            Messages that have been delivered more than max_deliveries times are moved to the dead letter stream instead.
+
+            is_paused: optional function - nothing is claimed while it returns True (e.g. while a circuit breaker is open), so parked
+            messages don't use up their deliveries.
+        """
+
+        while not stop.is_set():
+            beat()
+            # claiming while paused would only use up the parked messages' deliveries
+            if is_paused is not None and is_paused():
+                logger.warning("reclaiming is paused - not claiming pending messages")
+            else:
+                start_id = "0-0"
+                try:
+                    while True:
+                        next_id, claimed_msgs, deleted_ids = redis_conn.xautoclaim(redis_stream_key, redis_consumer_grp, consumer_name, min_idle_ms, start_id=start_id, count=100)
+
+                        # entries still in the pending list whose message was already deleted from the stream - nothing left to process
+                        if deleted_ids:
+                            redis_conn.xack(redis_stream_key, redis_consumer_grp, *deleted_ids)
+
+                        delivery_counts = SMSListener.delivery_counts(redis_conn, redis_stream_key, redis_consumer_grp, consumer_name, [msg[0] for msg in claimed_msgs])
+                        for msg in claimed_msgs:
+                            delivery_count = delivery_counts.get(msg[0], 1)
+
+                            if delivered_too_often(delivery_count, max_deliveries):
+                                logger.error(f"message {msg[0]} failed after {delivery_count - 1} deliveries - moving it to dead letter stream {dead_letter_key}")
+                                SMSListener.dead_letter_message(redis_conn, redis_stream_key, redis_consumer_grp, dead_letter_key, msg[0], msg[1], delivery_count - 1)
+                                dead_lettered_msgs.inc()
+                            else:
+                                logger.warning(f"reclaimed message {msg[0]} (delivery {delivery_count}) - posting it to the sms_inbound_q")
+                                inbound_sms_q.put((msg[0], msg[1]))
+                                reclaimed_msgs.inc()
+
+                        if next_id == "0-0":
+                            break
+                        start_id = next_id
+
+                except Exception as e:
+                    logger.error(f"problem reclaiming pending messages from redis stream: {redis_stream_key} and consumer group: {redis_consumer_grp}")
+                    logger.error(e)
+
+                SMSListener.remove_stale_consumers(redis_conn, redis_stream_key, redis_consumer_grp, consumer_name, Config.stale_consumer_ms)
+
+            stop.wait(check_interval)
+
+    @staticmethod
+    def delivery_counts(redis_conn: redis.Redis, redis_stream_key: str, redis_consumer_grp: str, consumer_name: str, msg_ids: list[str]) -> dict[str, int]:
+        """
+            A static method that returns message id -> times delivered for messages just claimed by consumer_name.
+
+            XAUTOCLAIM hands messages back in id order, so one XPENDING range call from the first id to the last covers a whole page.
+            It only needs another call if this consumer has more of its own messages pending in between than were claimed.
+        """
+
+        counts = {}
+        if not msg_ids:
+            return counts
+
+        start_id = msg_ids[0]
+        while len(counts) < len(msg_ids):
+            pending = redis_conn.xpending_range(redis_stream_key, redis_consumer_grp, min=start_id, max=msg_ids[-1], count=len(msg_ids), consumername=consumer_name)
+            counts.update({entry["message_id"]: entry["times_delivered"] for entry in pending})
+            if len(pending) < len(msg_ids):
+                break
+            start_id = "(" + pending[-1]["message_id"]
+
+        return {msg_id: counts[msg_id] for msg_id in msg_ids if msg_id in counts}
+
+    @staticmethod
+    def remove_stale_consumers(redis_conn: redis.Redis, redis_stream_key: str, redis_consumer_grp: str, consumer_name: str, stale_ms: int) -> int:
+        """
+            A static method that removes consumers from the group that have nothing pending and haven't read in stale_ms - each replica
+            reads as its own consumer (hostname-pid), so replaced replicas would otherwise pile up in the group. Consumers with pending
+            messages are left alone until the reclaimer has claimed them.
+
+            Returns the number of consumers removed, or None if an exception occurs.
+        """
+
+        removed = 0
+        try:
+            for stale_name in stale_consumers(redis_conn.xinfo_consumers(redis_stream_key, redis_consumer_grp), consumer_name, stale_ms):
+                redis_conn.xgroup_delconsumer(redis_stream_key, redis_consumer_grp, stale_name)
+                logger.info(f"removed stale consumer {stale_name} from consumer group {redis_consumer_grp}")
+                removed_consumers.inc()
+                removed += 1
+
+        except Exception as e:
+            logger.error(f"problem removing stale consumers from consumer group: {redis_consumer_grp}")
+            logger.error(e)
+            return None
+
+        return removed
+
+    @staticmethod
+    def stream_stats(redis_conn: redis.Redis, redis_stream_key: str, redis_consumer_grp: str) -> dict:
+        """
+            A static method that returns the consumer group's pending count (delivered but not acknowledged) and lag (in the stream but not delivered yet).
+
+            lag is None on redis versions before 7, or when redis can't work it out after messages were deleted. Returns None if the group doesn't exist.
+        """
+
+        for group in redis_conn.xinfo_groups(redis_stream_key):
+            if group["name"] == redis_consumer_grp:
+                return {"pending": group["pending"], "lag": group.get("lag")}
+
+        return None
+
+    @staticmethod
+    def dead_letter_message(redis_conn: redis.Redis, redis_stream_key: str, redis_consumer_grp: str, dead_letter_key: str, msg_id: str, msg: dict, delivery_count: int) -> bool:
+        """A static method that copies a message to the dead letter stream and removes it from the sms stream"""
+
+        try:
+            redis_conn.xadd(dead_letter_key, dead_letter_fields(msg_id, msg, delivery_count), "*")
+        except Exception as e:
+            logger.error(f"problem moving message {msg_id} to dead letter stream {dead_letter_key}")
+            logger.error(e)
+            return False
+
+        return SMSListener.ack_messages(redis_conn, redis_stream_key, redis_consumer_grp, [msg_id])
+
+    @staticmethod
+    def ack_messages(redis_conn: redis.Redis, redis_stream_key: str, redis_consumer_grp: str, msg_ids: list[str]) -> bool:
+        """
+            A static method that acknowledges and deletes a batch of messages from the redis stream using a single pipelined call.
+
+            Returns True if the batch was acknowledged and deleted. Returns False if an exception occurs.
+        """
+
+        if not msg_ids:
+            return True
+
+        logger.debug(f"acknowledging and deleting message ids in redis stream: {msg_ids}")
+        try:
+            pipe = redis_conn.pipeline(transaction=Config.redis_ack_transaction)
+            pipe.xack(redis_stream_key, redis_consumer_grp, *msg_ids)
+            pipe.xdel(redis_stream_key, *msg_ids)
+            pipe.execute()
+
+        except Exception as e:
+            logger.error(f"problem acknowledging and deleting message ids {msg_ids} from redis stream: {redis_stream_key}")
+            logger.error(e)
+            return False
+
+        return True
+
+
+class StreamAcker:
+    """
+        Acknowledges and deletes processed messages from the redis stream in batches, so each message doesn't cost its own round trip.
+
+        Message ids can be added from any thread - the sms workers, and the sms sender once a reply has gone out. A batch is flushed in
+        one pipeline (SMSListener.ack_messages) once max_batch ids are waiting, or max_wait_ms after the first one was added, by the
+        thread running run(). Ids from a failed flush are kept for the next one.
+
+        A message that isn't acknowledged before a crash just stays pending, and is reclaimed and recognised as already processed.
+
+        Messages can also be held while they wait on something else before they are done, e.g. a credentials sms in the send queue.
+        Every touch_interval_ms the held messages are claimed again by consumer_name with XCLAIM JUSTID, which resets their idle time
+        without counting a delivery, so the reclaimer (here or on another replica) leaves them alone. If this process stops, the touches
+        stop too, and the messages are reclaimed once they have been idle for the reclaimer's min idle time.
+    """
+
+    def __init__(self, redis_conn: redis.Redis, redis_stream_key: str, redis_consumer_grp: str, max_batch: int, max_wait_ms: float, consumer_name: str =None, touch_interval_ms: float =None):
+        self.redis_conn = redis_conn
+        self.redis_stream_key = redis_stream_key
+        self.redis_consumer_grp = redis_consumer_grp
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.consumer_name = consumer_name
+        self.touch_interval = touch_interval_ms / 1000 if touch_interval_ms else None
+        self._msg_ids = []
+        self._first_added = 0.0
+        self._held = set()
+        self._next_touch = 0.0
+        self._cond = Condition()
+
+    def add(self, msg_id: str) -> None:
+        """A method that queues a processed message to be acknowledged in the next batch"""
+
+        with self._cond:
+            self._held.discard(msg_id)
+            if not self._msg_ids:
+                self._first_added = monotonic()
+            self._msg_ids.append(msg_id)
+            if len(self._msg_ids) >= self.max_batch:
+                self._cond.notify()
+
+    def hold(self, msg_id: str) -> None:
+        """A method that keeps a message from looking idle to the reclaimer until it is added (acknowledged) or released"""
+
+        with self._cond:
+            self._held.add(msg_id)
+
+    def release(self, msg_id: str) -> None:
+        """A method that stops holding a message without acknowledging it, so the reclaimer picks it up again once it is idle"""
+
+        with self._cond:
+            self._held.discard(msg_id)
+
+    def qsize(self) -> int:
+        with self._cond:
+            return len(self._msg_ids)
+
+    def touch(self) -> bool:
+        """A method that resets the idle time of every held message in one XCLAIM JUSTID call. Returns False if an exception occurs."""
+
+        with self._cond:
+            msg_ids = list(self._held)
+
+        if not msg_ids:
+            return True
+
+        try:
+            self.redis_conn.xclaim(self.redis_stream_key, self.redis_consumer_grp, self.consumer_name, 0, msg_ids, justid=True)
+
+        except Exception as e:
+            logger.error(f"problem resetting the idle time of held message ids {msg_ids} in redis stream: {self.redis_stream_key}")
+            logger.error(e)
+            return False
+
+        return True
+
+    def flush(self) -> bool:
+        """A method that acknowledges every queued message in one pipeline. Returns False, keeping the ids for next time, if it fails."""
+
+        with self._cond:
+            msg_ids, self._msg_ids = self._msg_ids, []
+
+        if SMSListener.ack_messages(self.redis_conn, self.redis_stream_key, self.redis_consumer_grp, msg_ids):
+            return True
+
+        with self._cond:
+            if not self._msg_ids:
+                self._first_added = monotonic()
+            self._msg_ids = msg_ids + self._msg_ids
+        return False
+
+    def run(self, stop: Event) -> None:
+        """A method that flushes batches until stop is set, then flushes whatever is left. Meant to be the target of its own thread."""
+
+        while not stop.is_set():
+            beat()
+            if self.touch_interval and monotonic() >= self._next_touch:
+                self.touch()
+                self._next_touch = monotonic() + self.touch_interval
+
+            with self._cond:
+                idle = not self._msg_ids
+                if not idle:
+                    wait_time = self._first_added + self.max_wait - monotonic()
+                    if len(self._msg_ids) < self.max_batch and wait_time > 0:
+                        self._cond.wait(wait_time)
+                due = len(self._msg_ids) >= self.max_batch or (self._msg_ids and monotonic() >= self._first_added + self.max_wait)
+
+            # nothing to acknowledge - wait on stop rather than the condition, so shutdown isn't held up. An id added meanwhile has
+            # waited at most max_wait by the time it is looked at
+            if idle:
+                stop.wait(min(max(self.max_wait, .01), 1))
+                continue
 
-                    logger.debug(f"acknowledging message id in redis stream: {msg[0]}")
-                    redis_conn.xack(redis_stream_key, redis_consumer_grp, msg[0])
+            if due and not self.flush():
+                # redis is having trouble - don't retry in a tight loop
+                stop.wait(1)
 
-                    logger.debug(f"deleting message from redis stream: {msg[0]}")
-                    redis_conn.xdel(redis_stream_key, msg[0])
\ No newline at end of file
+        if not self.flush():
+            logger.warning(f"{self.qsize()} processed messages were not acknowledged before shutdown - they will be reclaimed and skipped")
@@ -0,0 +1,38 @@
+from queue import Queue
+import zlib
+
+
+class ShardedQueue:
+    """
+        A set of queues, one per sms worker, that routes each inbound sms by a hash of the phone number it came from.
+
+        Every message from the same phone number lands on the same shard, so one worker handles them in order and the same
+        number is never processed by two workers at once.
+    """
+
+    def __init__(self, shard_count: int):
+        if shard_count < 1:
+            raise ValueError("shard_count must be at least 1")
+
+        self.shards = [Queue() for i in range(0, shard_count)]
+
+    def shard_for(self, phone_num: str) -> int:
+        """Returns the index of the shard that handles the phone number provided"""
+
+        return zlib.crc32(phone_num.encode("utf-8")) % len(self.shards)
+
+    def put(self, item: tuple[str, dict]) -> None:
+        """Post a (stream message id, message) tuple to the shard for the message's From number"""
+
+        self.shards[self.shard_for(item[1].get("From", ""))].put(item)
+
+    def shard(self, index: int) -> Queue:
+        return self.shards[index]
+
+    def depths(self) -> list[int]:
+        """Returns the approximate number of messages waiting on each shard"""
+
+        return [shard.qsize() for shard in self.shards]
+
+    def qsize(self) -> int:
+        return sum(self.depths())
@@ -1,28 +1,39 @@
 from coder_sms_register.config import Config
 from queue import Empty, Queue
-from coder_sms_register.twilio import TwilioSender
-from coder_sms_register.models import users
+from threading import Event
+from coder_sms_register.twilio import TwilioSendQueue
+from coder_sms_register.user_store import UserStore
+from coder_sms_register.idempotency import IdempotencyStore
 from coder_sms_register.coder import Coder
-from sqlalchemy.engine import Engine
-from datetime import datetime
-import sqlalchemy as db
-import os, bcrypt
+from coder_sms_register.sms_listener import StreamAcker
+from coder_sms_register.metrics import registry
+from coder_sms_register.supervisor import beat
+from time import time
+from functools import partial
+from typing import Callable
+import bcrypt, hmac, hashlib
 
 # Logging setup
 import logging
 logger = logging.getLogger(__name__)
-logger.setLevel(Config.log_level)
-logger.addHandler(Config.file_handler)
-logger.addHandler(Config.stout_handler)
+
+# per stage timings for inbound sms processing
+process_latency = registry.histogram("sms_worker_process_seconds", "total time spent processing an inbound sms")
+lookup_latency = registry.histogram("sms_worker_lookup_seconds", "time spent checking for an existing user")
+create_user_latency = registry.histogram("sms_worker_create_user_seconds", "time spent creating a Coder user and saving them to the database")
+send_sms_latency = registry.histogram("sms_worker_send_sms_seconds", "time spent sending credentials via Twilio (asyncio runtime)")
+bcrypt_latency = registry.histogram("sms_worker_bcrypt_seconds", "time spent hashing a phone number, or checking one against a legacy user, with bcrypt", labelnames=("op",))
+resumed_msgs = registry.counter("sms_worker_resumed_total", "redelivered messages picked up from their saved state instead of processed from scratch", labelnames=("state",))
+processed_msgs = registry.counter("sms_worker_messages_total", "inbound sms messages handled, by whether they were done with, waiting on their credentials sms, or left to be retried", labelnames=("result",))
 
 
 class MsgManager:
-    """A class to process inbound sms messages, fetch and store data in the database, and send reply sms messages"""
+    """A class to process inbound sms messages, fetch and store data in the user store, and send reply sms messages"""
     
-    def __init__(self, phone_num: str, msg_body: str, db_engine: Engine):
+    def __init__(self, phone_num: str, msg_body: str, user_store: UserStore):
         self.phone_num = phone_num
         self.msg_body = msg_body
-        self.db_engine = db_engine
+        self.user_store = user_store
         self._check_from_num_format()
 
     def _check_from_num_format(self) -> None:
@@ -42,15 +53,25 @@ class MsgManager:
           
         phone_num_bytes = self.phone_num.encode('utf-8') # converting phone number to array of bytes
         salt = bcrypt.gensalt() # generating the salt
-        phone_num_hash = bcrypt.hashpw(phone_num_bytes, salt).decode("utf-8") # Hashing the phone number
+        with bcrypt_latency.labels(op="hash").time():
+            phone_num_hash = bcrypt.hashpw(phone_num_bytes, salt).decode("utf-8") # Hashing the phone number
         self.phone_num_hash = phone_num_hash
 
         return phone_num_hash
 
+    def gen_phone_key(self) -> str:
+        """A method to generate a keyed, non-reversible lookup value (HMAC-SHA256) from the normalized phone number that can be indexed in the database"""
+
+        normalized_phone_num = "+" + "".join(char for char in self.phone_num if char.isdigit())
+        phone_key = hmac.new(Config.phone_key_secret.encode("utf-8"), normalized_phone_num.encode("utf-8"), hashlib.sha256).hexdigest()
+        self.phone_key = phone_key
+
+        return phone_key
+
     def verify_pass_phrase(self) -> bool:
         """A method to check for a valid pass phrase in the sms message"""
 
-        if self.msg_body.replace(" ", "").lower().rstrip(".").rstrip("!").rstrip("?") == os.environ.get("CODER_REG_PASS").replace(" ", "").lower():
+        if self.msg_body.replace(" ", "").lower().rstrip(".").rstrip("!").rstrip("?") == Config.coder_reg_pass.replace(" ", "").lower():
             self.pass_verified = True
 
             logger.info("pass phrase matches")            
@@ -62,36 +83,69 @@ class MsgManager:
         return False
     
     def check_for_matching_user(self) -> str:
-        """A method that checks the SQLite database to see if a user already exists for phone number that sent the message"""
+        """A method that checks the user store to see if a user already exists for phone number that sent the message"""
 
         try:
-            qry = db.select(users)
-        
-            with self.db_engine.connect() as connection:
-                results_obj = connection.execute(qry)
-                results_data = results_obj.fetchall()
-        
+            username = self.user_store.get_username_by_phone_key(self.gen_phone_key())
+
         # if we have a problem fetching data from the database log the problem and return False
         except Exception as e:
             logger.error("problem getting users")
             logger.error(e)
             return False
-        
-        # if we don't have any users, no need to check anything
+
+        if username:
+            return username
+
+        return self._check_for_matching_legacy_user()
+
+    def _check_for_matching_legacy_user(self) -> str:
+        """
+            A private method that checks users created before the phone_key column existed, which can only be matched with bcrypt.
+
+            When a match is found the phone_key is filled in, so the next lookup for this phone number is a single indexed query.
+        """
+
+        try:
+            results_data = self.user_store.get_legacy_users()
+
+        except Exception as e:
+            logger.error("problem getting legacy users")
+            logger.error(e)
+            return False
+
+        # if we don't have any users without a phone key, no need to check anything
         if len(results_data) == 0:
             logger.info("no users found")
             return None
-        
+
         # check the phone number against the existing hashes
-        for user in results_data:            
-            phone_num_bytes =  self.phone_num.encode('utf-8') # encoding user phone number              
-            
+        for user in results_data:
+            phone_num_bytes =  self.phone_num.encode('utf-8') # encoding user phone number
+
             # if the phone number provided matches the bcrypt hash, return the username - note that we need to turn the has back into bytes before checking
-            if bcrypt.checkpw(phone_num_bytes, user[0].encode("utf-8")): 
+            with bcrypt_latency.labels(op="check").time():
+                phone_num_match = bcrypt.checkpw(phone_num_bytes, user[0].encode("utf-8"))
+            if phone_num_match:
+                self._backfill_phone_key(user[0])
                 return user[1]
-                    
+
         return None
 
+    def _backfill_phone_key(self, phone_hash: str) -> bool:
+        """A private method to store the phone_key for a user row that only has a bcrypt hash"""
+
+        try:
+            self.user_store.set_phone_key(phone_hash, self.phone_key)
+
+        except Exception as e:
+            logger.error("problem adding phone key to legacy user")
+            logger.error(e)
+            return False
+
+        logger.info("phone key added to legacy user")
+        return True
+
     def create_user(self) -> dict[str]:
         """A method to create a new Coder user and add them to the database."""
 
@@ -105,7 +159,7 @@ class MsgManager:
                 logger.error(f"failed to save new Coder user {creds['username']} to database. Deleting user.")
                 
                 # attempt to remove the newly created user from Coder to avoid a mess with the data
-                if Coder.delete_coder_user(creds['username']):
+                if Coder(creds['username']).delete_coder_user():
                     logger.info(f"Coder user {creds['username']} successfully deleted")
                 else:
                     logger.error(f"failed to delete Coder user {creds['username']}")
@@ -124,9 +178,7 @@ class MsgManager:
         """A private method to add a Coder user to the database."""
         
         try:
-            qry = db.insert(users).values([phone_hash, user_name, datetime.now().strftime("%Y-%m-%d %H:%M:%S")])
-            with self.db_engine.begin() as connection:
-                connection.execute(qry)
+            self.user_store.add_user(phone_hash, user_name, int(time()), self.gen_phone_key())
 
         except Exception as e:
             logger.error("problem adding user to the database")
@@ -140,32 +192,163 @@ class SMSWorker:
     """A class used to pick up inbound sms messages from the queue for processing"""
 
     @staticmethod
-    def sms_worker(kill_q: Queue, inbound_sms_q: Queue, db_engine: Engine):
-        """Method used to monitor a message queue and process sms messages passed into that queue"""
+    def sms_worker(inbound_sms_q: Queue, user_store: UserStore, acker: StreamAcker, twilio_send_q: TwilioSendQueue, idempotency_store: IdempotencyStore, stop: Event):
+        """
+            Method used to monitor a message queue and process sms messages passed into that queue.
 
-        while kill_q.empty():
-            try:
-                inbound_sms = inbound_sms_q.get(timeout=3)
-                sms_msg = MsgManager(inbound_sms["From"], inbound_sms["Body"], db_engine) 
-                if sms_msg.phone_num_valid:
-                    existing_user = sms_msg.check_for_matching_user()
-
-                    if existing_user:
-                        logger.info(f"user {existing_user} already exists")
-                    else:
-                        if sms_msg.verify_pass_phrase(): 
-                            logger.info(f"user does not exist and a correct pass phrase was provided. create a new user")
-                            if user_creds:= sms_msg.create_user():
-                                logger.info(f"successfully created new user")
-                                ts = TwilioSender()
-                                if ts.send_registration_sms(sms_msg.phone_num, sms_msg.phone_num_hash, user_creds["username"] + "@" + os.environ.get("CODER_EMAIL_DOM"), user_creds["pw"]):
-                                    logger.info(f"credentials sent for {user_creds['username']}")
-                                else:
-                                    logger.error(f"failed to send credentials to {user_creds['username']}")
-                            else: 
-                                logger.error(f"problem creating new user")
-                else:
-                    logger.warning(f"invalid phone number received")         
+            Several of these run at once, each watching its own shard of a ShardedQueue, so one slow Coder or Twilio call
+            only holds up the phone numbers that hash to the same shard.
+
+            Messages are only acknowledged in the redis stream once they have been processed - processed ids go to the acker, which
+            acknowledges them in batches. A message that created a user is only acknowledged once Twilio accepts its credentials sms,
+            and the acker holds it until then so the reclaimer doesn't take it while it waits in the send queue.
+            Anything that fails stays in the consumer group's pending entries list, where the listener's reclaimer will pick it up again.
+
+            On shutdown the supervisor only sets stop once the shard is empty (or the shutdown deadline is close), so messages already read from redis get finished.
+        """
 
+        while not stop.is_set():
+            beat()
+            try:
+                msg_id, inbound_sms = inbound_sms_q.get(timeout=1)
             except Empty:
-                logger.debug("sms inbound queue is empty")       
+                logger.debug("sms inbound queue is empty")
+                continue
+
+            try:
+                with process_latency.time():
+                    result = SMSWorker.process_sms(msg_id, inbound_sms, user_store, twilio_send_q, idempotency_store, acker)
+            except Exception as e:
+                logger.error(f"unexpected error processing message {msg_id}")
+                logger.error(e)
+                result = "retry"
+
+            processed_msgs.inc(result=result)
+            if result == "done":
+                acker.add(msg_id)
+            elif result == "retry":
+                logger.warning(f"message {msg_id} not processed - leaving it pending in the redis stream to be retried")
+
+    @staticmethod
+    def process_sms(msg_id: str, inbound_sms: dict, user_store: UserStore, twilio_send_q: TwilioSendQueue, idempotency_store: IdempotencyStore, acker: StreamAcker) -> str:
+        """
+            Static method that processes a single inbound sms message. Reply messages are handed to the twilio send queue rather than sent here.
+
+            The message's progress is saved in the idempotency store under its MessageSid, so a message we have seen before skips the steps
+            it already finished - no second Coder user, and no second credentials sms.
+
+            msg_id: the message's id in the redis stream.
+            acker: the stream acker - the message is held there while its credentials sms is queued, and acknowledged once Twilio accepts it.
+
+            Returns "done" if the message is done with (including messages we ignore), "sending" if its credentials sms is queued and the
+            message will be acknowledged once it is sent, or "retry" if it should be retried. Until then the message stays pending, so an sms
+            that never goes out (crash, shutdown, Twilio failing every attempt) is sent again when the message is reclaimed.
+        """
+
+        message_sid = inbound_sms.get("MessageSid")
+        saved_state = idempotency_store.get(message_sid)
+
+        if saved_state and saved_state.get("state") in ("sms_sent", "ignored"):
+            logger.info(f"message {message_sid} was already processed ({saved_state.get('state')})")
+            resumed_msgs.inc(state=saved_state.get("state"))
+            return "done"
+
+        if saved_state and saved_state.get("state") in ("user_created", "sms_queued"):
+            resumed_msgs.inc(state=saved_state.get("state"))
+            # another stream entry for the same MessageSid has the sms queued, and is acknowledged once it is sent. That entry is held while
+            # it waits, so it is only reclaimed (and the sms queued again) if the process holding it stops
+            if saved_state.get("state") == "sms_queued" and saved_state.get("stream_id") != msg_id:
+                logger.info(f"credentials for message {message_sid} are already queued by stream entry {saved_state.get('stream_id')}")
+                return "done"
+
+            logger.info(f"user {saved_state.get('username')} was already created for message {message_sid} - sending credentials")
+            pw = saved_state.get("pw")
+            # the password is only kept for REDIS_IDEMPOTENCY_PW_TTL seconds - past that the user gets a new one
+            if not pw:
+                if SMSWorker.coder_unavailable(message_sid):
+                    return "retry"
+                pw = Coder.gen_password()
+                if not Coder.set_user_password(saved_state.get("username"), pw):
+                    return "retry"
+                idempotency_store.set_state(message_sid, saved_state.get("state"), pw=pw)
+            return SMSWorker._queue_credentials(msg_id, message_sid, inbound_sms["From"], saved_state.get("phone_num_hash"), saved_state.get("username"), pw, twilio_send_q, idempotency_store, acker)
+
+        idempotency_store.set_state(message_sid, "received")
+
+        sms_msg = MsgManager(inbound_sms["From"], inbound_sms["Body"], user_store)
+        if not sms_msg.phone_num_valid:
+            logger.warning(f"invalid phone number received")
+            idempotency_store.set_state(message_sid, "ignored")
+            return "done"
+
+        with lookup_latency.time():
+            existing_user = sms_msg.check_for_matching_user()
+
+        # False means we couldn't read from the database - try again later
+        if existing_user is False:
+            return "retry"
+
+        if existing_user:
+            logger.info(f"user {existing_user} already exists")
+            idempotency_store.set_state(message_sid, "ignored")
+            return "done"
+
+        if not sms_msg.verify_pass_phrase():
+            idempotency_store.set_state(message_sid, "ignored")
+            return "done"
+
+        logger.info(f"user does not exist and a correct pass phrase was provided. create a new user")
+        if SMSWorker.coder_unavailable(message_sid):
+            return "retry"
+
+        with create_user_latency.time():
+            user_creds = sms_msg.create_user()
+
+        if user_creds:
+            logger.info(f"successfully created new user")
+            idempotency_store.set_state(message_sid, "user_created", username=user_creds["username"], pw=user_creds["pw"], phone_num_hash=sms_msg.phone_num_hash)
+            result = SMSWorker._queue_credentials(msg_id, message_sid, sms_msg.phone_num, sms_msg.phone_num_hash, user_creds["username"], user_creds["pw"], twilio_send_q, idempotency_store, acker)
+            logger.info(f"credentials queued for {user_creds['username']}")
+            return result
+
+        logger.error(f"problem creating new user")
+        return "retry"
+
+    @staticmethod
+    def coder_unavailable(message_sid: str) -> bool:
+        """
+            A static method that returns True while the Coder users circuit is open. Checked just before a message's Coder calls, so the
+            message is left pending in the redis stream (and the reclaimer, paused on the same circuit, picks it up once it closes) rather
+            than failed. Messages that don't need Coder - resends, and ones that are ignored - are handled as usual.
+        """
+
+        if Coder.breaker("users").is_open():
+            logger.warning(f"circuit {Coder.breaker('users').name} is open - leaving message {message_sid} pending in the redis stream")
+            return True
+
+        return False
+
+    @staticmethod
+    def _queue_credentials(msg_id: str, message_sid: str, phone_num: str, phone_num_hash: str, username: str, pw: str, twilio_send_q: TwilioSendQueue, idempotency_store: IdempotencyStore, acker: StreamAcker) -> str:
+        """
+            A private static method that queues a new user's credentials sms and records the message as sms_queued by this stream entry.
+
+            The message is held in the acker until the sms is sent (then it is acknowledged) or given up on (then it is released, and
+            reclaimed later to try again). Returns "sending".
+        """
+
+        idempotency_store.set_state(message_sid, "sms_queued", stream_id=msg_id)
+        acker.hold(msg_id)
+        twilio_send_q.enqueue_registration_sms(phone_num, phone_num_hash, username + "@" + Config.coder_email_dom, pw, on_sent=SMSWorker._on_sms_sent(idempotency_store, message_sid, partial(acker.add, msg_id)),
+                                               on_failed=partial(acker.release, msg_id), key=message_sid)
+        return "sending"
+
+    @staticmethod
+    def _on_sms_sent(idempotency_store: IdempotencyStore, message_sid: str, ack: Callable[[], None]) -> Callable[[], None]:
+        """A private static method that returns the twilio send queue callback for a credentials sms - saves that it went out, then acknowledges the message"""
+
+        def on_sent():
+            idempotency_store.set_state(message_sid, "sms_sent")
+            ack()
+
+        return on_sent
@@ -0,0 +1,52 @@
+from coder_sms_register.database import Queries
+from coder_sms_register.user_store import UserStore
+from sqlalchemy.engine import Engine
+
+
+class SQLUserStore(UserStore):
+    """A user store backed by the users table, through the shared SQLAlchemy engine (SQLite by default)"""
+
+    def __init__(self, db_engine: Engine):
+        self.db_engine = db_engine
+
+    def add_user(self, hash_id: str, username: str, create_stamp: int, phone_key: str) -> None:
+        with self.db_engine.begin() as connection:
+            connection.execute(Queries.insert_user, {"hash_id": hash_id, "username": username, "create_stamp": create_stamp, "phone_key": phone_key})
+
+    def get_username_by_phone_key(self, phone_key: str) -> str:
+        with self.db_engine.connect() as connection:
+            result_row = connection.execute(Queries.user_by_phone_key, {"phone_key": phone_key}).first()
+
+        return result_row[0] if result_row else None
+
+    def username_exists(self, username: str) -> bool:
+        with self.db_engine.connect() as connection:
+            return connection.execute(Queries.user_by_username, {"username": username}).first() is not None
+
+    def get_legacy_users(self) -> list[tuple[str, str]]:
+        with self.db_engine.connect() as connection:
+            return [(row[0], row[1]) for row in connection.execute(Queries.legacy_users).fetchall()]
+
+    def set_phone_key(self, hash_id: str, phone_key: str) -> None:
+        with self.db_engine.begin() as connection:
+            connection.execute(Queries.set_phone_key, {"b_hash_id": hash_id, "phone_key": phone_key})
+
+    def get_expired_users(self, cutoff: int, batch_size: int) -> list[dict]:
+        with self.db_engine.connect() as connection:
+            results = connection.execute(Queries.in_progress_users, {"batch_size": batch_size}).fetchall()
+            if len(results) < batch_size:
+                results = results + connection.execute(Queries.expired_users, {"cutoff": cutoff, "batch_size": batch_size - len(results)}).fetchall()
+
+        return [{"username": row[0], "create_stamp": row[1], "remove_state": row[2]} for row in results]
+
+    def get_next_create_stamp(self, cutoff: int) -> int:
+        with self.db_engine.connect() as connection:
+            return connection.execute(Queries.next_create_stamp, {"cutoff": cutoff}).scalar()
+
+    def set_remove_state(self, username: str, remove_state: str) -> None:
+        with self.db_engine.begin() as connection:
+            connection.execute(Queries.set_remove_state, {"b_username": username, "remove_state": remove_state})
+
+    def delete_user(self, username: str) -> None:
+        with self.db_engine.begin() as connection:
+            connection.execute(Queries.delete_user, {"username": username})
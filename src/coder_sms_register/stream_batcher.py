@@ -0,0 +1,177 @@
+from coder_sms_register.metrics import registry
+from typing import Callable, TYPE_CHECKING
+from time import monotonic
+import queue, threading, asyncio, redis
+
+# only needed for type hints - the flask api never loads redis.asyncio
+if TYPE_CHECKING:
+    import redis.asyncio as aioredis
+
+# Logging setup
+import logging
+logger = logging.getLogger(__name__)
+
+batch_size = registry.histogram("sms_api_xadd_batch_size", "messages published to the redis stream per pipeline flush", buckets=(1, 2, 5, 10, 20, 50, 100, 200))
+
+
+class StreamBatcher:
+    """
+        Collects XADDs from concurrent request threads and publishes them to the redis stream in a single pipeline, from one background thread.
+
+        A flush happens once max_batch messages are waiting, or max_wait_ms after the first message of the batch arrived - whichever is first.
+        Under a burst of webhooks this turns one round trip per message into one round trip per batch, and with light traffic a message
+        waits at most max_wait_ms longer than it would have.
+    """
+
+    def __init__(self, get_redis_conn: Callable[[], redis.Redis], stream_key: str, maxlen: int, max_batch: int, max_wait_ms: float):
+        self.get_redis_conn = get_redis_conn
+        self.stream_key = stream_key
+        self.maxlen = maxlen or None
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="xadd-batcher", daemon=True)
+        self.thread.start()
+
+    def xadd(self, msg: dict, timeout: float) -> bool:
+        """
+            Queues the message for the next flush and waits up to timeout seconds for it to be published.
+
+            Returns True if the message was published. Returns False if the XADD failed or didn't happen in time.
+        """
+
+        # [message, set once the flush is done, whether the XADD worked]
+        entry = [msg, threading.Event(), False]
+        self.pending.put(entry)
+
+        if not entry[1].wait(timeout):
+            logger.error(f"message was not published to redis stream {self.stream_key} within {timeout} seconds")
+            return False
+
+        return entry[2]
+
+    def run(self) -> None:
+        """A method that flushes batches of queued messages for as long as the process runs"""
+
+        while True:
+            batch = [self.pending.get()]
+            deadline = monotonic() + self.max_wait
+
+            while len(batch) < self.max_batch:
+                wait_time = deadline - monotonic()
+                if wait_time <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=wait_time))
+                except queue.Empty:
+                    break
+
+            self.flush(batch)
+
+    def flush(self, batch: list[list]) -> None:
+        """A method that publishes a batch of messages in one pipeline, then wakes up the request threads waiting on them"""
+
+        batch_size.observe(len(batch))
+        try:
+            pipe = self.get_redis_conn().pipeline(transaction=False)
+            for entry in batch:
+                pipe.xadd(self.stream_key, entry[0], "*", maxlen=self.maxlen, approximate=True)
+            results = pipe.execute(raise_on_error=False)
+
+            for entry, result in zip(batch, results):
+                entry[2] = not isinstance(result, Exception)
+                if isinstance(result, Exception):
+                    logger.error(f"problem publishing message to redis stream msg: {entry[0]}")
+                    logger.error(result)
+
+        except Exception as e:
+            logger.error(f"problem publishing a batch of {len(batch)} messages to redis stream {self.stream_key}")
+            logger.error(e)
+
+        finally:
+            for entry in batch:
+                entry[1].set()
+
+
+class AsyncStreamBatcher:
+    """
+        The asyncio version of StreamBatcher, for the ASGI app - collects XADDs from concurrent requests on one event loop and publishes
+        them in a single pipeline from a background task.
+    """
+
+    def __init__(self, redis_conn: "aioredis.Redis", stream_key: str, maxlen: int, max_batch: int, max_wait_ms: float):
+        self.redis_conn = redis_conn
+        self.stream_key = stream_key
+        self.maxlen = maxlen or None
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.pending = asyncio.Queue()
+        self.task = None
+
+    async def xadd(self, msg: dict, timeout: float) -> bool:
+        """
+            Queues the message for the next flush and waits up to timeout seconds for it to be published.
+
+            Returns True if the message was published. Returns False if the XADD failed or didn't happen in time.
+        """
+
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+        published = asyncio.get_running_loop().create_future()
+        await self.pending.put((msg, published))
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(published), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"message was not published to redis stream {self.stream_key} within {timeout} seconds")
+            return False
+
+    async def run(self) -> None:
+        """A method that flushes batches of queued messages until the task is cancelled"""
+
+        while True:
+            batch = [await self.pending.get()]
+            deadline = monotonic() + self.max_wait
+
+            while len(batch) < self.max_batch:
+                wait_time = deadline - monotonic()
+                if wait_time <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.pending.get(), wait_time))
+                except asyncio.TimeoutError:
+                    break
+
+            await self.flush(batch)
+
+    async def flush(self, batch: list[tuple]) -> None:
+        """A method that publishes a batch of messages in one pipeline, then resolves the futures the requests are waiting on"""
+
+        batch_size.observe(len(batch))
+        results = [False] * len(batch)
+        try:
+            async with self.redis_conn.pipeline(transaction=False) as pipe:
+                for msg, published in batch:
+                    pipe.xadd(self.stream_key, msg, "*", maxlen=self.maxlen, approximate=True)
+                pipe_results = await pipe.execute(raise_on_error=False)
+
+            for i, result in enumerate(pipe_results):
+                results[i] = not isinstance(result, Exception)
+                if isinstance(result, Exception):
+                    logger.error(f"problem publishing message to redis stream msg: {batch[i][0]}")
+                    logger.error(result)
+
+        except Exception as e:
+            logger.error(f"problem publishing a batch of {len(batch)} messages to redis stream {self.stream_key}")
+            logger.error(e)
+
+        finally:
+            for (msg, published), result in zip(batch, results):
+                if not published.done():
+                    published.set_result(result)
+
+    async def close(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
@@ -0,0 +1,236 @@
+from coder_sms_register.config import Config
+from coder_sms_register.metrics import registry
+from coder_sms_register.resilience import RetryPolicy
+from threading import Thread, Event, current_thread, main_thread
+from time import time, monotonic, sleep
+from typing import Callable
+import json, signal
+
+# Logging setup
+import logging
+logger = logging.getLogger(__name__)
+
+thread_restarts = registry.counter("supervisor_thread_restarts_total", "daemon threads restarted after they crashed or stopped on their own", labelnames=("thread",))
+
+# thread name -> unix time of the thread's last heartbeat
+heartbeats = {}
+
+
+def beat() -> None:
+    """Records a heartbeat for the calling thread - long running loops call it once per pass, so a stuck thread shows up in /healthz"""
+
+    heartbeats[current_thread().name] = time()
+
+
+class Service:
+    """A long running function the supervisor keeps running on its own thread"""
+
+    def __init__(self, name: str, target: Callable, args: list, kwargs: dict, stage: int, heartbeat_timeout: float):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs
+        self.stage = stage
+        self.heartbeat_timeout = heartbeat_timeout
+        self.thread = None
+        self.running = False
+        self.restarts = 0
+
+
+class Supervisor:
+    """
+        Runs the daemon's threads, restarts any that crash with backoff, and stops them in stages on shutdown.
+
+        Each thread's target is called with a stop keyword argument - a threading.Event for the thread's stage, which it checks each
+        pass and waits on instead of sleeping, so shutdown doesn't wait out a sleep. On shutdown the stages are stopped in order. A
+        stage with drained checks (e.g. the inbound sms queue size) keeps running until the earlier stages are stopped and its queues are
+        empty, so messages already read from redis are finished rather than left for the reclaimer. Everything has to stop within the
+        shutdown deadline - the supervisor's threads still running after it are abandoned (they are daemon threads), and their
+        unacknowledged messages are reclaimed from the redis stream later.
+
+        Thread pools the threads use (e.g. Coder's workspace delete executor) are not daemon threads - the interpreter joins them at exit.
+        Their shutdown hooks (add_shutdown_hook) run as soon as shutdown starts and should shut them down with cancel_futures, so only
+        requests already in flight, bounded by their timeouts, are waited on.
+    """
+
+    def __init__(self):
+        self.services = []
+        # stage -> [stop event, drained checks]
+        self.stages = {}
+        self.ready_checks = {}
+        self.shutdown_hooks = []
+        self.stopping = Event()
+        self.restart_policy = RetryPolicy(Config.supervisor_restart_base, Config.supervisor_restart_cap, float("inf"))
+
+    def add(self, name: str, target: Callable, args: list =(), kwargs: dict =None, stage: int =0, drained: Callable[[], int] =None, heartbeat_timeout: float =0) -> Service:
+        """
+            Adds a thread to be started by start(). target is called as target(*args, stop=<stage's stop event>, **kwargs).
+
+            drained: optional function returning how much work is still queued for this stage - the stage isn't stopped until it returns 0 (or the deadline passes).
+            heartbeat_timeout: seconds without a beat() before the thread counts as stuck - 0 for HEARTBEAT_TIMEOUT, None to only check the thread is alive.
+        """
+
+        if heartbeat_timeout == 0:
+            heartbeat_timeout = Config.heartbeat_timeout
+
+        if stage not in self.stages:
+            self.stages[stage] = [Event(), []]
+        if drained is not None:
+            self.stages[stage][1].append(drained)
+
+        service = Service(name, target, list(args), kwargs or {}, stage, heartbeat_timeout)
+        self.services.append(service)
+        return service
+
+    def add_ready_check(self, name: str, check: Callable[[], bool]) -> None:
+        """Adds a check /readyz runs, e.g. that redis answers a ping. An exception counts as not ready."""
+
+        self.ready_checks[name] = check
+
+    def add_shutdown_hook(self, hook: Callable[[], None]) -> None:
+        """Adds a function shutdown() calls before stopping any threads, e.g. to shut down a thread pool without waiting. An exception is logged and ignored."""
+
+        self.shutdown_hooks.append(hook)
+
+    def start(self) -> None:
+        for service in self.services:
+            service.thread = Thread(target=self._run, args=[service], name=service.name, daemon=True)
+            service.thread.start()
+
+    def _run(self, service: Service) -> None:
+        """A private method that runs a service's target until its stage is stopped, restarting it with backoff if it crashes or returns early"""
+
+        stop = self.stages[service.stage][0]
+        attempt = 0
+
+        while not stop.is_set():
+            started = monotonic()
+            service.running = True
+            beat()
+            try:
+                service.target(*service.args, stop=stop, **service.kwargs)
+            except Exception as e:
+                logger.error(f"thread {service.name} crashed")
+                logger.error(e)
+            service.running = False
+
+            if stop.is_set():
+                break
+
+            # a thread that ran for a good while before failing starts its backoff over
+            if monotonic() - started > self.restart_policy.cap:
+                attempt = 0
+            delay = self.restart_policy.backoff(attempt)
+            attempt += 1
+
+            logger.error(f"thread {service.name} stopped unexpectedly - restarting it in {delay:.1f} seconds")
+            service.restarts += 1
+            thread_restarts.inc(thread=service.name)
+            stop.wait(delay)
+
+    def install_signal_handlers(self) -> None:
+        """Makes SIGTERM (docker stop, rolling deploys) and SIGINT (ctrl + c) start a graceful shutdown. Only works from the main thread."""
+
+        if current_thread() is not main_thread():
+            logger.warning("not on the main thread - SIGTERM and SIGINT handlers not installed")
+            return None
+
+        def request_shutdown(signum, frame):
+            logger.warning(f"received {signal.Signals(signum).name} - shutting down")
+            self.stopping.set()
+
+        signal.signal(signal.SIGTERM, request_shutdown)
+        signal.signal(signal.SIGINT, request_shutdown)
+
+    def shutdown(self, deadline: float) -> bool:
+        """
+            Stops every thread, a stage at a time, within deadline seconds.
+
+            Returns True if every thread stopped in time. Returns False if some were still running at the deadline.
+        """
+
+        self.stopping.set()
+        end = monotonic() + deadline
+        logger.warning(f"stopping threads - giving them {deadline} seconds")
+
+        for hook in self.shutdown_hooks:
+            try:
+                hook()
+            except Exception as e:
+                logger.error("problem running shutdown hook")
+                logger.error(e)
+
+        for stage in sorted(self.stages):
+            stop, drained = self.stages[stage]
+
+            # let this stage finish the work the stages already stopped left for it
+            while monotonic() < end and any(check() for check in drained):
+                sleep(.1)
+            stop.set()
+
+            for service in self.services:
+                if service.stage == stage and service.thread is not None:
+                    service.thread.join(max(0, end - monotonic()))
+
+        still_running = [service.name for service in self.services if service.thread is not None and service.thread.is_alive()]
+        if still_running:
+            logger.error(f"threads still running after the {deadline} second shutdown deadline: {still_running} - their unacknowledged messages will be reclaimed")
+            return False
+
+        logger.info("all threads stopped")
+        return True
+
+    def thread_status(self) -> dict:
+        """Returns each thread's state - whether it is running, how many times it was restarted, and when it last beat"""
+
+        now = time()
+        status = {}
+        for service in self.services:
+            last_beat = heartbeats.get(service.name)
+            stale = service.heartbeat_timeout is not None and (last_beat is None or now - last_beat > service.heartbeat_timeout)
+            status[service.name] = {
+                "alive": service.running and service.thread is not None and service.thread.is_alive(),
+                "restarts": service.restarts,
+                "last_heartbeat": last_beat,
+                "stale": stale
+            }
+
+        return status
+
+    def live(self) -> bool:
+        """True if every thread is running and beating. Always True while shutting down, so the process isn't killed part way through."""
+
+        if self.stopping.is_set():
+            return True
+
+        return all(thread["alive"] and not thread["stale"] for thread in self.thread_status().values())
+
+    def ready(self) -> bool:
+        """True if the process is live, isn't shutting down, and every ready check passes"""
+
+        if self.stopping.is_set() or not self.live():
+            return False
+
+        for name, check in self.ready_checks.items():
+            try:
+                if not check():
+                    return False
+            except Exception as e:
+                logger.warning(f"ready check {name} failed")
+                logger.warning(e)
+                return False
+
+        return True
+
+    def healthz(self) -> tuple[int, str, str]:
+        """Liveness for the metrics server's /healthz - the status of every thread, with a 503 if any is dead or stuck"""
+
+        live = self.live()
+        body = {"status": "ok" if live else "failing", "stopping": self.stopping.is_set(), "threads": self.thread_status()}
+        return 200 if live else 503, "application/json", json.dumps(body)
+
+    def readyz(self) -> tuple[int, str, str]:
+        """Readiness for the metrics server's /readyz - a 503 while shutting down or when a ready check fails"""
+
+        ready = self.ready()
+        return 200 if ready else 503, "application/json", json.dumps({"status": "ready" if ready else "not ready"})
@@ -1,34 +1,53 @@
-import os, base64, requests, hashlib, hmac
+import base64, requests, threading, itertools, heapq
 from coder_sms_register.config import Config
-from datetime import datetime
-from time import sleep
+from coder_sms_register.metrics import registry
+from coder_sms_register.resilience import CircuitBreaker, RetryPolicy, next_retry_delay
+from coder_sms_register.supervisor import beat
+from requests.adapters import HTTPAdapter
+from time import sleep, monotonic, perf_counter
 from textwrap import dedent
+from threading import Event
+
+# kept importable from here - it lives in its own module so the sms api can check signatures without loading requests
+from coder_sms_register.twilio_signature import TwilioSignature
 
 # Logging setup
 import logging
 logger = logging.getLogger(__name__)
-logger.setLevel(Config.log_level)
-logger.addHandler(Config.file_handler)
-logger.addHandler(Config.stout_handler)
+
+send_latency = registry.histogram("twilio_send_seconds", "time spent on each request to send an sms via Twilio, by response status", labelnames=("endpoint", "status"))
+send_retries = registry.counter("twilio_send_retries_total", "sms sends retried after a failed attempt")
+send_failures = registry.counter("twilio_send_failed_total", "sms messages given up on after every attempt failed")
+
 
 class TwilioSender:
-    """Class for sending sms messages via Twilio's api"""
+    """Class for sending sms messages via Twilio's api - create one and reuse it, so requests share the session's keep-alive connections"""
 
     def __init__(self):
-        self.url = Config.twilio_url + "/" + os.environ.get("TWILIO_ACCOUNT_SID") + "/Messages.json"
+        self.url = Config.twilio_url + "/" + Config.twilio_account_sid + "/Messages.json"
         
-        basic_auth = os.environ.get("TWILIO_AUTH_SID") + ":" + os.environ.get("TWILIO_AUTH_TOKEN")
+        basic_auth = Config.twilio_auth_sid + ":" + Config.twilio_auth_token
         basic_auth_bytes = basic_auth.encode("utf-8")
         base64_bytes = base64.b64encode(basic_auth_bytes)
         base64_auth = base64_bytes.decode("ascii")
 
         self.headers = {"Authorization": "Basic " + base64_auth, "Content-Type": "application/x-www-form-urlencoded"}
-        self.from_phone = os.environ.get("FROM_NUM")
+        self.from_phone = Config.twilio_from_num
 
+        self.timeout = (Config.twilio_connect_timeout, Config.twilio_read_timeout)
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=Config.twilio_pool_size))
+        self.session.headers.update(self.headers)
 
-    def send_registration_sms(self, phone_num: str, phone_num_hash: str, user_email: str, pw: str) -> bool:
-        logger.info(f"attempting to send registration sms to {phone_num_hash}")
-        body = dedent(f"""
+        # shared with every other sender in the process, and with the asyncio sender
+        self.breaker = CircuitBreaker.get("twilio:messages")
+        self.retry_policy = RetryPolicy(Config.twilio_backoff_base, Config.twilio_backoff_cap, Config.retry_max_wait)
+
+    @staticmethod
+    def registration_body(user_email: str, pw: str) -> str:
+        """A static method that builds the body of the sms message containing a new user's credentials"""
+
+        return dedent(f"""
             Here are your credentials for coder.handsonproduct.com
                       
             email: {user_email}
@@ -36,6 +55,10 @@ class TwilioSender:
             pw: {pw}
             """.strip("\n"))
 
+    def send_registration_sms(self, phone_num: str, phone_num_hash: str, user_email: str, pw: str) -> bool:
+        logger.info(f"attempting to send registration sms to {phone_num_hash}")
+        body = TwilioSender.registration_body(user_email, pw)
+
         if not self.send_sms_with_retry(2, body, phone_num):
             logger.error(f"failed to send sub sms to {phone_num_hash}")
             return False
@@ -44,6 +67,28 @@ class TwilioSender:
  
  
     def send_sms(self, body: str, phone_num: str) -> bool:
+        if not self.breaker.allow_request():
+            logger.warning(f"circuit {self.breaker.name} is open - not sending sms")
+            return None
+
+        resp = self._post_sms(body, phone_num)
+        if resp is None:
+            return None
+
+        if resp.status_code != 201:
+            logger.error("twilio request to send sms failed status code: {0} content: {1}".format(resp.status_code, resp.content))
+            return None
+
+        logger.info("sms message successfully sent")
+        return True
+
+    def _post_sms(self, body: str, phone_num: str) -> requests.Response:
+        """
+            A private method that makes the request to Twilio and records the result with the circuit breaker.
+
+            Returns the response, or None if an exception occurs (SSL issue, timeout, etc).
+        """
+
         logger.info("attempting to send sms")
         
         req_body = {
@@ -52,8 +97,12 @@ class TwilioSender:
             "From": self.from_phone
         }
 
+        status = "error"
+        start = perf_counter()
         try:
-            resp = requests.post(url=self.url, headers=self.headers, data=req_body)
+            resp = self.session.post(url=self.url, data=req_body, timeout=self.timeout)
+            status = resp.status_code
+            return resp
         except requests.exceptions.Timeout:
             logger.warning("twilio request timed out")
             return None
@@ -64,70 +113,183 @@ class TwilioSender:
             logger.error("twilio request encountered an unexpected error")
             logger.error(e)
             return None
-
-        if resp.status_code != 201:
-            logger.error("twilio request to send sms failed status code: {0} content: {1}".format(resp.status_code, resp.content))
-            return None
-
-        logger.info("sms message successfully sent")
-        return True
+        finally:
+            send_latency.labels(endpoint="messages", status=status).observe(perf_counter() - start)
+            self.breaker.record(None if status == "error" else status)
 
 
     def send_sms_with_retry(self, attempts: int, body: str, phone_num: str) -> bool:
-        # attempts = total attempts, not just retries
+        # attempts = total attempts, not just retries. Only timeouts, 429s and 5xx responses are retried.
         for i in range(0, attempts):
-            sms_result = self.send_sms(body, phone_num)
-            if sms_result:
-                return sms_result
-            if i < max(range(0, attempts)):
-                logger.warning("wait before we retry")
-                sleep(1.5 + (i * 10))
-                logger.warning("retrying twilio api call")
-        logger.error("sms send exceeded the max number of attempts - max atempts: {0}".format(attempts))
-        return None
+            if not self.breaker.allow_request():
+                logger.warning(f"circuit {self.breaker.name} is open - not sending sms")
+                break
+
+            resp = self._post_sms(body, phone_num)
+            if resp is not None and resp.status_code == 201:
+                logger.info("sms message successfully sent")
+                return True
+
+            if resp is not None:
+                logger.error("twilio request to send sms failed status code: {0} content: {1}".format(resp.status_code, resp.content))
 
+            delay = next_retry_delay(self.retry_policy, i, attempts, resp)
+            if delay is None:
+                break
 
-class TwilioSignature:
-    """Class used to verify inbound SMS message signatures from Twilio"""
+            logger.warning(f"wait {delay:.1f} seconds before we retry")
+            sleep(delay)
+            logger.warning("retrying twilio api call")
+            send_retries.inc()
 
-    def __init__(self, request_body, headers: dict):
-        self.request_body = request_body
-        self.headers = headers
-    
-    def _get_header_sig(self) -> str:
-        if self.headers.get("X-Twilio-Signature"):
-            return self.headers.get("X-Twilio-Signature")        
-        logger.warning("twilio signature header is missing")
+        send_failures.inc()
+        logger.error("giving up on sms send after {0} of {1} attempts".format(i + 1, attempts))
         return None
-    
-    def _create_param_str(self) -> str:
-        req_body_dict = self.request_body.form.to_dict()
-        keys = list(req_body_dict.keys())
-        keys.sort()
-        param_str = ""
-        for key in keys:
-            param_str = param_str + key + req_body_dict.get(key)
-        
-        return param_str
-    
-    def _create_signature(self) -> str:
-        key = bytes(os.environ.get("TWILIO_ACCOUNT_TOKEN"), "UTF-8")
-        contents = bytes(os.environ.get("TWILIO_WEBHOOK_URL") + self._create_param_str(), "UTF-8")
-        hmac_obj = hmac.new(key, contents, hashlib.sha1)
-        signature = hmac_obj.digest()
-        # encode hmac signature to base64, then decode bytes to be a utf-8 string
-        signature_base64_str = base64.b64encode(signature).decode('UTF-8')
-
-        return signature_base64_str
-    
-    def compare_signatures(self) -> bool:
-        header_signature = self._get_header_sig()
-        if not header_signature:
-            logger.warning("request header signature not present")
-            return False
-        
-        if header_signature == self._create_signature():
-            logger.info("request signature matches what is expected")
-            return True
-        
-        return False
+
+
+class TwilioSendQueue:
+    """
+        A rate limited queue of outbound sms messages, sent by a single background thread (run).
+
+        Sends are spaced out to stay under Twilio's messages per second limit for our from number. Timeouts, 429s and 5xx responses
+        are retried later with jittered exponential backoff, without holding up the thread that queued the message. While Twilio's
+        circuit breaker is open, jobs are put back to wait for it rather than spending their attempts.
+    """
+
+    def __init__(self, twilio_sender: TwilioSender, messages_per_sec: float, max_attempts: int):
+        self.twilio_sender = twilio_sender
+        self.send_interval = 1 / messages_per_sec
+        self.max_attempts = max_attempts
+        self._jobs = [] # heap of (time the job can be sent, tie breaker, job)
+        self._job_count = itertools.count()
+        self._jobs_cond = threading.Condition()
+        self._next_send_time = 0.0
+        self._keys = set() # keys of the jobs queued or being sent, so a redelivered message doesn't queue its sms twice
+        # jobs wait in the heap rather than on a thread, so any Retry-After Twilio asks for can be honoured
+        self.retry_policy = RetryPolicy(Config.twilio_backoff_base, Config.twilio_backoff_cap, float("inf"))
+
+    def enqueue_registration_sms(self, phone_num: str, phone_num_hash: str, user_email: str, pw: str, on_sent=None, on_failed=None, key: str =None) -> bool:
+        """A method that queues the sms message containing a new user's credentials"""
+
+        logger.info(f"queueing registration sms to {phone_num_hash}")
+        return self.enqueue(phone_num, TwilioSender.registration_body(user_email, pw), phone_num_hash, on_sent, on_failed, key)
+
+    def enqueue(self, phone_num: str, body: str, phone_num_hash: str =None, on_sent=None, on_failed=None, key: str =None) -> bool:
+        """
+            A method that queues an sms message to be sent as soon as the rate limit allows.
+
+            on_sent: optional function called with no arguments once Twilio accepts the message.
+            on_failed: optional function called with no arguments if the message is given up on.
+            key: optional id for the message (e.g. the inbound MessageSid) - while a message with the same key is still queued, this one
+            is dropped and False is returned.
+        """
+
+        with self._jobs_cond:
+            if key is not None and key in self._keys:
+                logger.info(f"sms to {phone_num_hash} is already queued - not queueing it again")
+                return False
+            if key is not None:
+                self._keys.add(key)
+
+        job = {"phone_num": phone_num, "body": body, "phone_num_hash": phone_num_hash, "on_sent": on_sent, "on_failed": on_failed, "key": key, "attempt": 0}
+        self._schedule(job, monotonic())
+        return True
+
+    def qsize(self) -> int:
+        with self._jobs_cond:
+            return len(self._jobs)
+
+    def due(self) -> int:
+        """
+            A method that returns how many queued messages are ready to send now - not ones waiting out a retry delay or an open circuit.
+
+            Shutdown only waits for these. A message left in the queue is still pending in the redis stream, so it is sent again once reclaimed.
+        """
+
+        now = monotonic()
+        with self._jobs_cond:
+            return sum(1 for ready_time, _, _ in self._jobs if ready_time <= now)
+
+    def run(self, stop: Event) -> None:
+        """A method that sends queued messages until stop is set"""
+
+        while not stop.is_set():
+            beat()
+            job = self._next_ready_job(timeout=1)
+            if job is None:
+                continue
+
+            # space the requests out to honour the messages per second limit
+            wait_time = self._next_send_time - monotonic()
+            if wait_time > 0:
+                sleep(wait_time)
+            self._next_send_time = monotonic() + self.send_interval
+
+            self._send(job)
+
+        if self.qsize() > 0:
+            logger.warning(f"sms send queue stopped with {self.qsize()} messages not sent")
+
+    def _schedule(self, job: dict, ready_time: float) -> None:
+        with self._jobs_cond:
+            heapq.heappush(self._jobs, (ready_time, next(self._job_count), job))
+            self._jobs_cond.notify()
+
+    def _next_ready_job(self, timeout: float) -> dict:
+        """A private method that waits up to timeout seconds for a job that is ready to send. Returns None if there isn't one."""
+
+        deadline = monotonic() + timeout
+        with self._jobs_cond:
+            while True:
+                now = monotonic()
+                if self._jobs and self._jobs[0][0] <= now:
+                    return heapq.heappop(self._jobs)[2]
+
+                wait_time = deadline - now
+                if self._jobs:
+                    wait_time = min(wait_time, self._jobs[0][0] - now)
+                if wait_time <= 0:
+                    return None
+
+                self._jobs_cond.wait(wait_time)
+
+    def _send(self, job: dict) -> None:
+        breaker = self.twilio_sender.breaker
+        if not breaker.allow_request():
+            logger.warning(f"circuit {breaker.name} is open - holding sms to {job['phone_num_hash']}")
+            self._schedule(job, monotonic() + max(1, breaker.retry_in()))
+            return None
+
+        job["attempt"] += 1
+        resp = self.twilio_sender._post_sms(job["body"], job["phone_num"])
+
+        if resp is not None and resp.status_code == 201:
+            logger.info(f"sms message successfully sent to {job['phone_num_hash']}")
+            self._done(job)
+            if job["on_sent"]:
+                job["on_sent"]()
+            return None
+
+        if resp is not None:
+            logger.error("twilio request to send sms failed status code: {0} content: {1}".format(resp.status_code, resp.content))
+
+        # timeouts, connection errors, rate limiting and server errors may work next time - other 4xx responses won't.
+        # full jitter exponential backoff, but never sooner than Twilio asked for
+        backoff = self.retry_policy.delay(job["attempt"], resp.status_code if resp is not None else None, resp.headers if resp is not None else None)
+        if backoff is None or job["attempt"] >= self.max_attempts:
+            logger.error(f"failed to send sms to {job['phone_num_hash']} after {job['attempt']} attempts")
+            send_failures.inc()
+            self._done(job)
+            if job["on_failed"]:
+                job["on_failed"]()
+            return None
+
+        logger.warning(f"retrying sms to {job['phone_num_hash']} in {backoff:.1f} seconds")
+        send_retries.inc()
+        self._schedule(job, monotonic() + backoff)
+
+    def _done(self, job: dict) -> None:
+        """A private method that frees the job's key once it has been sent or given up on, so the message can be queued again"""
+
+        with self._jobs_cond:
+            self._keys.discard(job["key"])
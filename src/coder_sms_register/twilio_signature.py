@@ -0,0 +1,64 @@
+from coder_sms_register.config import Config
+import base64, hashlib, hmac, threading
+
+# Logging setup
+import logging
+logger = logging.getLogger(__name__)
+
+
+class TwilioSignature:
+    """Class used to verify inbound SMS message signatures from Twilio"""
+
+    # HMAC-SHA1 keyed with the account token, and the webhook url every signature starts with - built once per process on first use
+    _hmac_base = None
+    _webhook_url = None
+    _init_lock = threading.Lock()
+
+    def __init__(self, request_body, headers: dict):
+        """request_body: the flask request, or the form parameters already parsed into a dict (e.g. by the ASGI app)"""
+
+        self.request_body = request_body
+        self.headers = headers
+
+    @staticmethod
+    def _get_hmac_base():
+        if TwilioSignature._hmac_base is None:
+            with TwilioSignature._init_lock:
+                if TwilioSignature._hmac_base is None:
+                    TwilioSignature._webhook_url = Config.twilio_webhook_url
+                    TwilioSignature._hmac_base = hmac.new(bytes(Config.twilio_account_token, "UTF-8"), digestmod=hashlib.sha1)
+
+        return TwilioSignature._hmac_base
+    
+    def _get_header_sig(self) -> str:
+        if self.headers.get("X-Twilio-Signature"):
+            return self.headers.get("X-Twilio-Signature")        
+        logger.warning("twilio signature header is missing")
+        return None
+    
+    def _create_param_str(self) -> str:
+        req_body_dict = self.request_body if isinstance(self.request_body, dict) else self.request_body.form.to_dict()
+        return "".join(key + req_body_dict[key] for key in sorted(req_body_dict))
+    
+    def _create_signature(self) -> str:
+        # copying the keyed HMAC skips hashing the key again for every request
+        hmac_obj = TwilioSignature._get_hmac_base().copy()
+        hmac_obj.update(bytes(TwilioSignature._webhook_url + self._create_param_str(), "UTF-8"))
+        signature = hmac_obj.digest()
+        # encode hmac signature to base64, then decode bytes to be a utf-8 string
+        signature_base64_str = base64.b64encode(signature).decode('UTF-8')
+
+        return signature_base64_str
+    
+    def compare_signatures(self) -> bool:
+        header_signature = self._get_header_sig()
+        if not header_signature:
+            logger.warning("request header signature not present")
+            return False
+        
+        # constant time compare, so response timing doesn't leak how much of a forged signature was right
+        if hmac.compare_digest(header_signature.encode("UTF-8"), self._create_signature().encode("UTF-8")):
+            logger.info("request signature matches what is expected")
+            return True
+        
+        return False
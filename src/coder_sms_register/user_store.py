@@ -0,0 +1,163 @@
+from coder_sms_register.config import Config
+from abc import ABC, abstractmethod
+import redis
+
+
+class UserStore(ABC):
+    """
+        Where coder sms register keeps track of the users it created. MsgManager and UserMgr only talk to this interface.
+
+        Methods raise on storage errors - callers decide how to log and recover.
+    """
+
+    @staticmethod
+    def create(redis_conn: redis.Redis =None) -> "UserStore":
+        """
+            A static method that builds the store picked by CODER_REG_STORE. The redis store uses redis_conn, which must decode responses,
+            or its own connection if one isn't passed in. The sql store creates the database if it doesn't already exist and brings older databases up to date.
+        """
+
+        if Config.user_store == "redis":
+            if redis_conn is None:
+                redis_conn = redis.Redis(host=Config.redis_host, port=Config.redis_port, db=Config.redis_db, password=Config.redis_pw, decode_responses=True)
+            return RedisUserStore(redis_conn)
+
+        if Config.user_store != "sql":
+            raise ValueError(f"unknown CODER_REG_STORE: {Config.user_store} - expected 'sql' or 'redis'")
+
+        # imported here so SQLAlchemy is only loaded by processes that use the sql store
+        from coder_sms_register.sql_user_store import SQLUserStore
+        from coder_sms_register.database import Database
+
+        return SQLUserStore(Database.init_db())
+
+    @abstractmethod
+    def add_user(self, hash_id: str, username: str, create_stamp: int, phone_key: str) -> None:
+        """Save a newly created user. create_stamp is epoch seconds."""
+
+    @abstractmethod
+    def get_username_by_phone_key(self, phone_key: str) -> str:
+        """Returns the username for the phone key, or None if there isn't one"""
+
+    @abstractmethod
+    def username_exists(self, username: str) -> bool:
+        """Returns True if a user with this username is in the store"""
+
+    @abstractmethod
+    def get_legacy_users(self) -> list[tuple[str, str]]:
+        """Returns (bcrypt hash_id, username) for users saved before phone keys existed"""
+
+    @abstractmethod
+    def set_phone_key(self, hash_id: str, phone_key: str) -> None:
+        """Fill in the phone key for a legacy user - a no-op for stores that can't have legacy users"""
+
+    @abstractmethod
+    def get_expired_users(self, cutoff: int, batch_size: int) -> list[dict]:
+        """Returns up to batch_size users already being removed, then users created before the cutoff, oldest first, as dicts with username, create_stamp and remove_state"""
+
+    @abstractmethod
+    def get_next_create_stamp(self, cutoff: int) -> int:
+        """Returns the oldest create_stamp at or after the cutoff, or None if there isn't one"""
+
+    @abstractmethod
+    def set_remove_state(self, username: str, remove_state: str) -> None:
+        """Save where a user is in being removed from Coder"""
+
+    @abstractmethod
+    def delete_user(self, username: str) -> None:
+        """Remove a user from the store"""
+
+
+class RedisUserStore(UserStore):
+    """
+        A user store kept in redis, so several coder sms register processes on different nodes can share it.
+
+        Keys (all under the configured prefix):
+            <prefix>:user:<username>  - hash with hash_id, username, create_stamp, phone_key and remove_state
+            <prefix>:phone_keys       - hash of phone_key -> username
+            <prefix>:expiry           - sorted set of usernames not being removed yet, scored by create_stamp
+            <prefix>:removing         - sorted set of usernames being removed, scored by create_stamp
+    """
+
+    # claim the phone key, the same way the unique index does in SQL, and save the user in the same step - so a crash or a lost
+    # connection can't leave a claimed phone key with no user behind it. Returns 0 if the phone key already belongs to someone.
+    _add_user_script = """
+        if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 0 then
+            return 0
+        end
+        redis.call('HSET', KEYS[2], 'hash_id', ARGV[3], 'username', ARGV[2], 'create_stamp', ARGV[4], 'phone_key', ARGV[1])
+        redis.call('ZADD', KEYS[3], ARGV[4], ARGV[2])
+        return 1
+    """
+
+    def __init__(self, redis_conn: redis.Redis, key_prefix: str =None):
+        self.redis_conn = redis_conn
+        key_prefix = key_prefix or Config.redis_user_key_prefix
+        self.user_key_prefix = key_prefix + ":user:"
+        self.phone_keys_key = key_prefix + ":phone_keys"
+        self.expiry_key = key_prefix + ":expiry"
+        self.removing_key = key_prefix + ":removing"
+
+        self._add_user = redis_conn.register_script(RedisUserStore._add_user_script)
+
+    def add_user(self, hash_id: str, username: str, create_stamp: int, phone_key: str) -> None:
+        if not self._add_user(keys=[self.phone_keys_key, self.user_key_prefix + username, self.expiry_key], args=[phone_key, username, hash_id, create_stamp]):
+            raise Exception("a user already exists for this phone key")
+
+    def get_username_by_phone_key(self, phone_key: str) -> str:
+        return self.redis_conn.hget(self.phone_keys_key, phone_key)
+
+    def username_exists(self, username: str) -> bool:
+        return bool(self.redis_conn.exists(self.user_key_prefix + username))
+
+    def get_legacy_users(self) -> list[tuple[str, str]]:
+        # users have always had a phone key in redis
+        return []
+
+    def set_phone_key(self, hash_id: str, phone_key: str) -> None:
+        # every redis user is saved with its phone key, so get_legacy_users never returns one to backfill - nothing to do
+        return None
+
+    def get_expired_users(self, cutoff: int, batch_size: int) -> list[dict]:
+        usernames = self.redis_conn.zrange(self.removing_key, 0, batch_size - 1)
+        if len(usernames) < batch_size:
+            usernames = usernames + self.redis_conn.zrangebyscore(self.expiry_key, "-inf", f"({cutoff}", start=0, num=batch_size - len(usernames))
+
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for username in usernames:
+            pipe.hmget(self.user_key_prefix + username, ["username", "create_stamp", "remove_state"])
+
+        user_list = []
+        for user in pipe.execute():
+            # skip users deleted between the two calls
+            if user[0] is not None:
+                user_list.append({"username": user[0], "create_stamp": int(user[1]), "remove_state": user[2]})
+
+        return user_list
+
+    def get_next_create_stamp(self, cutoff: int) -> int:
+        next_user = self.redis_conn.zrangebyscore(self.expiry_key, cutoff, "+inf", start=0, num=1, withscores=True)
+        return int(next_user[0][1]) if next_user else None
+
+    def set_remove_state(self, username: str, remove_state: str) -> None:
+        create_stamp = self.redis_conn.zscore(self.expiry_key, username)
+        if create_stamp is None:
+            create_stamp = self.redis_conn.zscore(self.removing_key, username)
+
+        pipe = self.redis_conn.pipeline(transaction=True)
+        pipe.hset(self.user_key_prefix + username, "remove_state", remove_state)
+        if create_stamp is not None:
+            pipe.zrem(self.expiry_key, username)
+            pipe.zadd(self.removing_key, {username: create_stamp})
+        pipe.execute()
+
+    def delete_user(self, username: str) -> None:
+        phone_key = self.redis_conn.hget(self.user_key_prefix + username, "phone_key")
+
+        pipe = self.redis_conn.pipeline(transaction=True)
+        pipe.delete(self.user_key_prefix + username)
+        if phone_key:
+            pipe.hdel(self.phone_keys_key, phone_key)
+        pipe.zrem(self.expiry_key, username)
+        pipe.zrem(self.removing_key, username)
+        pipe.execute()
@@ -1,60 +1,76 @@
 from coder_sms_register.config import Config
 from coder_sms_register.coder import Coder
-from coder_sms_register.models import users
-from queue import Queue
-import sqlalchemy as db
-from sqlalchemy.engine import Engine
-from datetime import datetime, timedelta
-from time import sleep
-import os
+from coder_sms_register.user_store import UserStore
+from coder_sms_register.metrics import registry
+from coder_sms_register.leader import LeaderLease
+from coder_sms_register.supervisor import beat
+from threading import Event
+from time import sleep, monotonic, time
+from concurrent.futures import ThreadPoolExecutor
 
 # Logging setup
 import logging
 logger = logging.getLogger(__name__)
-logger.setLevel(Config.log_level)
-logger.addHandler(Config.file_handler)
-logger.addHandler(Config.stout_handler)
+
+users_pending_removal = registry.gauge("users_pending_removal", "expired users part way through removal from the Coder server, as of the last check")
+users_removed = registry.counter("users_removed_total", "users removed from the Coder server and the user store")
 
 class UserMgr:
 
-    def __init__(self, db_engine: Engine):
-        self.db_engine = db_engine
+    def __init__(self, user_store: UserStore):
+        self.user_store = user_store
 
-    def get_users(self) -> bool:
-        """Method to fetch all users from the database and sets the users property of the UserMgr object.
+    def get_expired_users(self, cutoff: int, batch_size: int) -> bool:
+        """Method to fetch users created before the cutoff (epoch seconds), or already being removed, oldest first, and set the users property of the UserMgr object.
         
         Returns True if no errors were encountered while fetching users. Returns False if an exception occurs."""
 
         self.users = None
 
         try:
-            qry = db.select(users)
-            
-            with self.db_engine.connect() as connection:
-                results_obj = connection.execute(qry)
-                results = results_obj.fetchall()
+            user_list = self.user_store.get_expired_users(cutoff, batch_size)
         except Exception as e:
             logger.error("problem fetching users from the database")
             logger.error(e)
             return False
         
-        user_list = []
-        if len(results) == 0:
-            logger.info("no users in the db")
+        if len(user_list) == 0:
+            logger.info("no expired users in the db")
 
         else:
-            for row in results:
-                user_list.append({"username": row[1], "create_stamp": row[2]})
-            logger.info(f"fetched {len(user_list)} users from db")
+            logger.info(f"fetched {len(user_list)} expired users from db")
             
         self.users = user_list       
         return True
+
+    def get_next_create_stamp(self, cutoff: int) -> int:
+        """Method that returns the oldest create_stamp at or after the cutoff, i.e. the next user to expire. Returns None if there isn't one or an exception occurs."""
+
+        try:
+            return self.user_store.get_next_create_stamp(cutoff)
+
+        except Exception as e:
+            logger.error("problem fetching the next user to expire from the database")
+            logger.error(e)
+            return None
+
+    def set_remove_state(self, username: str, remove_state: str) -> bool:
+        """Method to save where a user is in being removed from Coder, so removal picks up where it left off after a restart"""
+
+        try:
+            self.user_store.set_remove_state(username, remove_state)
+
+        except Exception as e:
+            logger.error(f"problem saving remove state {remove_state} for user: {username}")
+            logger.error(e)
+            return False
+
+        logger.info(f"user: {username} remove state is now {remove_state}")
+        return True
         
     def delete_user(self, username: str) -> bool:
         try:
-            qry = db.delete(users).where(users.c.username == username)
-            with self.db_engine.begin() as connection:
-                connection.execute(qry)
+            self.user_store.delete_user(username)
             
         except Exception as e:
             logger.error(f"problem deleting user: {username} from the db")
@@ -69,27 +85,187 @@ class UserWorker:
     """A class to house the method used to manage user removal from the Coder server"""
 
     @staticmethod
-    def user_worker(kill_q: Queue, db_engine: Engine) -> None:
-        """A static method that looks for users to remove from the coder server based on the configured interval set as an environment variable"""
+    def user_worker(user_store: UserStore, stop: Event, lease: LeaderLease =None) -> None:
+        """
+            A static method that looks for users to remove from the coder server based on the configured interval set as an environment variable.
+
+            Removing a user is a series of steps (expired -> workspaces_deleting -> user_deleting -> done) saved in the database. Each pass moves
+            every user one step forward, and checks back sooner while any removal is in progress, rather than waiting on one user at a time.
+
+            lease: with several replicas, only the process holding the leader lease removes users. The others wait here to take over.
+        """
         
-        while kill_q.empty():
+        executor = ThreadPoolExecutor(max_workers=Config.coder_cleanup_workers, thread_name_prefix="user-cleanup")
+        try:
+            UserWorker._user_worker(executor, user_store, stop, lease)
+        finally:
+            # don't wait on users still being stepped - the pool's threads aren't daemon threads, and the interpreter joins them at exit.
+            # Steps that haven't started are cancelled, and a user left part way through carries on from its saved state next time
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _user_worker(executor: ThreadPoolExecutor, user_store: UserStore, stop: Event, lease: LeaderLease =None) -> None:
+        """A private static method with the user_worker loop, so user_worker can shut the executor down however the loop ends"""
+
+        while not stop.is_set():
+            beat()
+            if lease is not None and not lease.is_leader():
+                logger.debug("not the leader - waiting to take over user cleanup")
+                stop.wait(1)
+                continue
+
             logger.info("starting routine to check for Coder user that need to be deleted")
-            user_mgr = UserMgr(db_engine)
-            if user_mgr.get_users():
-                removed_user_count = 0
-                for user in user_mgr.users:
-                    if datetime.strptime(user.get("create_stamp"), "%Y-%m-%d %H:%M:%S") + timedelta(minutes=int(os.environ.get("CODER_REMOVE_TIME"))) < datetime.now():
-                        coder = Coder(user.get("username"))
-                        if coder.remove_user():
-                            logger.info("user removed from Coder server - now remove from db")
-                            if user_mgr.delete_user(user.get("username")):
-                                logger.info("user removed from db")
-                                removed_user_count = removed_user_count + 1
-                            else:
-                                logger.error(f"user {user.get('username')} has been removed from the Coder server but is still in the db")
+            user_mgr = UserMgr(user_store)
+            remove_secs = Config.coder_remove_time * 60
+            removed_user_count = 0
+            in_progress_count = 0
+            if user_mgr.get_expired_users(int(time()) - remove_secs, Config.coder_cleanup_batch):
+                results = UserWorker.advance_users(executor, user_mgr, user_mgr.users, lease)
+                removed_user_count = list(results.values()).count("removed")
+                in_progress_count = len(results) - removed_user_count - list(results.values()).count(None)
+                users_pending_removal.set(in_progress_count)
+                users_removed.inc(removed_user_count)
+
             if removed_user_count < 1:
                 logger.info("no users removed")
             else:
                 logger.info(f"{removed_user_count} users removed")
 
-            sleep(int(os.environ.get("CODER_CHECK_INTERVAL")))
+            # check back sooner while users are part way through removal
+            if in_progress_count > 0:
+                logger.info(f"{in_progress_count} users are being removed")
+                sleep_time = Config.coder_remove_poll_interval
+
+            # otherwise sleep until the next user expires - with no users at all, fall back to the check interval
+            elif next_create_stamp:= user_mgr.get_next_create_stamp(int(time()) - remove_secs):
+                sleep_time = max(1, next_create_stamp + remove_secs - int(time()) + 1)
+                logger.info(f"next user expires in {sleep_time} seconds")
+            else:
+                sleep_time = Config.coder_check_interval
+
+            # wait a second at a time so we notice losing the lease, and keep beating through long waits
+            for i in range(0, sleep_time):
+                if stop.wait(1) or (lease is not None and lease.token is None):
+                    break
+                beat()
+
+    @staticmethod
+    def advance_users(executor: ThreadPoolExecutor, user_mgr: UserMgr, user_list: list[dict], lease: LeaderLease =None) -> dict[str, str]:
+        """
+            A static method that moves each user in user_list one step through removal, several users at a time.
+
+            Returns a dict of username -> the result of advance_user for that user.
+        """
+
+        futures = {}
+        for user in user_list:
+            futures[user.get("username")] = executor.submit(UserWorker.advance_user, user_mgr, user.get("username"), user.get("create_stamp"), user.get("remove_state"), lease)
+
+        results = {}
+        for username, future in futures.items():
+            try:
+                results[username] = future.result()
+            except Exception as e:
+                logger.error(f"unexpected error removing user {username}")
+                logger.error(e)
+                results[username] = "error"
+
+        return results
+
+    @staticmethod
+    def cleanup_users(user_store: UserStore, limit: int, timeout: int) -> dict:
+        """
+            A static method that removes up to limit expired users as fast as the Coder server allows, e.g. to drain a backlog after an outage.
+
+            Keeps stepping the chosen users until they are all removed or timeout seconds pass. Returns a summary including users removed per second.
+        """
+
+        user_mgr = UserMgr(user_store)
+        remove_secs = Config.coder_remove_time * 60
+        if not user_mgr.get_expired_users(int(time()) - remove_secs, limit):
+            return None
+
+        start = monotonic()
+        executor = ThreadPoolExecutor(max_workers=Config.coder_cleanup_workers, thread_name_prefix="user-cleanup")
+
+        remaining = [user.get("username") for user in user_mgr.users]
+        to_advance = user_mgr.users
+        removed = []
+        logger.info(f"cleaning up {len(remaining)} users")
+
+        while remaining and monotonic() - start < timeout:
+            results = UserWorker.advance_users(executor, user_mgr, to_advance)
+            newly_removed = [username for username, result in results.items() if result == "removed"]
+            users_removed.inc(len(newly_removed))
+            removed.extend(newly_removed)
+            remaining = [username for username in remaining if username not in removed]
+
+            if not remaining:
+                break
+
+            sleep(Config.coder_remove_poll_interval)
+            if not user_mgr.get_expired_users(int(time()) - remove_secs, limit):
+                break
+            to_advance = [user for user in user_mgr.users if user.get("username") in remaining]
+
+        executor.shutdown()
+
+        elapsed = monotonic() - start
+        summary = {
+            "users": len(remaining) + len(removed),
+            "removed": len(removed),
+            "seconds": round(elapsed, 2),
+            "users_per_second": round(len(removed) / elapsed, 3) if elapsed > 0 else 0
+        }
+        logger.info(f"cleanup finished: {summary}")
+        return summary
+
+    @staticmethod
+    def is_due(create_stamp: int, remove_state: str) -> bool:
+        """A static method that returns True if the user has expired or is already being removed"""
+
+        if remove_state is not None:
+            return True
+
+        return create_stamp + Config.coder_remove_time * 60 < time()
+
+    @staticmethod
+    def advance_user(user_mgr: UserMgr, username: str, create_stamp: int, remove_state: str, lease: LeaderLease =None) -> str:
+        """
+            A static method that moves one user a single step through removal and saves the new state.
+
+            Returns None if the user hasn't expired, "removed" once the user is gone from Coder and the db, otherwise the user's remove state.
+        """
+
+        # fencing - a leader that lost its lease part way through a pass leaves the rest of the users to the new leader
+        if lease is not None and not lease.is_leader():
+            logger.warning(f"no longer the leader - leaving user {username} for the new leader")
+            return remove_state
+
+        if remove_state is None:
+            if not UserWorker.is_due(create_stamp, remove_state):
+                return None
+
+            logger.info(f"user {username} has expired")
+            return "expired" if user_mgr.set_remove_state(username, "expired") else None
+
+        if remove_state != "done":
+            coder = Coder(username)
+            new_state = coder.remove_user_step(remove_state)
+            if new_state == remove_state:
+                return remove_state
+
+            if not user_mgr.set_remove_state(username, new_state):
+                return remove_state
+
+            if new_state != "done":
+                return new_state
+
+            logger.info("user removed from Coder server - now remove from db")
+
+        if user_mgr.delete_user(username):
+            logger.info("user removed from db")
+            return "removed"
+
+        logger.error(f"user {username} has been removed from the Coder server but is still in the db")
+        return "done"
@@ -0,0 +1,111 @@
+from coder_sms_register.config import Config
+from coder_sms_register.coder import Coder
+from coder_sms_register.user_store import UserStore
+from coder_sms_register.metrics import registry
+from coder_sms_register.supervisor import beat
+from collections import deque
+import threading
+
+# Logging setup
+import logging
+logger = logging.getLogger(__name__)
+
+pool_candidates = registry.counter("username_pool_candidates_total", "generated usernames checked for the pool, by result (free, store_collision, coder_collision or error)", labelnames=("result",))
+pool_misses = registry.counter("username_pool_misses_total", "usernames generated on the spot because the pool was empty")
+
+
+class UsernamePool:
+    """
+        Keeps up to size usernames that are already known to be free - not in the user store and not on the Coder server - so registration
+        can take one without risking a failed create user request on a name that is taken.
+
+        A background thread (run) tops the pool up. take() is safe to call from any thread.
+    """
+
+    def __init__(self, user_store: UserStore, size: int):
+        self.user_store = user_store
+        self.size = size
+        self.names = deque()
+        self.lock = threading.Lock()
+
+    def depth(self) -> int:
+        """Returns the number of usernames ready in the pool"""
+
+        return len(self.names)
+
+    def take(self) -> str:
+        """Returns a free username from the pool, or None if the pool is empty"""
+
+        try:
+            return self.names.popleft()
+        except IndexError:
+            pool_misses.inc()
+            return None
+
+    def check_username(self, user_name: str) -> str:
+        """
+            Checks a candidate username against the user store and the Coder server.
+
+            Returns "free", "store_collision", "coder_collision" or "error".
+        """
+
+        try:
+            if self.user_store.username_exists(user_name):
+                return "store_collision"
+        except Exception as e:
+            logger.error(f"problem checking the user store for username {user_name}")
+            logger.error(e)
+            return "error"
+
+        coder_user_exists = Coder.coder_user_exists(user_name)
+        if coder_user_exists is None:
+            return "error"
+
+        return "coder_collision" if coder_user_exists else "free"
+
+    def fill(self) -> int:
+        """
+            Generates and checks usernames until the pool is full. Gives up for this pass after a check fails (the store or the Coder server
+            is having trouble), or after size * 4 candidates, so a nearly used up name space doesn't keep the thread spinning.
+
+            Returns the number of usernames added.
+        """
+
+        added = 0
+        for i in range(0, self.size * 4):
+            if self.depth() >= self.size:
+                break
+
+            user_name = Coder.gen_username()
+            with self.lock:
+                if user_name in self.names:
+                    continue
+
+            result = self.check_username(user_name)
+            pool_candidates.inc(result=result)
+
+            if result == "error":
+                break
+
+            if result == "free":
+                with self.lock:
+                    if user_name not in self.names:
+                        self.names.append(user_name)
+                        added += 1
+
+        if self.depth() < self.size:
+            logger.warning(f"username pool is only {self.depth()} of {self.size} deep")
+
+        return added
+
+    def run(self, stop: threading.Event) -> None:
+        """A method to keep the pool topped up until stop is set. Meant to be the target of its own thread."""
+
+        logger.info(f"starting username pool with {self.size} usernames")
+
+        while not stop.is_set():
+            beat()
+            if added:= self.fill():
+                logger.debug(f"added {added} usernames to the pool")
+
+            stop.wait(Config.username_pool_interval)
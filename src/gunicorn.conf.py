@@ -0,0 +1,42 @@
+# gunicorn settings for the inbound sms api, read from the environment so the container can be tuned without a rebuild
+#
+# SMS_API_WORKER_CLASS:
+#   sync    - the default gunicorn worker, one webhook at a time per process
+#   gthread - SMS_API_THREADS webhooks at a time per process (pairs well with SMS_API_BATCH_XADD=true)
+#   gevent  - SMS_API_WORKER_CONNECTIONS webhooks at a time per process on greenlets (requires pip install gevent)
+#   asgi    - the ASGI app (coder_sms_register.sms_asgi) on uvicorn workers, with an async redis producer (requires pip install .[asgi])
+# SMS_API_WORKERS: worker processes (default 2)
+
+import os
+
+worker_type = os.environ.get("SMS_API_WORKER_CLASS", "sync").lower()
+
+bind = os.environ.get("SMS_API_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("SMS_API_WORKERS", 2))
+threads = int(os.environ.get("SMS_API_THREADS", 8)) if worker_type == "gthread" else 1
+worker_connections = int(os.environ.get("SMS_API_WORKER_CONNECTIONS", 1000))
+# seconds workers get to finish the webhooks they are handling after SIGTERM - shares SHUTDOWN_DEADLINE with the daemon so both stop
+# within the container's stop timeout
+graceful_timeout = max(1, round(float(os.environ.get("SHUTDOWN_DEADLINE", 8))))
+
+if worker_type == "asgi":
+    worker_class = "uvicorn.workers.UvicornWorker"
+    wsgi_app = "asgi:sms_asgi"
+elif worker_type in ("sync", "gthread", "gevent"):
+    worker_class = worker_type
+    wsgi_app = "wsgi:sms_api"
+else:
+    raise ValueError(f"unknown SMS_API_WORKER_CLASS: {worker_type} - expected 'sync', 'gthread', 'gevent' or 'asgi'")
+
+
+def on_starting(server):
+    # check the api's settings once, in the master, so a bad environment stops gunicorn with one message listing every problem
+    # instead of every worker failing on its first webhook
+    from coder_sms_register.config import Config
+    Config.load("api")
+
+
+def post_fork(server, worker):
+    # each worker gets its own log queue and listener thread - threads don't survive the fork, so this can't happen at import time
+    from coder_sms_register.logs import setup_logging
+    setup_logging("api")
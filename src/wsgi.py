@@ -1,4 +1,9 @@
 from coder_sms_register.sms_api import sms_api
 
 if __name__ == "__main__":
-    sms_api.run(host="0.0.0.0")
\ No newline at end of file
+    # running the flask development server directly - under gunicorn, gunicorn.conf.py does this
+    from coder_sms_register.config import Config
+    from coder_sms_register.logs import setup_logging
+    Config.load("api")
+    setup_logging("api")
+    sms_api.run(host="0.0.0.0")
@@ -0,0 +1,92 @@
+from coder_sms_register.coder import Coder
+from unittest import mock
+import unittest
+
+
+def build(build_id: str, transition: str, status: str) -> dict:
+    return {"id": build_id, "transition": transition, "status": status}
+
+
+class TestRemoveUserStep(unittest.TestCase):
+    """Each step of removing a user, with the Coder API calls mocked out"""
+
+    def setUp(self):
+        self.coder = Coder("happy-tuna")
+
+        patcher = mock.patch.object(Coder, "delete_workspaces", side_effect=lambda workspace_ids: {workspace_id: True for workspace_id in workspace_ids})
+        self.delete_workspaces = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def set_builds(self, builds: list[dict]) -> None:
+        """Makes get_user_workspaces report these workspace builds"""
+
+        def get_user_workspaces():
+            self.coder.workspace_builds = builds
+            return [[build["id"] for build in builds], builds]
+
+        patcher = mock.patch.object(self.coder, "get_user_workspaces", side_effect=get_user_workspaces)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_expired_without_workspaces_moves_to_user_deleting(self):
+        self.set_builds([])
+
+        self.assertEqual(self.coder.remove_user_step("expired"), "user_deleting")
+        self.delete_workspaces.assert_called_once_with([])
+
+    def test_expired_with_stopped_workspaces_starts_deletes(self):
+        self.set_builds([build("ws-1", "stop", "stopped"), build("ws-2", "delete", "running")])
+
+        self.assertEqual(self.coder.remove_user_step("expired"), "workspaces_deleting")
+        # ws-2 is already being deleted
+        self.delete_workspaces.assert_called_once_with(["ws-1"])
+
+    def test_expired_with_running_workspaces_waits(self):
+        self.set_builds([build("ws-1", "start", "running")])
+
+        self.assertEqual(self.coder.remove_user_step("expired"), "expired")
+        self.delete_workspaces.assert_not_called()
+
+    def test_expired_stays_expired_if_workspaces_cannot_be_fetched(self):
+        with mock.patch.object(self.coder, "get_user_workspaces", return_value=None):
+            self.assertEqual(self.coder.remove_user_step("expired"), "expired")
+
+        self.delete_workspaces.assert_not_called()
+
+    def test_expired_stays_expired_if_a_delete_fails(self):
+        self.set_builds([build("ws-1", "stop", "stopped"), build("ws-2", "stop", "stopped")])
+        self.delete_workspaces.side_effect = lambda workspace_ids: {"ws-1": True, "ws-2": False}
+
+        self.assertEqual(self.coder.remove_user_step("expired"), "expired")
+
+    def test_workspaces_deleting_moves_on_once_workspaces_are_gone(self):
+        self.set_builds([])
+
+        self.assertEqual(self.coder.remove_user_step("workspaces_deleting"), "user_deleting")
+
+    def test_workspaces_deleting_restarts_failed_deletes(self):
+        self.set_builds([build("ws-1", "delete", "failed"), build("ws-2", "delete", "running"), build("ws-3", "start", "running")])
+
+        self.assertEqual(self.coder.remove_user_step("workspaces_deleting"), "workspaces_deleting")
+        # ws-3 was started again in the meantime - it has to stop before it can be deleted
+        self.delete_workspaces.assert_called_once_with(["ws-1"])
+
+    def test_workspaces_deleting_stays_if_workspaces_cannot_be_fetched(self):
+        with mock.patch.object(self.coder, "get_user_workspaces", return_value=None):
+            self.assertEqual(self.coder.remove_user_step("workspaces_deleting"), "workspaces_deleting")
+
+    def test_user_deleting_finishes_once_the_user_is_deleted(self):
+        with mock.patch.object(self.coder, "delete_coder_user", return_value=True):
+            self.assertEqual(self.coder.remove_user_step("user_deleting"), "done")
+
+    def test_user_deleting_retries_if_the_delete_fails(self):
+        with mock.patch.object(self.coder, "delete_coder_user", return_value=False):
+            self.assertEqual(self.coder.remove_user_step("user_deleting"), "user_deleting")
+
+    def test_invalid_state_raises(self):
+        with self.assertRaises(Exception):
+            self.coder.remove_user_step("done")
+
+
+if __name__ == "__main__":
+    unittest.main()
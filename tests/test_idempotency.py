@@ -0,0 +1,49 @@
+from coder_sms_register.idempotency import IdempotencyStore
+import fakeredis
+import unittest
+
+
+class TestIdempotencyStore(unittest.TestCase):
+
+    def setUp(self):
+        self.redis_conn = fakeredis.FakeRedis(decode_responses=True)
+        self.store = IdempotencyStore(self.redis_conn, key_prefix="test_state:", ttl=86400, pw_ttl=1800)
+
+    def test_unknown_message_has_no_state(self):
+        self.assertIsNone(self.store.get("SM1"))
+        self.assertIsNone(self.store.get(None))
+
+    def test_saves_state_and_fields(self):
+        self.store.set_state("SM1", "received")
+        self.store.set_state("SM1", "user_created", username="happy-tuna", phone_num_hash="hash")
+
+        self.assertEqual(self.store.get("SM1"), {"state": "user_created", "username": "happy-tuna", "phone_num_hash": "hash"})
+        self.assertEqual(self.redis_conn.ttl("test_state:SM1"), 86400)
+
+    def test_password_is_kept_apart_with_a_short_ttl(self):
+        self.store.set_state("SM1", "user_created", username="happy-tuna", pw="secret")
+
+        self.assertEqual(self.store.get("SM1")["pw"], "secret")
+        self.assertNotIn("pw", self.redis_conn.hgetall("test_state:SM1"))
+        self.assertEqual(self.redis_conn.ttl("test_state:SM1:pw"), 1800)
+
+    def test_expired_password_is_left_out(self):
+        self.store.set_state("SM1", "user_created", username="happy-tuna", pw="secret")
+        self.redis_conn.delete("test_state:SM1:pw")
+
+        self.assertNotIn("pw", self.store.get("SM1"))
+
+    def test_password_is_removed_once_the_sms_is_sent(self):
+        self.store.set_state("SM1", "user_created", username="happy-tuna", pw="secret")
+        self.store.set_state("SM1", "sms_sent")
+
+        self.assertEqual(self.store.get("SM1"), {"state": "sms_sent", "username": "happy-tuna"})
+        self.assertFalse(self.redis_conn.exists("test_state:SM1:pw"))
+
+    def test_rejects_unknown_states(self):
+        with self.assertRaises(Exception):
+            self.store.set_state("SM1", "finished")
+
+
+if __name__ == "__main__":
+    unittest.main()
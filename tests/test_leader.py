@@ -0,0 +1,55 @@
+from coder_sms_register.leader import LeaderLease
+from unittest import mock
+import fakeredis
+import unittest
+
+
+class TestLeaderLease(unittest.TestCase):
+
+    def setUp(self):
+        self.redis_conn = fakeredis.FakeRedis(decode_responses=True)
+        self.first = LeaderLease(self.redis_conn, "test_leader", "replica-1", ttl=15)
+        self.second = LeaderLease(self.redis_conn, "test_leader", "replica-2", ttl=15)
+
+    def test_only_one_replica_takes_the_lease(self):
+        self.assertTrue(self.first.try_acquire())
+        self.assertFalse(self.second.try_acquire())
+
+        self.assertTrue(self.first.is_leader())
+        self.assertFalse(self.second.is_leader())
+        self.assertEqual(self.redis_conn.get("test_leader"), "replica-1:1")
+
+    def test_renew_keeps_the_lease(self):
+        self.first.try_acquire()
+
+        self.assertTrue(self.first.renew())
+        self.assertTrue(self.first.is_leader())
+
+    def test_release_lets_another_replica_take_over(self):
+        self.first.try_acquire()
+        self.first.release()
+
+        self.assertFalse(self.first.is_leader())
+        self.assertTrue(self.second.try_acquire())
+        self.assertEqual(self.second.token, 2)
+
+    def test_expired_lease_is_lost_and_fenced(self):
+        self.first.try_acquire()
+        # the lease ran out while replica-1 was paused, and replica-2 took it
+        self.redis_conn.delete("test_leader")
+        self.assertTrue(self.second.try_acquire())
+
+        self.assertFalse(self.first.is_leader())
+        self.assertFalse(self.first.renew())
+        self.assertIsNone(self.first.token)
+        self.assertTrue(self.second.is_leader())
+
+    def test_not_leader_once_the_lease_period_passes_without_a_renew(self):
+        self.first.try_acquire()
+
+        with mock.patch("coder_sms_register.leader.monotonic", return_value=self.first.renewed_at + 15):
+            self.assertFalse(self.first.is_leader())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+from coder_sms_register.models import users, upgrade_schema
+from datetime import datetime
+from zoneinfo import ZoneInfo
+import sqlalchemy as db
+import unittest
+
+
+class TestUpgradeSchema(unittest.TestCase):
+    """Brings a database created by the first release (string create stamps, no phone_key or remove_state) up to date"""
+
+    def setUp(self):
+        self.engine = db.create_engine("sqlite://")
+        with self.engine.begin() as connection:
+            connection.execute(db.text("CREATE TABLE users (hash_id VARCHAR NOT NULL PRIMARY KEY, username VARCHAR NOT NULL, create_stamp VARCHAR NOT NULL)"))
+            connection.execute(db.text("INSERT INTO users (hash_id, username, create_stamp) VALUES (:hash_id, :username, :create_stamp)"), [
+                {"hash_id": "hash-1", "username": "happy-tuna", "create_stamp": "2023-01-15 08:30:00"},
+                # summer time in Chicago - UTC-5 instead of UTC-6
+                {"hash_id": "hash-2", "username": "sad-cod", "create_stamp": "2023-07-04 17:45:10"},
+            ])
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def get_users(self) -> dict:
+        with self.engine.connect() as connection:
+            return {row.username: row for row in connection.execute(db.select(users))}
+
+    def test_upgrade_adds_columns_and_indexes(self):
+        upgrade_schema(self.engine)
+
+        inspector = db.inspect(self.engine)
+        cols = {col["name"]: col for col in inspector.get_columns("users")}
+        self.assertIn("phone_key", cols)
+        self.assertIn("remove_state", cols)
+        self.assertIsInstance(cols["create_stamp"]["type"], db.Integer)
+        self.assertEqual({index.name for index in users.indexes}, {index["name"] for index in inspector.get_indexes("users")})
+
+    def test_upgrade_converts_stamps_from_chicago_time(self):
+        upgrade_schema(self.engine)
+
+        saved_users = self.get_users()
+        self.assertEqual(saved_users["happy-tuna"].create_stamp, int(datetime(2023, 1, 15, 14, 30, tzinfo=ZoneInfo("UTC")).timestamp()))
+        self.assertEqual(saved_users["sad-cod"].create_stamp, int(datetime(2023, 7, 4, 22, 45, 10, tzinfo=ZoneInfo("UTC")).timestamp()))
+        self.assertEqual(saved_users["happy-tuna"].hash_id, "hash-1")
+        self.assertIsNone(saved_users["happy-tuna"].phone_key)
+        self.assertIsNone(saved_users["happy-tuna"].remove_state)
+
+    def test_upgrade_uses_the_time_zone_provided(self):
+        upgrade_schema(self.engine, "UTC")
+
+        self.assertEqual(self.get_users()["happy-tuna"].create_stamp, int(datetime(2023, 1, 15, 8, 30, tzinfo=ZoneInfo("UTC")).timestamp()))
+
+    def test_upgrade_is_idempotent(self):
+        upgrade_schema(self.engine)
+        first_pass = self.get_users()
+
+        upgrade_schema(self.engine)
+        second_pass = self.get_users()
+
+        self.assertEqual(first_pass, second_pass)
+        self.assertEqual(len(db.inspect(self.engine).get_indexes("users")), len(users.indexes))
+        self.assertNotIn("users_legacy", db.inspect(self.engine).get_table_names())
+
+    def test_upgraded_table_enforces_unique_phone_keys(self):
+        upgrade_schema(self.engine)
+
+        with self.engine.begin() as connection:
+            connection.execute(db.update(users).where(users.c.username == "happy-tuna").values(phone_key="key-1"))
+
+        with self.assertRaises(db.exc.IntegrityError):
+            with self.engine.begin() as connection:
+                connection.execute(db.update(users).where(users.c.username == "sad-cod").values(phone_key="key-1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
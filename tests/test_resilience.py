@@ -0,0 +1,102 @@
+from coder_sms_register.resilience import CircuitBreaker, RetryPolicy, retryable
+from unittest import mock
+import unittest
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("coder_sms_register.resilience.monotonic", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=30)
+
+    def fail(self, times: int) -> None:
+        for i in range(0, times):
+            self.breaker.record(503)
+
+    def test_opens_after_threshold_failures_in_a_row(self):
+        self.fail(2)
+        self.assertEqual(self.breaker.state, "closed")
+        self.assertTrue(self.breaker.allow_request())
+
+        self.fail(1)
+        self.assertEqual(self.breaker.state, "open")
+        self.assertTrue(self.breaker.is_open())
+        self.assertFalse(self.breaker.allow_request())
+
+    def test_success_resets_the_failure_count(self):
+        self.fail(2)
+        self.breaker.record(200)
+        self.fail(2)
+
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_client_errors_are_not_failures(self):
+        for i in range(0, 5):
+            self.breaker.record(404)
+
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_timeouts_are_failures(self):
+        for i in range(0, 3):
+            self.breaker.record(None)
+
+        self.assertEqual(self.breaker.state, "open")
+
+    def test_lets_one_trial_request_through_after_the_reset_timeout(self):
+        self.fail(3)
+        self.now += 30
+
+        self.assertFalse(self.breaker.is_open())
+        self.assertEqual(self.breaker.retry_in(), 0)
+        self.assertTrue(self.breaker.allow_request())
+        self.assertEqual(self.breaker.state, "half_open")
+        self.assertFalse(self.breaker.allow_request())
+
+    def test_trial_success_closes_the_circuit(self):
+        self.fail(3)
+        self.now += 30
+        self.breaker.allow_request()
+        self.breaker.record(201)
+
+        self.assertEqual(self.breaker.state, "closed")
+        self.assertTrue(self.breaker.allow_request())
+
+    def test_trial_failure_opens_the_circuit_again(self):
+        self.fail(3)
+        self.now += 30
+        self.breaker.allow_request()
+        self.breaker.record(500)
+
+        self.assertEqual(self.breaker.state, "open")
+        self.assertEqual(self.breaker.retry_in(), 30)
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.retry_policy = RetryPolicy(base=1, cap=8, max_wait=60)
+
+    def test_only_server_errors_timeouts_and_rate_limits_are_retried(self):
+        self.assertTrue(retryable(None))
+        self.assertTrue(retryable(503))
+        self.assertTrue(retryable(429))
+        self.assertFalse(retryable(400))
+        self.assertIsNone(self.retry_policy.delay(0, 404))
+
+    def test_backoff_is_capped(self):
+        for attempt in range(0, 10):
+            self.assertLessEqual(self.retry_policy.delay(attempt, 503), 8)
+
+    def test_honours_retry_after(self):
+        self.assertGreaterEqual(self.retry_policy.delay(0, 429, {"Retry-After": "20"}), 20)
+
+    def test_gives_up_if_retry_after_is_too_long(self):
+        self.assertIsNone(self.retry_policy.delay(0, 429, {"Retry-After": "120"}))
+
+
+if __name__ == "__main__":
+    unittest.main()
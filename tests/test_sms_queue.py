@@ -0,0 +1,38 @@
+from coder_sms_register.sms_queue import ShardedQueue
+import unittest
+
+
+class TestShardedQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = ShardedQueue(4)
+
+    def test_needs_at_least_one_shard(self):
+        with self.assertRaises(ValueError):
+            ShardedQueue(0)
+
+    def test_messages_from_the_same_number_share_a_shard_in_order(self):
+        for i in range(0, 5):
+            self.queue.put((f"{i}-0", {"From": "+15555550100", "Body": str(i)}))
+
+        shard = self.queue.shard(self.queue.shard_for("+15555550100"))
+        self.assertEqual([shard.get_nowait()[0] for i in range(0, 5)], [f"{i}-0" for i in range(0, 5)])
+
+    def test_depths_and_qsize(self):
+        for i in range(0, 50):
+            self.queue.put((f"{i}-0", {"From": f"+1555555{i:04d}"}))
+
+        self.assertEqual(len(self.queue.depths()), 4)
+        self.assertEqual(sum(self.queue.depths()), 50)
+        self.assertEqual(self.queue.qsize(), 50)
+        # 50 numbers shouldn't all hash to one shard
+        self.assertGreater(len([depth for depth in self.queue.depths() if depth]), 1)
+
+    def test_missing_from_number_still_routes(self):
+        self.queue.put(("1-0", {}))
+
+        self.assertEqual(self.queue.shard(self.queue.shard_for("")).qsize(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
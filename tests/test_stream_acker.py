@@ -0,0 +1,49 @@
+from coder_sms_register.sms_listener import StreamAcker
+from time import sleep
+import fakeredis
+import unittest
+
+
+class TestStreamAcker(unittest.TestCase):
+
+    def setUp(self):
+        self.redis_conn = fakeredis.FakeRedis(decode_responses=True)
+        self.redis_conn.xgroup_create("sms", "grp", mkstream=True, id="$")
+        self.msg_id = self.redis_conn.xadd("sms", {"MessageSid": "SM1"})
+        self.redis_conn.xreadgroup("grp", "consumer-1", {"sms": ">"})
+        self.acker = StreamAcker(self.redis_conn, "sms", "grp", max_batch=10, max_wait_ms=100, consumer_name="consumer-1", touch_interval_ms=1000)
+
+    def idle_ms(self) -> int:
+        return self.redis_conn.xpending_range("sms", "grp", "-", "+", 10)[0]["time_since_delivered"]
+
+    def test_touch_keeps_held_messages_from_being_reclaimed(self):
+        self.acker.hold(self.msg_id)
+        sleep(.2)
+        self.assertTrue(self.acker.touch())
+
+        self.assertLess(self.idle_ms(), 200)
+        _, claimed, _ = self.redis_conn.xautoclaim("sms", "grp", "consumer-2", 150, "0-0")
+        self.assertEqual(claimed, [])
+        # touching doesn't count as a delivery
+        self.assertEqual(self.redis_conn.xpending_range("sms", "grp", "-", "+", 10)[0]["times_delivered"], 1)
+
+    def test_released_messages_are_not_touched(self):
+        self.acker.hold(self.msg_id)
+        self.acker.release(self.msg_id)
+        sleep(.2)
+        self.acker.touch()
+
+        self.assertGreaterEqual(self.idle_ms(), 200)
+
+    def test_acknowledging_stops_holding(self):
+        self.acker.hold(self.msg_id)
+        self.acker.add(self.msg_id)
+        sleep(.2)
+        self.acker.touch()
+
+        self.assertEqual(self.acker.qsize(), 1)
+        self.assertGreaterEqual(self.idle_ms(), 200)
+
+
+if __name__ == "__main__":
+    unittest.main()